@@ -1,52 +1,230 @@
 """Views for Melomap App"""
 
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify, abort
+import time
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify, abort, make_response
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy import func
+from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import IntegrityError
-from werkzeug.utils import secure_filename
 from werkzeug.exceptions import HTTPException
-import uuid as uuid
 
 from views.forms import SignupForm, LoginForm, EditUserForm, EditPasswordForm, ImageUploadForm
-from models.models import db, connect_db, User, Song, Post
-from views.api_funcs import get_keywords, get_list_of_tracks
+from models.models import db, connect_db, User, Song, Post, BookmarkedSongs, recount_counters
+from models.migrations import migrate, migration_status
+from models.routing import REPLICA_BIND, engine_options, pool_stats
+from views import fragments
+from views.identity import load_identity, forget_identity
+from views.metrics import metrics
+from views import api
+from views import assets
+from views import thumbnails
+from views.storage import (MAX_UPLOAD_BYTES, UploadTooLarge, LocalStorage, init_storage,
+                           current_storage, image_key, import_file)
+from views.pagination import (encode_post_cursor, decode_post_cursor, encode_int_cursor,
+                              decode_int_cursor)
+from views.search import search_songs, search_users
+from views.uploads import save_post_image
+from views.upload_jobs import enqueue_upload, run_next_job, start_upload_workers, wake_upload_workers
 from functools import wraps
 
 CURR_USER_KEY = 'curr_user'
+# until when this browser's reads go to the primary, after it wrote
+PRIMARY_UNTIL_KEY = 'primary_until'
+# songs/users listed on popular pages
+POPULAR_LIMIT = 50
 app = Flask(__name__)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = (os.environ.get(
     'DATABASE_URL', 'postgresql:///melomap'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool size, overflow, timeout, recycle and pre-ping from DB_POOL_* variables
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+# Read-only routes query the replica when one is set
+if os.environ.get('DATABASE_REPLICA_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: os.environ['DATABASE_REPLICA_URL']}
+# Seconds a browser reads from the primary after writing, longer than replica lag
+app.config['REPLICA_LAG_WINDOW'] = float(os.environ.get('REPLICA_LAG_WINDOW', 5))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 toolbar = DebugToolbarExtension(app)
 
-# Photos upload directories - saving photo uploads to app folders for now
-PROFILE_FOLDER  = 'static/profile-images'
-app.config['PROFILE_FOLDER'] = PROFILE_FOLDER
+# Uploaded photos are stored by content hash in STORAGE_BACKEND: 'local'
+# files under STORAGE_ROOT (default the static folder, or a mount shared by
+# all app nodes) served at STORAGE_URL, or 'memory' for tests
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+app.config['STORAGE_ROOT'] = os.environ.get('STORAGE_ROOT')
+app.config['STORAGE_URL'] = os.environ.get('STORAGE_URL')
+app.config['MAX_UPLOAD_BYTES'] = int(os.environ.get('MAX_UPLOAD_BYTES', MAX_UPLOAD_BYTES))
+# Bodies bigger than a photo plus the form's fields are refused unread
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_UPLOAD_BYTES'] + 1024 * 1024
 
-IMAGE_FOLDER = 'static/post-images'
-app.config['IMAGE_FOLDER'] = IMAGE_FOLDER
+# Background threads per serving process finishing uploaded posts (0 to
+# disable, e.g. when running `flask upload-worker` as its own process instead)
+app.config['UPLOAD_WORKER_THREADS'] = int(os.environ.get('UPLOAD_WORKER_THREADS', 1))
+
+# Processes making sized copies of uploaded images (0 to make them in
+# the request or upload job instead)
+app.config['THUMBNAIL_PROCESSES'] = int(os.environ.get('THUMBNAIL_PROCESSES', 2))
+
+# /metrics exposes internal counters and pool stats, off unless asked for
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '0') == '1'
 
 connect_db(app)
+init_storage(app)
+
+def db_pool_stats():
+    """Returns connection counts of primary and replica pools"""
+
+    binds = [None, *(app.config.get('SQLALCHEMY_BINDS') or {})]
+    return {bind or 'primary': pool_stats(db.get_engine(app, bind)) for bind in binds}
+
+metrics.register('db_pool', db_pool_stats)
+
+@app.before_first_request
+def start_background_work():
+    """Before the first request this process serves, starts its upload
+    worker threads and thumbnail pool (so CLI commands don't)"""
+
+    if app.config['UPLOAD_WORKER_THREADS']:
+        start_upload_workers(app, app.config['UPLOAD_WORKER_THREADS'])
+
+    if app.config['THUMBNAIL_PROCESSES']:
+        thumbnails.start_thumbnail_pool(app.config['THUMBNAIL_PROCESSES'])
+
+###############################################################
+# Static files
+
+@app.after_request
+def cache_static(response):
+    """Lets browsers keep uploads and fingerprinted static files for a
+    year without revalidating"""
+
+    if request.endpoint == 'static':
+        assets.set_cache_headers(response, app.static_folder,
+                                 request.view_args['filename'], request.args.get('v'))
+    return response
+
+
+def asset_url(filename):
+    """Returns URL of static file, fingerprinted by content (used by templates)"""
+
+    return assets.asset_url(app.static_folder, filename)
+
+
+# widths of sized copies of images in each upload folder
+IMAGE_WIDTHS = {'post-images': thumbnails.POST_WIDTHS,
+                'profile-images': thumbnails.AVATAR_WIDTHS}
+
+
+def storage_url(key):
+    """Returns URL of stored file, fingerprinted like other static files
+    when storage is served from the static folder"""
+
+    url = current_storage().url(key)
+    if url == f'/static/{key}':
+        return asset_url(key)
+    return url
+
+
+def image_url(folder, name):
+    """Returns URL of uploaded image saved in a post or user row
+    (used by templates)"""
+
+    return storage_url(image_key(folder, name))
+
+
+def image_srcsets(folder, name):
+    """Returns srcsets (and a fallback src) of an uploaded image's sized
+    copies, None until they exist (used by the picture macro)"""
+
+    key = image_key(folder, name)
+    widths = thumbnails.variant_widths(current_storage(), key)
+    if widths is None:
+        return None
+    srcsets = thumbnails.srcsets(key, widths, storage_url)
+    srcsets['src'] = storage_url(thumbnails.variant_key(key, widths[len(widths) // 2], 'jpg'))
+    return srcsets
+
+app.jinja_env.globals.update(asset_url=asset_url, image_url=image_url,
+                             image_srcsets=image_srcsets)
+
+
+def upload_too_large_message():
+    """Returns form error for a photo over the upload size limit"""
+
+    limit = app.config['MAX_UPLOAD_BYTES']
+    if limit >= 1024 * 1024:
+        return f'Photo must be smaller than {limit // (1024 * 1024)} MB.'
+    return f'Photo must be smaller than {limit // 1024} KB.'
 
 ###############################################################
 # User auth decoraters/functions
 
+@app.before_request
+def route_reads():
+    """Before every request, lets read-only routes query the replica,
+    unless this browser wrote recently and the replica may lag behind"""
+
+    view = app.view_functions.get(request.endpoint)
+    g.db_replica = (getattr(view, 'read_only', False)
+                    and session.get(PRIMARY_UNTIL_KEY, 0) < time.time())
+
+
+@app.after_request
+def remember_writes(response):
+    """After a request that wrote, reads stay on the primary for a while
+    so the browser sees its own changes"""
+
+    if g.get('db_wrote') and app.config.get('SQLALCHEMY_BINDS'):
+        session[PRIMARY_UNTIL_KEY] = time.time() + app.config['REPLICA_LAG_WINDOW']
+    return response
+
+
+def read_only(func):
+    """Marks route as read-only, so its queries can go to the replica"""
+
+    func.read_only = True
+    return func
+
+
 @app.before_request
 def add_user_to_g():
     """Before every request, checks if a user is logged in
-    and adds current user to Flask global"""
+    and adds current user's slim identity to Flask global
+    - routes needing the full User row call g.user.load()"""
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_identity(session[CURR_USER_KEY])
     else:
         g.user = None
 
 
+def bookmarked_song_ids():
+    """Returns IDs of songs bookmarked by current user as a set,
+    loaded once per request for every song the templates display"""
+
+    if 'bookmarked_song_ids' not in g:
+        g.bookmarked_song_ids = g.user.bookmarked_song_ids() if g.user else set()
+    return g.bookmarked_song_ids
+
+
+def post_card(post):
+    """Returns post's cached card with current user's trash button
+    and bookmark icons (used by display_post)"""
+
+    return fragments.post_card(post, g.user.id if g.user else None, bookmarked_song_ids)
+
+
+def song_card(song, border_style):
+    """Returns song's cached card with current user's bookmark icon
+    (used by display_song)"""
+
+    return fragments.song_card(song, border_style, bookmarked_song_ids)
+
+app.jinja_env.globals.update(post_card=post_card, song_card=song_card)
+
+
 def check_g_user(func):
     """Custom decorator function to check if g.user logged in 
     for routes requiring authorization"""
@@ -152,53 +330,77 @@ def logout():
 # Dynamic homepages 
 
 @app.route('/')
+@read_only
 def homepage():
     """Shows homepage:
     - anon users: signup page
-    - logged in: 30 most recent posts
+    - logged in: most recent posts, more are loaded with the page's cursor
     """
 
     if g.user:
-        posts = Post.query.order_by(Post.timestamp.desc()).limit(5).all()
-        return render_template('homepages/home.html', posts=posts)
+        posts, has_more = Post.feed_page()
+        next_cursor = encode_post_cursor(posts[-1]) if has_more else None
+        return render_template('homepages/home.html', posts=posts,
+                               next_cursor=next_cursor)
 
     else:
         return render_template('homepages/home-anon.html')
 
 @app.route('/loadmore/posts')
+@read_only
 @check_g_user
 def loadmore_posts():
-    """Shows more posts
-    - sends response to axios request to be handled in JS"""
+    """Shows next page of posts after cursor
+    - sends response to axios request to be handled in JS, with
+      cursor for the following page in X-Next-Cursor (absent on last page)"""
 
-    offset = int(request.args.get('offset'))
-    posts = Post.query.order_by(Post.timestamp.desc()).limit(5).offset(offset).all()
-    return render_template('homepages/loadmore.html', posts=posts)
+    try:
+        after = decode_post_cursor(request.args.get('cursor', ''))
+    except ValueError:
+        abort(400)
+
+    posts, has_more = Post.feed_page(after)
+    resp = make_response(render_template('homepages/loadmore.html', posts=posts))
+    if has_more:
+        resp.headers['X-Next-Cursor'] = encode_post_cursor(posts[-1])
+    return resp
 
 
 ###############################################################
 # User routes
     
 @app.route('/users/<int:user_id>')
+@read_only
 @check_g_user
 def user_profile(user_id):
     """Show user profile - displays user's posts by default"""
 
-    user = User.query.get_or_404(user_id)
+    user = user_with_posts(user_id)
     return render_template('user/profile.html', user=user)
 
 
 @app.route('/users/<int:user_id>/posts')
+@read_only
 @check_g_user
 def show_user_posts(user_id):
     """Show all posts by user 
     - sends response to axios request to be handled in JS"""
    
-    user = User.query.get_or_404(user_id)
+    user = user_with_posts(user_id)
     return render_template('user/posts.html', user=user)
 
 
+def user_with_posts(user_id):
+    """Gets user or 404, with user's posts and their songs loaded
+    in one query each"""
+
+    return (User.query
+            .options(selectinload(User.posts).selectinload(Post.songs))
+            .get_or_404(user_id))
+
+
 @app.route('/users/<int:user_id>/bookmarked')
+@read_only
 @check_g_user
 def show_bookmarked_songs(user_id):
     """Show all bookmarked songs by user 
@@ -208,22 +410,33 @@ def show_bookmarked_songs(user_id):
     return render_template('user/saved.html', user=user)
 
 
+@app.route('/users/top')
+@read_only
+@check_g_user
+def top_users():
+    """Show users with the most posts"""
+
+    users = User.most_posts(limit=POPULAR_LIMIT)
+    return render_template('user/top.html', users=users)
+
+
 @app.route('/bookmark/<int:song_id>', methods=['POST'])
 @check_g_user
 def bookmark(song_id):
     """ Add/remove bookmark for songs 
     - sends response to axios request to be handled in JS"""
-   
-    song = Song.query.get(song_id)
-    if song in g.user.bookmarked_songs:
-        g.user.bookmarked_songs.remove(song)
-        message = 'removed'
-    else:
-        g.user.bookmarked_songs.append(song)
-        message = 'added'
 
-    db.session.commit()
-    return jsonify(message=message)
+    try:
+        bookmarked = BookmarkedSongs.toggle(g.user.id, song_id)
+        db.session.commit()
+    except IntegrityError:
+        # no song with song_id
+        db.session.rollback()
+        abort(404)
+
+    g.pop('bookmarked_song_ids', None)
+    return jsonify(message='added' if bookmarked else 'removed',
+                   bookmarked=bookmarked)
 
 
 @app.route('/user/edit', methods=['GET', 'POST'])
@@ -231,51 +444,65 @@ def bookmark(song_id):
 def edit_user():
     """Shows edit user form and handles editing user info"""
     
-    form = EditUserForm(obj=g.user)
+    user = g.user.load()
+    form = EditUserForm(obj=user)
 
     # If form validated, authenticate user to saved changes to db
     if form.validate_on_submit():
-        if User.authenticate(g.user.username, form.password.data):
+        if User.authenticate(user.username, form.password.data):
             try:
-                g.user.name = form.name.data
-                g.user.location = form.location.data
-                g.user.bio = form.bio.data
-                g.user.email = form.email.data
-                g.user.username = form.username.data
+                user.name = form.name.data
+                user.location = form.location.data
+                user.bio = form.bio.data
+                user.email = form.email.data
+                user.username = form.username.data
                 
                 # If filefield filled, handles saving filename to db
                 if ('profile_image' in request.files and request.files['profile_image']): 
-                    # Grab file and filename
+                    # Stream image into storage under its content key
                     img_file = request.files['profile_image']
-                    img_filename = secure_filename(img_file.filename)
-                    # Set UUID to make unique filenames
-                    img_name = f'{str(uuid.uuid1())}_{img_filename}'
-                    # Save image to profile-images directory
-                    img_file.save(os.path.join(app.config['PROFILE_FOLDER'], img_name))
-                    # Save file's name to db
-                    g.user.profile_image = img_name
+                    stored = current_storage().save(img_file.stream, img_file.filename,
+                                                    app.config['MAX_UPLOAD_BYTES'])
+                    # Start making avatar-sized copies, pages show the
+                    # original until they exist
+                    thumbnails.submit_variants(current_storage(), stored.key,
+                                               thumbnails.AVATAR_WIDTHS)
+                    # Save file's key to db
+                    user.profile_image = stored.key
                 # Otherwise keep image file as is in db and commit
                 db.session.commit()
+                forget_identity(user.id)
+                # posts show user's name, username and profile image
+                fragments.forget_user_posts(user.id)
+
+            # Catches photo over the size limit and refreshes form
+            except UploadTooLarge:
+                db.session.rollback()
+                form.profile_image.errors.append(upload_too_large_message())
+                return render_template('/user/edit.html', form=form,
+                                       user=user,
+                                       title = 'My Info',
+                                       button='Save')
 
             # Catches error if username already exists in db and refreshes form
             except IntegrityError:
                 db.session.rollback()
                 form.username.errors.append('Username taken.')
                 return render_template('/user/edit.html', form=form,
-                                       user=g.user,
+                                       user=user,
                                        title = 'My Info',
                                        button='Save')
             
             # If no errors, then redirects to user profile
             flash("Saved profile edits.", "info")
-            return redirect(url_for('user_profile', user_id=g.user.id))
+            return redirect(url_for('user_profile', user_id=user.id))
         
         # If password authentification fails, display message
         form.password.errors.append('Invalid password.')
 
     # Displays edit user info form 
     return render_template('/user/edit.html', form=form, 
-                           user=g.user,
+                           user=user,
                            title = 'My Info',
                            button='Save')
 
@@ -284,21 +511,22 @@ def edit_user():
 def edit_password():
     """Shows edit password form and handles password changes"""
 
+    user = g.user.load()
     form = EditPasswordForm()
 
     # If form validated, authenticates user's old credentials
     if form.validate_on_submit():
-        if User.authenticate(g.user.username, form.password.data):
+        if User.authenticate(user.username, form.password.data):
             new_pw = form.new_password1.data
             confirm_pw = form.new_password2.data
             
             # Checks if new password and confirm password fields are the same
             if new_pw == confirm_pw:
                 # Hashes new password and saves to db
-                g.user.password = User.hash_pw(new_pw)
+                user.password = User.hash_pw(new_pw)
                 db.session.commit()
                 flash("Changed password.", "info")
-                return redirect(url_for('user_profile', user_id=g.user.id))
+                return redirect(url_for('user_profile', user_id=user.id))
             # Let's user know if new password cannot be confirmed
             form.new_password2.errors.append('Passwords do not match.')
        
@@ -307,7 +535,7 @@ def edit_password():
 
     # Displays edit password form
     return render_template('/user/edit-pw.html',form=form,
-                           user=g.user,
+                           user=user,
                            title = 'Change Password',
                            button = 'Save')
 
@@ -317,9 +545,12 @@ def edit_password():
 def delete_user():
     """Delete user"""
 
+    user = g.user.load()
     do_logout()
-    db.session.delete(g.user)
+    fragments.forget_user_posts(user.id)
+    user.delete()
     db.session.commit()
+    forget_identity(user.id)
 
     flash("Account deleted.", "success")
     return redirect(url_for('homepage'))
@@ -329,109 +560,129 @@ def delete_user():
 # Search music and posts routes
 
 @app.route('/search')
+@read_only
 @check_g_user
 def search():
-    """Search form filters and displays all songs and users in database"""
+    """Search form filters and displays songs and users in database
+    (first page of each, best matches first)"""
     
     # Grab search query 
     search = request.args.get('q')
 
-    # Display all results if no search query entered
-    if not search:
-        songs = Song.query.limit(20).all()
-        users = User.query.all()
-    
-    # Display filtered results based on search query 
-    else:
-        songs = Song.query.filter(
-            (func.lower(Song.title).like(f"%{search}%")) | 
-            (func.lower(Song.album).like(f"%{search}%")) | 
-            (func.lower(Song.artists).like(f"%{search}%"))
-            ).limit(20).all()
-        users = User.query.filter(
-            (func.lower(User.username).like(f"%{search}%")) | 
-            (func.lower(User.name).like(f"%{search}%"))
-            ).all()
+    songs, more_songs = search_songs(search)
+    users, more_users = search_users(search)
 
     return render_template('search.html', 
                             songs=songs,
                             users=users,
+                            more_songs=more_songs,
+                            more_users=more_users,
+                            next_page_cursor=encode_int_cursor(1),
                             search=search)
 
+
+def render_next_page(template, page, has_more, **context):
+    """Renders a load-more page, with number of the following
+    page in X-Next-Page (absent on last page)"""
+
+    resp = make_response(render_template(template, **context))
+    if has_more:
+        resp.headers['X-Next-Page'] = str(page + 1)
+    return resp
+
+
 @app.route('/loadmore/songs')
+@read_only
 @check_g_user
 def loadmore_songs():
     """Shows more song results
     - sends response to axios request to be handled in JS"""
 
-    search = request.args.get('q')
-    offset = int(request.args.get('offset'))
+    # page 0 is rendered by /search
+    page = max(request.args.get('page', 1, type=int), 1)
+    songs, has_more = search_songs(request.args.get('q'), page)
+    return render_next_page('homepages/loadmore.html', page, has_more, songs=songs)
 
-    if not search:
-        songs = Song.query.limit(20).offset(offset).all()
 
-    else:
-        songs = Song.query.filter(
-            (func.lower(Song.title).like(f"%{search}%")) | 
-            (func.lower(Song.album).like(f"%{search}%")) | 
-            (func.lower(Song.artists).like(f"%{search}%"))
-            ).limit(20).offset(offset).all()
-    
-    return render_template('homepages/loadmore.html', songs=songs)
+@app.route('/loadmore/users')
+@read_only
+@check_g_user
+def loadmore_users():
+    """Shows more user results
+    - sends response to axios request to be handled in JS"""
+
+    # page 0 is rendered by /search
+    page = max(request.args.get('page', 1, type=int), 1)
+    users, has_more = search_users(request.args.get('q'), page)
+    return render_next_page('homepages/loadmore.html', page, has_more, users=users)
+
+
+@app.route('/songs/most-bookmarked')
+@read_only
+@check_g_user
+def most_bookmarked_songs():
+    """Show songs bookmarked by the most users"""
+
+    songs = Song.most_bookmarked(limit=POPULAR_LIMIT)
+    return render_template('songs/popular.html', songs=songs,
+                           title='Most bookmarked songs', count='bookmark_count',
+                           label='bookmarks')
+
+
+@app.route('/songs/most-posted')
+@read_only
+@check_g_user
+def most_posted_songs():
+    """Show songs featured in the most posts"""
+
+    songs = Song.most_posted(limit=POPULAR_LIMIT)
+    return render_template('songs/popular.html', songs=songs,
+                           title='Most posted songs', count='post_count',
+                           label='posts')
 
 
 @app.route('/posts/upload', methods=['GET', 'POST'])
 @check_g_user
 def search_music():
-    """Shows image upload search form and handles 
-    working with API requests responses and displaying results"""
+    """Shows image upload search form and handles saving the photo
+    - creates a pending post, songs are found by a background upload job
+    - redirects to the results page, which updates once post is ready"""
 
     form = ImageUploadForm()
 
     if form.validate_on_submit():
         description = form.description.data
 
-        # If filefield filled, grab file and make filename
+        # Stream image into storage, unless same photo was uploaded before
         img_file = request.files['image'] 
-        img_filename = secure_filename(img_file.filename)
-        # Set UUID to make unique filenames
-        img_name = f'{str(uuid.uuid1())}_{img_filename}'
-        # Save image to profile-images directory to send to API
-        img_file.save(os.path.join(app.config['IMAGE_FOLDER'], img_name))
-
-        # send photo to AI-image API to get keywords
-        keywords = get_keywords(f'static/post-images/{img_name}')
-        
-        # if API succeeds in sending keywords
-        if (keywords):
-            # send keywords to Spotify API to get song data as a list
-            song_data_list = get_list_of_tracks(keywords)
-
-            # Create Post instance
-            new_post = Post(image=img_name, description=description)
-            # Append post to user
-            g.user.posts.append(new_post)
-
-            # Create or find Song instances in db and append them to new_post
-            for song_obj in song_data_list:
-                # If not found in db, create new song instance
-                found_song = Song.song_in_db(song_obj)
-                if (found_song is None):
-                    found_song = Song.create_song(song_obj)
-                # Else append to post
-                new_post.songs.append(found_song)
-            
-            try:
-                db.session.commit()
-                return redirect(url_for('music_results', post_id=new_post.id))
-
-            except Exception as e:
-                db.session.rollback()
+        try:
+            image = save_post_image(img_file, current_storage(),
+                                    app.config['MAX_UPLOAD_BYTES'])
+        except UploadTooLarge:
+            form.image.errors.append(upload_too_large_message())
+            return render_template('form.html',
+                                   title = 'What songs will you get?',
+                                   form=form,
+                                   button='Get Results')
+        # Start making sized copies while the upload job finds songs
+        thumbnails.submit_variants(current_storage(), image.filename,
+                                   thumbnails.POST_WIDTHS)
+
+        # Create pending Post instance and queue job to find its songs
+        new_post = Post(image=image.filename, description=description,
+                        status='pending', user_id=g.user.id)
+        db.session.add(new_post)
+        User.adjust_post_count(g.user.id, 1)
+        enqueue_upload(new_post, image)
 
-        # API fails to send keywords show error 500 page
-        else:
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
             abort(500)
 
+        wake_upload_workers()
+        return redirect(url_for('music_results', post_id=new_post.id))
 
     return render_template('form.html', 
                            title = 'What songs will you get?',
@@ -439,13 +690,24 @@ def search_music():
                            button='Get Results')
 
 @app.route('/posts/<int:post_id>')
+@read_only
 @check_g_user
 def music_results(post_id):
     """Displays post results of image-music search form"""
 
-    post = Post.query.get_or_404(post_id)
+    post = Post.with_details().get_or_404(post_id)
     return render_template('posts/results.html', post=post)
 
+@app.route('/posts/<int:post_id>/status')
+@read_only
+@check_g_user
+def post_status(post_id):
+    """Shows whether post's songs are ready
+    - polled by JS on the results page of a pending post"""
+
+    post = Post.query.get_or_404(post_id)
+    return jsonify(status=post.status)
+
 @app.route('/posts/<int:post_id>/delete', methods=['DELETE'])
 @check_g_user
 def delete_post(post_id):
@@ -453,7 +715,8 @@ def delete_post(post_id):
     
     post = Post.query.get_or_404(post_id)
     if (g.user.id == post.user_id):
-        db.session.delete(post)
+        post.delete()
+        fragments.forget_post(post.id)
 
         try:
             # if deletion goes through, sends "Deleted" message to handle in JS
@@ -464,6 +727,215 @@ def delete_post(post_id):
             return jsonify(message="Failed")
 
 
+###############################################################
+# JSON API (v1) - compact pages with next_cursor and has_more
+
+def api_login_required(func):
+    """Decorator for API routes, responds 401 unless a user is logged in"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not g.user:
+            return api.json_response({'error': 'Login required'}, 401)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def api_cursor(decode, default=None):
+    """Returns ?cursor= of API request decoded with decode (default if
+    absent), responds 400 if cursor is invalid"""
+
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return default
+    try:
+        return decode(cursor)
+    except ValueError:
+        abort(api.json_response({'error': 'Invalid cursor'}, 400))
+
+
+def api_user_or_404(user_id):
+    """Responds 404 unless user with user_id exists"""
+
+    if db.session.query(User.id).filter_by(id=user_id).scalar() is None:
+        abort(api.json_response({'error': 'User not found'}, 404))
+
+
+@app.route('/api/v1/feed')
+@read_only
+@api_login_required
+def api_feed():
+    """Page of the feed, newest posts first"""
+
+    after = api_cursor(decode_post_cursor)
+    return api.json_response(api.feed_payload(after, bookmarked_song_ids))
+
+
+@app.route('/api/v1/search/songs')
+@read_only
+@api_login_required
+def api_search_songs():
+    """Page of songs matching ?q=, best matches first"""
+
+    page = api_cursor(decode_int_cursor, default=0)
+    return api.json_response(api.song_search_payload(request.args.get('q'), page,
+                                                     bookmarked_song_ids))
+
+
+@app.route('/api/v1/search/users')
+@read_only
+@api_login_required
+def api_search_users():
+    """Page of users matching ?q="""
+
+    page = api_cursor(decode_int_cursor, default=0)
+    return api.json_response(api.user_search_payload(request.args.get('q'), page))
+
+
+@app.route('/api/v1/users/<int:user_id>/posts')
+@read_only
+@api_login_required
+def api_user_posts(user_id):
+    """Page of user's posts, newest first"""
+
+    api_user_or_404(user_id)
+    after = api_cursor(decode_post_cursor)
+    return api.json_response(api.user_posts_payload(user_id, after, bookmarked_song_ids))
+
+
+@app.route('/api/v1/users/<int:user_id>/bookmarked')
+@read_only
+@api_login_required
+def api_user_bookmarks(user_id):
+    """Page of user's bookmarked songs by artists, as on their profile"""
+
+    api_user_or_404(user_id)
+    after = api_cursor(decode_int_cursor)
+    return api.json_response(api.bookmarks_payload(user_id, after, bookmarked_song_ids))
+
+
+###############################################################
+# Background upload jobs
+
+@app.cli.command('upload-worker')
+def upload_worker_command():
+    """Processes upload jobs in the foreground until stopped"""
+
+    if app.config['THUMBNAIL_PROCESSES']:
+        thumbnails.start_thumbnail_pool(app.config['THUMBNAIL_PROCESSES'])
+    while True:
+        found_job = run_next_job()
+        # start each job with a fresh session
+        db.session.remove()
+        if not found_job:
+            time.sleep(2)
+
+
+@app.cli.command('repair-counters')
+def repair_counters_command():
+    """Recomputes post and bookmark counters of songs and users"""
+
+    fixed = recount_counters()
+    db.session.commit()
+    click.echo(f"Fixed counters of {fixed['songs']} songs and {fixed['users']} users")
+
+
+def stored_image_keys():
+    """Returns storage keys of post and profile images saved in the db,
+    by folder"""
+
+    return {'post-images': sorted({image_key('post-images', image)
+                                   for image, in db.session.query(Post.image).distinct()}),
+            'profile-images': sorted({image_key('profile-images', image)
+                                      for image, in db.session.query(User.profile_image).distinct()})}
+
+
+@app.cli.command('thumbnails-backfill')
+def thumbnails_backfill_command():
+    """Makes sized copies of post and profile images that don't have them yet"""
+
+    if app.config['THUMBNAIL_PROCESSES']:
+        thumbnails.start_thumbnail_pool(app.config['THUMBNAIL_PROCESSES'])
+    storage = current_storage()
+    futures = {}
+    missing = 0
+    for folder, keys in stored_image_keys().items():
+        for key in keys:
+            if not storage.exists(key):
+                missing += 1
+                continue
+            futures[key] = thumbnails.submit_variants(storage, key, IMAGE_WIDTHS[folder])
+
+    made = failed = 0
+    for key, future in futures.items():
+        try:
+            made += bool(future.result())
+        except Exception as err:
+            failed += 1
+            click.echo(f'Could not make copies of {key}: {err}')
+    click.echo(f'Made sized copies of {made} images ({failed} failed, '
+               f'{len(futures) - made - failed} already done, {missing} missing)')
+
+
+@app.cli.command('storage-import')
+def storage_import_command():
+    """Copies post and profile images (and their sized copies) from the
+    static folder into the configured storage"""
+
+    storage = current_storage()
+    static_storage = LocalStorage(app.static_folder)
+    copied = 0
+    for keys in stored_image_keys().values():
+        for key in keys:
+            widths = thumbnails.variant_widths(static_storage, key) or ()
+            variant_keys = [thumbnails.variant_key(key, width, ext)
+                            for width in widths
+                            for ext, fmt in thumbnails.FORMATS]
+            # list of widths last, once the copies are there
+            for file_key in [key, *variant_keys, thumbnails.widths_key(key)]:
+                path = os.path.join(app.static_folder, *file_key.split('/'))
+                if os.path.isfile(path):
+                    copied += import_file(storage, file_key, path)
+    click.echo(f'Copied {copied} files into {storage!r}')
+
+
+###############################################################
+# Schema migrations
+
+@app.cli.command('db-migrate')
+@click.option('--target', help='Stop after this migration version (e.g. 0002)')
+def db_migrate_command(target):
+    """Applies pending schema migrations from migrations/"""
+
+    applied = migrate(db.engine, target)
+    for migration in applied:
+        click.echo(f'Applied {migration.version}_{migration.name}: {migration.description}')
+    if not applied:
+        click.echo('Database is up to date')
+
+
+@app.cli.command('db-status')
+def db_status_command():
+    """Lists schema migrations and whether each has been applied"""
+
+    for migration, applied in migration_status(db.engine):
+        click.echo(f"[{'x' if applied else ' '}] {migration.version}_{migration.name}: "
+                   f"{migration.description}")
+
+
+###############################################################
+# Metrics
+
+@app.route('/metrics')
+def show_metrics():
+    """Shows in-process counters, timings and component stats as JSON,
+    if METRICS_ENABLED is set"""
+
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return jsonify(metrics.snapshot())
+
+
 ###############################################################
 # Error Pages
         
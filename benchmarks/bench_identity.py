@@ -0,0 +1,76 @@
+"""Benchmark: per-request cost of loading the logged-in user into g.user
+
+Compares loading the full User row (what add_user_to_g used to do) with
+the slim identity, both uncached and from the identity cache. Every run
+starts with an empty session, like a new request.
+
+    python benchmarks/bench_identity.py --database-url postgresql:///melomap-bench
+
+Creates the tables if missing and adds one user, never point this at real data.
+"""
+
+import os, sys
+import argparse
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def time_loader(db, load, user_id, runs, before_run=None):
+    """Returns (mean ms, SQL statements per run) of load(user_id)"""
+
+    from sqlalchemy import event
+
+    statements = []
+    def count_statement(*args):
+        statements.append(args[2])
+
+    elapsed = 0
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        for _ in range(runs):
+            db.session.remove()
+            if before_run:
+                before_run()
+            start = time.perf_counter()
+            load(user_id)
+            elapsed += time.perf_counter() - start
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    return elapsed / runs * 1000, len(statements) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--runs', type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['UPLOAD_WORKER_THREADS'] = '0'
+    from app import app
+    from models.models import db, User
+    from views.identity import load_identity, identity_cache
+
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username='identitybench').first()
+        if user is None:
+            user = User(email='identitybench@email.com', username='identitybench',
+                        password='x', bio='bio ' * 500)
+            db.session.add(user)
+            db.session.commit()
+        user_id = user.id
+
+        loaders = [
+            ('full User row', User.query.get, None),
+            ('slim identity, uncached', load_identity, identity_cache.clear),
+            ('slim identity, cached', load_identity, None),
+        ]
+        for name, load, before_run in loaders:
+            mean_ms, statements = time_loader(db, load, user_id, args.runs, before_run)
+            print(f'{name:<26} {mean_ms:8.3f} ms  {statements:.0f} queries')
+
+
+if __name__ == '__main__':
+    main()
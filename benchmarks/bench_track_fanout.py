@@ -0,0 +1,62 @@
+"""Benchmark: sequential vs concurrent Spotify searches for one upload
+
+Runs get_list_of_tracks against the local fake Spotify API with injected
+latency, so wall-clock time reflects network latency only.
+
+    python benchmarks/bench_track_fanout.py --latency fixed:250 --keywords 5
+"""
+
+import os, sys
+import argparse
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from views import api_funcs
+from views.fake_apis import FakeApiConfig, FakeApiServer, KEYWORD_VOCABULARY
+from views.spotify_token import SpotifyTokenManager
+
+
+def time_run(keywords, max_workers, repeat):
+    """Returns best wall-clock time in seconds over repeat runs"""
+
+    best = None
+    for _ in range(repeat):
+        # measure the network path, not cached search results
+        api_funcs.search_cache.clear()
+        start = time.perf_counter()
+        api_funcs.get_list_of_tracks(keywords, max_workers=max_workers)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', default='fixed:250',
+                        help='latency spec for fake search endpoint (see views/fake_apis.py)')
+    parser.add_argument('--keywords', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=api_funcs.SPOTIFY_MAX_WORKERS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    config = FakeApiConfig(endpoint_latency={'search': args.latency}, seed=0)
+    with FakeApiServer(config) as server:
+        # Point search at fake server, token is fetched once up front
+        api_funcs.SPOTIFY_SEARCH_BASE_URL = f'{server.url}/v1/search'
+        api_funcs.SPOTIFY_TOKEN_URL = f'{server.url}/api/token'
+        api_funcs.spotify_tokens = SpotifyTokenManager(api_funcs.request_spotify_token)
+        api_funcs.get_spotify_token()
+
+        keywords = KEYWORD_VOCABULARY[:args.keywords]
+        sequential = time_run(keywords, 1, args.repeat)
+        concurrent = time_run(keywords, args.workers, args.repeat)
+
+    print(f'{args.keywords} keywords, search latency {args.latency}')
+    print(f'sequential:               {sequential * 1000:8.1f} ms')
+    print(f'concurrent ({args.workers} workers):   {concurrent * 1000:8.1f} ms')
+    print(f'speedup:                  {sequential / concurrent:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Query plans for the hot query paths, before and after the index migrations
+
+Builds a scratch database at schema version 0002, seeds it with a large
+random dataset, prints the plans of the feed, profile, song dedupe and
+bookmark queries, then applies the remaining migrations (0003 onwards)
+and prints them again. Postgres plans come from EXPLAIN ANALYZE, SQLite from EXPLAIN QUERY PLAN.
+
+    python benchmarks/explain_hot_queries.py --database-url postgresql:///melomap-explain
+
+The database is dropped and recreated, never point this at real data.
+"""
+
+import os, sys
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import create_engine, text
+
+from models.models import db
+from models.migrations import migrate, schema_migrations
+
+QUERIES = {
+    'feed page': """
+        SELECT * FROM posts WHERE status = 'ready'
+        ORDER BY timestamp DESC, id DESC LIMIT 6""",
+    'feed page after cursor': """
+        SELECT * FROM posts WHERE status = 'ready'
+        AND (timestamp, id) < (:cursor_timestamp, :cursor_id)
+        ORDER BY timestamp DESC, id DESC LIMIT 6""",
+    'feed page at offset 50000': """
+        SELECT * FROM posts WHERE status = 'ready'
+        ORDER BY timestamp DESC, id DESC LIMIT 6 OFFSET 50000""",
+    'profile posts': """
+        SELECT * FROM posts WHERE user_id = :user_id
+        ORDER BY timestamp DESC""",
+    'song dedupe': """
+        SELECT * FROM songs WHERE spotify_track_id IN (:track1, :track2, :track3)""",
+    'post songs': """
+        SELECT songs.* FROM songs JOIN post_songs ON post_songs.song_id = songs.id
+        WHERE post_songs.post_id = :post_id""",
+    'user bookmarks': """
+        SELECT songs.* FROM songs JOIN bookmarked_songs ON bookmarked_songs.song_id = songs.id
+        WHERE bookmarked_songs.user_id = :user_id""",
+}
+
+CHUNK = 5000
+
+
+def insert_rows(conn, table, rows):
+    """Inserts rows into table in chunks"""
+
+    for start in range(0, len(rows), CHUNK):
+        conn.execute(db.metadata.tables[table].insert(), rows[start:start + CHUNK])
+
+
+def seed(engine, users, songs, posts, songs_per_post, bookmarks, rng):
+    """Fills scratch database with random users, songs, posts and bookmarks"""
+
+    now = datetime.now()
+    with engine.begin() as conn:
+        insert_rows(conn, 'users', [{'id': i, 'email': f'user{i}@email.com',
+                                     'username': f'user{i}', 'password': 'x'}
+                                    for i in range(1, users + 1)])
+        insert_rows(conn, 'songs', [{'id': i, 'title': f'Song {i}', 'artists': 'Artist',
+                                     'spotify_track_id': f'track{i}',
+                                     'spotify_url': f'https://open.spotify.com/track/track{i}'}
+                                    for i in range(1, songs + 1)])
+        insert_rows(conn, 'posts', [{'id': i, 'user_id': rng.randint(1, users),
+                                     'image': f'{i}.jpg', 'status': 'ready',
+                                     'timestamp': now - timedelta(minutes=rng.randint(0, 10 ** 6))}
+                                    for i in range(1, posts + 1)])
+        insert_rows(conn, 'post_songs', [{'post_id': post_id, 'song_id': song_id}
+                                         for post_id in range(1, posts + 1)
+                                         for song_id in rng.sample(range(1, songs + 1),
+                                                                   songs_per_post)])
+        bookmark_pairs = {(rng.randint(1, users), rng.randint(1, songs))
+                          for _ in range(bookmarks)}
+        insert_rows(conn, 'bookmarked_songs', [{'user_id': user_id, 'song_id': song_id}
+                                               for user_id, song_id in bookmark_pairs])
+
+
+def print_plans(engine, params):
+    """Prints plan of every query in QUERIES"""
+
+    postgres = engine.dialect.name == 'postgresql'
+    with engine.begin() as conn:
+        conn.execute(text('ANALYZE'))
+        for name, sql in QUERIES.items():
+            explain = 'EXPLAIN (ANALYZE, BUFFERS) ' if postgres else 'EXPLAIN QUERY PLAN '
+            rows = conn.execute(text(explain + sql), **params).fetchall()
+
+            start = time.perf_counter()
+            conn.execute(text(sql), **params).fetchall()
+            elapsed = (time.perf_counter() - start) * 1000
+
+            print(f'-- {name} ({elapsed:.2f} ms)')
+            for row in rows:
+                # SQLite rows are (id, parent, notused, detail)
+                print('   ', row[0] if postgres else row[-1])
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', required=True,
+                        help='scratch database, dropped and recreated')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--songs-per-post', type=int, default=5)
+    parser.add_argument('--bookmarks', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    engine = create_engine(args.database_url)
+    db.metadata.drop_all(engine)
+    schema_migrations.drop(engine, checkfirst=True)
+
+    migrate(engine, target='0002')
+    seed(engine, args.users, args.songs, args.posts, args.songs_per_post,
+         args.bookmarks, rng)
+    with engine.begin() as conn:
+        # cursor of the post halfway down the feed
+        cursor_timestamp, cursor_id = conn.execute(text(
+            'SELECT timestamp, id FROM posts ORDER BY timestamp DESC, id DESC '
+            'LIMIT 1 OFFSET :offset'), offset=args.posts // 2).fetchone()
+    params = {'cursor_timestamp': cursor_timestamp, 'cursor_id': cursor_id,
+              'user_id': rng.randint(1, args.users), 'post_id': rng.randint(1, args.posts),
+              'track1': 'track1', 'track2': f'track{args.songs // 2}',
+              'track3': f'track{args.songs}'}
+
+    print(f'== before ({args.posts} posts, {args.songs} songs, {args.users} users)')
+    print_plans(engine, params)
+
+    migrate(engine)
+    print('== after migrations')
+    print_plans(engine, params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Initial schema: users, songs, posts and their bookmark/result tables
+
+Tables are defined here as they were at this version (not imported from
+models), so this migration keeps creating the same schema as models change."""
+
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, MetaData, String, Table, Text
+
+metadata = MetaData()
+
+Table('users', metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('email', String, unique=True, nullable=False),
+      Column('username', String(50), unique=True, nullable=False),
+      Column('password', String, nullable=False),
+      Column('name', String),
+      Column('location', String),
+      Column('bio', Text),
+      Column('profile_image', Text, default='default-profile.png'))
+
+Table('songs', metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('title', String, nullable=False),
+      Column('artists', String, nullable=False),
+      Column('album', String),
+      Column('album_year', String),
+      Column('spotify_track_id', String, nullable=False),
+      Column('spotify_url', Text, nullable=False),
+      Column('audio_url', Text),
+      Column('image_url', Text))
+
+Table('posts', metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False),
+      Column('image', Text, nullable=False),
+      Column('description', Text),
+      Column('timestamp', DateTime, nullable=False, default=datetime.now))
+
+Table('bookmarked_songs', metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False),
+      Column('song_id', Integer, ForeignKey('songs.id', ondelete='cascade'), nullable=False))
+
+Table('post_songs', metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('song_id', Integer, ForeignKey('songs.id', ondelete='cascade'), nullable=False),
+      Column('post_id', Integer, ForeignKey('posts.id', ondelete='cascade'), nullable=False))
+
+
+def upgrade(conn):
+    metadata.create_all(conn, checkfirst=True)
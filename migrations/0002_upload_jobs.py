@@ -0,0 +1,54 @@
+"""Background uploads: posts.status, uploaded_images and upload_jobs
+
+Adds the tables behind queued upload processing and photo dedupe."""
+
+from datetime import datetime
+
+from sqlalchemy import (JSON, Column, DateTime, Float, ForeignKey, Integer, MetaData,
+                        String, Table, Text, inspect, text)
+
+metadata = MetaData()
+
+# referenced by foreign keys below, already created by 0001
+Table('posts', metadata, Column('id', Integer, primary_key=True))
+
+Table('uploaded_images', metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('sha256', String(64), unique=True, nullable=False),
+      Column('phash', String(16)),
+      Column('filename', Text, nullable=False),
+      Column('keywords', JSON),
+      Column('created_at', DateTime, nullable=False, default=datetime.now))
+
+Table('upload_jobs', metadata,
+      Column('id', Integer, primary_key=True, autoincrement=True),
+      Column('post_id', Integer, ForeignKey('posts.id', ondelete='cascade'), nullable=False),
+      Column('image_id', Integer, ForeignKey('uploaded_images.id', ondelete='set null')),
+      Column('status', String(20), nullable=False, default='queued'),
+      Column('attempts', Integer, nullable=False, default=0),
+      Column('last_error', Text),
+      Column('original_bytes', Integer),
+      Column('keyword_bytes', Integer),
+      Column('preprocess_ms', Float),
+      Column('run_after', DateTime, nullable=False, default=datetime.now),
+      Column('locked_at', DateTime),
+      Column('created_at', DateTime, nullable=False, default=datetime.now))
+
+
+def upgrade(conn):
+    post_columns = {column['name'] for column in inspect(conn).get_columns('posts')}
+    if 'status' not in post_columns:
+        # existing posts already have their songs
+        conn.execute(text("ALTER TABLE posts ADD COLUMN status VARCHAR(20) "
+                          "NOT NULL DEFAULT 'ready'"))
+
+    metadata.tables['uploaded_images'].create(conn, checkfirst=True)
+    metadata.tables['upload_jobs'].create(conn, checkfirst=True)
+
+    # one index per band of the perceptual hash (models.PHASH_BANDS), they
+    # narrow UploadedImage.find_similar's candidates before it ranks them
+    # by distance
+    bands = ((0, 3), (3, 3), (6, 2), (8, 2), (10, 2), (12, 2), (14, 2))
+    for band, (start, length) in enumerate(bands):
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_uploaded_images_phash_band{band} '
+                          f'ON uploaded_images (substr(phash, {start + 1}, {length}))'))
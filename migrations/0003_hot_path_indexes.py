@@ -0,0 +1,43 @@
+"""Indexes for feed, profile, song dedupe and bookmark queries
+
+Also makes songs.spotify_track_id and (user_id, song_id) bookmarks unique,
+merging duplicate rows left from before the constraints existed."""
+
+from sqlalchemy import text
+
+INDEXES = [
+    # feed (newest first) and profile posts
+    'CREATE INDEX IF NOT EXISTS ix_posts_timestamp ON posts (timestamp)',
+    'CREATE INDEX IF NOT EXISTS ix_posts_user_id_timestamp ON posts (user_id, timestamp)',
+    # a post's songs, and the posts a song appears in
+    'CREATE INDEX IF NOT EXISTS ix_post_songs_post_id ON post_songs (post_id)',
+    'CREATE INDEX IF NOT EXISTS ix_post_songs_song_id ON post_songs (song_id)',
+    # song lookup when saving a post's tracks
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_songs_spotify_track_id ON songs (spotify_track_id)',
+    # a user's bookmarks (leading user_id), and cascades from songs
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_bookmarked_songs_user_id_song_id '
+    'ON bookmarked_songs (user_id, song_id)',
+    'CREATE INDEX IF NOT EXISTS ix_bookmarked_songs_song_id ON bookmarked_songs (song_id)',
+]
+
+
+def upgrade(conn):
+    # point results and bookmarks at the first copy of each duplicated track,
+    # then drop the other copies
+    for table in ['post_songs', 'bookmarked_songs']:
+        conn.execute(text(f"""
+            UPDATE {table} SET song_id = (
+                SELECT MIN(keep.id) FROM songs keep
+                JOIN songs dup ON dup.spotify_track_id = keep.spotify_track_id
+                WHERE dup.id = {table}.song_id)
+            WHERE song_id NOT IN (SELECT MIN(id) FROM songs GROUP BY spotify_track_id)"""))
+    conn.execute(text("""
+        DELETE FROM songs
+        WHERE id NOT IN (SELECT MIN(id) FROM songs GROUP BY spotify_track_id)"""))
+
+    conn.execute(text("""
+        DELETE FROM bookmarked_songs
+        WHERE id NOT IN (SELECT MIN(id) FROM bookmarked_songs GROUP BY user_id, song_id)"""))
+
+    for statement in INDEXES:
+        conn.execute(text(statement))
@@ -0,0 +1,10 @@
+"""Composite (timestamp, id) index for keyset pagination of the feed
+
+Replaces ix_posts_timestamp, which it covers."""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_posts_timestamp_id ON posts (timestamp, id)'))
+    conn.execute(text('DROP INDEX IF EXISTS ix_posts_timestamp'))
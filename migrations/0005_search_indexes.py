@@ -0,0 +1,33 @@
+"""Full-text and trigram indexes for song and user search (Postgres only)
+
+Expressions match views/search.py so the planner can use the indexes.
+The trigram indexes need the pg_trgm extension (creating it takes a role
+allowed to do so); servers without it only get the full-text index, and
+substring search there scans. SQLite has no equivalent, search there
+falls back to LIKE scans."""
+
+from sqlalchemy import text
+
+SONG_TEXT = "coalesce(title, '') || ' ' || coalesce(album, '') || ' ' || coalesce(artists, '')"
+USER_TEXT = "username || ' ' || coalesce(name, '')"
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    # word (prefix) matches and ts_rank
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_songs_search_fts ON songs "
+                      f"USING gin (to_tsvector('simple', {SONG_TEXT}))"))
+
+    trigrams_available = conn.execute(
+        text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar()
+    if trigrams_available is None:
+        return
+
+    conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    # substring matches (LIKE '%q%') and similarity
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_songs_search_trgm ON songs "
+                      f"USING gin (lower({SONG_TEXT}) gin_trgm_ops)"))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_users_search_trgm ON users "
+                      f"USING gin (lower({USER_TEXT}) gin_trgm_ops)"))
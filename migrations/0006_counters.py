@@ -0,0 +1,31 @@
+"""Post and bookmark counters on songs and users
+
+Adds songs.post_count, songs.bookmark_count and users.post_count, filled
+from existing rows, with indexes for the popular songs and top users pages."""
+
+from sqlalchemy import inspect, text
+
+COUNTERS = {
+    'songs': ['post_count', 'bookmark_count'],
+    'users': ['post_count'],
+}
+
+
+def upgrade(conn):
+    for table, counters in COUNTERS.items():
+        columns = {column['name'] for column in inspect(conn).get_columns(table)}
+        for counter in counters:
+            if counter not in columns:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {counter} '
+                                  'INTEGER NOT NULL DEFAULT 0'))
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_{counter}_id '
+                              f'ON {table} ({counter}, id)'))
+
+    conn.execute(text(
+        'UPDATE songs SET '
+        'post_count = (SELECT count(*) FROM post_songs WHERE post_songs.song_id = songs.id), '
+        'bookmark_count = (SELECT count(*) FROM bookmarked_songs '
+        'WHERE bookmarked_songs.song_id = songs.id)'))
+    conn.execute(text(
+        'UPDATE users SET '
+        'post_count = (SELECT count(*) FROM posts WHERE posts.user_id = users.id)'))
@@ -0,0 +1,87 @@
+"""Versioned schema migrations for Melomap
+
+Migrations live in the top-level migrations/ folder as numbered modules
+(0001_initial.py, 0002_...), each with a docstring and an upgrade(conn)
+function. Applied versions are recorded in the schema_migrations table, so
+`flask db-migrate` only runs migrations a database hasn't had yet. Every
+migration checks for what it creates, so it is also safe to run against a
+database that was set up with db.create_all()."""
+
+import importlib.util
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, select, text
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'migrations')
+
+# Kept apart from db.metadata so db.drop_all() doesn't forget applied migrations
+schema_migrations = Table('schema_migrations', MetaData(),
+                          Column('version', String(16), primary_key=True),
+                          Column('name', String, nullable=False),
+                          Column('applied_at', DateTime, nullable=False))
+
+Migration = namedtuple('Migration', ['version', 'name', 'description', 'upgrade'])
+
+# Postgres advisory lock id, so two deploys can't migrate at the same time
+MIGRATION_LOCK_ID = 4127
+
+
+def load_migrations():
+    """Returns all migrations in MIGRATIONS_DIR ordered by version"""
+
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r'(\d{4})_(\w+)\.py$', filename)
+        if not match:
+            continue
+        version, name = match.groups()
+        spec = importlib.util.spec_from_file_location(f'migration_{version}',
+                                                      os.path.join(MIGRATIONS_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        migrations.append(Migration(version, name,
+                                    (module.__doc__ or '').strip().splitlines()[0],
+                                    module.upgrade))
+    return migrations
+
+
+def applied_versions(conn):
+    """Returns versions already applied to the database conn points at"""
+
+    schema_migrations.create(conn, checkfirst=True)
+    return {row.version for row in conn.execute(select([schema_migrations.c.version]))}
+
+
+def migrate(engine, target=None):
+    """Applies pending migrations up to target version (default all),
+    each in its own transaction. Returns the migrations applied."""
+
+    applied = []
+    for migration in load_migrations():
+        if target and migration.version > target:
+            break
+
+        with engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text('SELECT pg_advisory_xact_lock(:id)'), id=MIGRATION_LOCK_ID)
+            if migration.version in applied_versions(conn):
+                continue
+
+            migration.upgrade(conn)
+            conn.execute(schema_migrations.insert().values(version=migration.version,
+                                                           name=migration.name,
+                                                           applied_at=datetime.now()))
+        applied.append(migration)
+    return applied
+
+
+def migration_status(engine):
+    """Returns list of (migration, applied) for every migration"""
+
+    with engine.begin() as conn:
+        applied = applied_versions(conn)
+    return [(migration, migration.version in applied) for migration in load_migrations()]
@@ -1,11 +1,16 @@
 """SQLAlchemy models for Capstone Project 1"""
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from collections import defaultdict
 from datetime import datetime
+from sqlalchemy import Text, cast, func, literal, or_, select, tuple_
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.dialects import postgresql
+
+from models.routing import RoutingSQLAlchemy
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 def connect_db(app):
     """Connect database to Flask app."""
@@ -18,6 +23,10 @@ class User(db.Model):
     """Model for user of the app"""
 
     __tablename__ = 'users'
+    __table_args__ = (
+        # top users, most posts first
+        db.Index('ix_users_post_count_id', 'post_count', 'id'),
+    )
 
     id = db.Column(db.Integer, 
                    primary_key=True,
@@ -43,6 +52,11 @@ class User(db.Model):
     profile_image = db.Column(db.Text, 
                               default = "default-profile.png")
 
+    # maintained with posts, see recount_counters() for repairs
+    post_count = db.Column(db.Integer,
+                           nullable=False,
+                           default=0)
+
     # M:M relationship to map user bookmarks to songs
     bookmarked_songs = db.relationship('Song',
                                        secondary='bookmarked_songs')
@@ -91,6 +105,44 @@ class User(db.Model):
             # Returns False if username not found
             return False
 
+    def bookmarked_song_ids(self):
+        """Returns set of IDs of songs user has bookmarked,
+        selecting only the IDs instead of loading the songs"""
+
+        return BookmarkedSongs.song_ids_for(self.id)
+
+    @classmethod
+    def adjust_post_count(cls, user_id, change):
+        """Adds change to post_count of user with user_id. Doesn't commit."""
+
+        table = cls.__table__
+        db.session.execute(table.update()
+                           .where(table.c.id == user_id)
+                           .values(post_count=table.c.post_count + change))
+
+    @classmethod
+    def most_posts(cls, limit=50):
+        """Returns users with the most posts, read from post_count"""
+
+        return (cls.query
+                .filter(cls.post_count > 0)
+                .order_by(cls.post_count.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
+    def delete(self):
+        """Deletes user, taking their posts and bookmarks off song counters.
+        Doesn't commit."""
+
+        post_counts = (db.session.query(PostSongs.song_id, func.count())
+                       .join(Post, Post.id == PostSongs.post_id)
+                       .filter(Post.user_id == self.id)
+                       .group_by(PostSongs.song_id))
+        Song.adjust_counts('post_count', {song_id: -count for song_id, count in post_counts})
+        Song.adjust_counts('bookmark_count',
+                           {song_id: -1 for song_id in self.bookmarked_song_ids()})
+        db.session.delete(self)
+
     @classmethod
     def hash_pw(cls, password):
         """Hashes password"""
@@ -102,6 +154,10 @@ class BookmarkedSongs(db.Model):
     """Mapping user to bookmarked songs"""
 
     __tablename__ = 'bookmarked_songs'
+    __table_args__ = (
+        # a song can be bookmarked once per user, also serves user's bookmarks
+        db.Index('uq_bookmarked_songs_user_id_song_id', 'user_id', 'song_id', unique=True),
+    )
 
     id = db.Column(db.Integer, 
                    primary_key=True,
@@ -113,13 +169,53 @@ class BookmarkedSongs(db.Model):
 
     song_id = db.Column(db.Integer, 
                         db.ForeignKey('songs.id', ondelete='cascade'),
-                        nullable=False)
+                        nullable=False,
+                        index=True)
+
+    @classmethod
+    def song_ids_for(cls, user_id):
+        """Returns set of IDs of songs bookmarked by user with user_id"""
+
+        rows = db.session.query(cls.song_id).filter(cls.user_id == user_id)
+        return {song_id for song_id, in rows}
+
+    @classmethod
+    def toggle(cls, user_id, song_id):
+        """Bookmarks song for user, or removes bookmark if it exists.
+        Returns True if song is now bookmarked.
+
+        Deletes by (user_id, song_id), otherwise inserts a row that skips
+        a bookmark added meanwhile, both using the unique index, so the
+        cost doesn't grow with the number of bookmarks. Doesn't commit."""
+
+        table = cls.__table__
+        deleted = db.session.execute(
+            table.delete().where((table.c.user_id == user_id) &
+                                 (table.c.song_id == song_id)))
+        if deleted.rowcount:
+            Song.adjust_counts('bookmark_count', {song_id: -1})
+            return False
+
+        if db.session.bind.dialect.name == 'postgresql':
+            stmt = (postgresql.insert(table)
+                    .on_conflict_do_nothing(index_elements=['user_id', 'song_id']))
+        else:
+            stmt = table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+        inserted = db.session.execute(stmt.values(user_id=user_id, song_id=song_id))
+        if inserted.rowcount:
+            Song.adjust_counts('bookmark_count', {song_id: 1})
+        return True
 
 
 class Song(db.Model):
     """Model for individual songs in database"""
 
     __tablename__ = 'songs'
+    __table_args__ = (
+        # popular songs, highest count first
+        db.Index('ix_songs_post_count_id', 'post_count', 'id'),
+        db.Index('ix_songs_bookmark_count_id', 'bookmark_count', 'id'),
+    )
 
     id = db.Column(db.Integer,
                    primary_key=True,
@@ -135,7 +231,10 @@ class Song(db.Model):
 
     album_year = db.Column(db.String)
 
+    # unique so concurrent uploads of the same track can't add it twice
     spotify_track_id = db.Column(db.String, 
+                                 unique=True,
+                                 index=True,
                                  nullable=False)
 
     spotify_url = db.Column(db.Text,
@@ -145,6 +244,15 @@ class Song(db.Model):
 
     image_url = db.Column(db.Text)
 
+    # maintained with posts and bookmarks, see recount_counters() for repairs
+    post_count = db.Column(db.Integer,
+                           nullable=False,
+                           default=0)
+
+    bookmark_count = db.Column(db.Integer,
+                               nullable=False,
+                               default=0)
+
     # bidirectional M:M relationship to associate song with posts
     posts = db.relationship('Post',
                             secondary='post_songs',
@@ -180,6 +288,81 @@ class Song(db.Model):
         db.session.commit()
         return song_to_add
 
+    @classmethod
+    def resolve_songs(cls, songs):
+        """Returns Song instances for a list of song objects, in the same order
+        (duplicate tracks once), inserting songs not in db yet.
+
+        Looks up all tracks with one SELECT and adds missing ones with one
+        multi-row INSERT that skips tracks added meanwhile by another upload.
+        Doesn't commit, so songs are saved in the caller's transaction."""
+
+        song_objs = {}
+        for song in songs:
+            song_objs.setdefault(song['spotify_track_id'], song)
+        if not song_objs:
+            return []
+
+        found = cls.query.filter(cls.spotify_track_id.in_(song_objs)).all()
+        found_songs = {song.spotify_track_id: song for song in found}
+
+        missing = [track_id for track_id in song_objs if track_id not in found_songs]
+        if missing:
+            columns = ['title', 'album', 'album_year', 'artists', 'spotify_track_id',
+                       'spotify_url', 'image_url', 'audio_url']
+            rows = [{column: song_objs[track_id].get(column) for column in columns}
+                    for track_id in missing]
+
+            if db.session.bind.dialect.name == 'postgresql':
+                stmt = (postgresql.insert(cls.__table__)
+                        .on_conflict_do_nothing(index_elements=['spotify_track_id']))
+            else:
+                stmt = cls.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite')
+            db.session.execute(stmt.values(rows))
+
+            # includes rows another upload inserted first
+            added = cls.query.filter(cls.spotify_track_id.in_(missing)).all()
+            found_songs.update((song.spotify_track_id, song) for song in added)
+
+        return [found_songs[track_id] for track_id in song_objs]
+
+    @classmethod
+    def adjust_counts(cls, column, changes):
+        """Adds changes ({song_id: change}) to counter column, 'post_count'
+        or 'bookmark_count', with one UPDATE per distinct change.
+        Doesn't commit."""
+
+        song_ids_by_change = defaultdict(list)
+        for song_id, change in changes.items():
+            if change:
+                song_ids_by_change[change].append(song_id)
+
+        table = cls.__table__
+        for change, song_ids in song_ids_by_change.items():
+            db.session.execute(table.update()
+                               .where(table.c.id.in_(song_ids))
+                               .values({column: table.c[column] + change}))
+
+    @classmethod
+    def most_bookmarked(cls, limit=50):
+        """Returns most bookmarked songs, read from bookmark_count"""
+
+        return (cls.query
+                .filter(cls.bookmark_count > 0)
+                .order_by(cls.bookmark_count.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def most_posted(cls, limit=50):
+        """Returns songs featured in the most posts, read from post_count"""
+
+        return (cls.query
+                .filter(cls.post_count > 0)
+                .order_by(cls.post_count.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
 
 class PostSongs(db.Model):
     """Model for connection between post and songs results"""
@@ -192,17 +375,25 @@ class PostSongs(db.Model):
       
     song_id = db.Column(db.Integer,
                         db.ForeignKey('songs.id', ondelete='cascade'),
-                        nullable=False)
+                        nullable=False,
+                        index=True)
     
     post_id = db.Column(db.Integer, 
                         db.ForeignKey('posts.id', ondelete='cascade'),
-                        nullable=False)
+                        nullable=False,
+                        index=True)
 
 
 class Post(db.Model):
     """Model for individual post"""
 
     __tablename__ = 'posts'
+    __table_args__ = (
+        # feed pages, newest first with id breaking timestamp ties
+        db.Index('ix_posts_timestamp_id', 'timestamp', 'id'),
+        # user's posts, newest first (profile page)
+        db.Index('ix_posts_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     id = db.Column(db.Integer,
                    primary_key=True,
@@ -220,6 +411,11 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime,
                            nullable=False,
                            default=datetime.now)
+
+    # 'pending' while an upload job finds its songs, then 'ready' or 'failed'
+    status = db.Column(db.String(20),
+                       nullable=False,
+                       default='ready')
     
     # bidirectional 1:M relationship between post <-> user
     user = db.relationship('User',
@@ -229,4 +425,226 @@ class Post(db.Model):
     songs = db.relationship('Song',
                             secondary='post_songs',
                             back_populates='posts')
-    
+
+    @classmethod
+    def with_details(cls):
+        """Query for posts that loads each post's user (joined) and songs
+        (one IN query for all posts), so displaying any number of posts
+        takes the same number of queries"""
+
+        return cls.query.options(joinedload(cls.user), selectinload(cls.songs))
+
+    @classmethod
+    def feed(cls, query=None):
+        """Query for ready posts, newest first, with their users and songs
+        - query: base query to use instead, e.g. selecting only some columns"""
+
+        if query is None:
+            query = cls.with_details()
+        return (query.filter(cls.status == 'ready')
+                .order_by(cls.timestamp.desc(), cls.id.desc()))
+
+    @classmethod
+    def feed_page(cls, after=None, per_page=5, query=None):
+        """Returns (posts, has_more) for a page of the feed
+        - after: (timestamp, id) of last post on previous page
+        - query: base query, as for feed()"""
+
+        return cls.page_after(cls.feed(query), after, per_page)
+
+    @classmethod
+    def page_after(cls, query, after=None, per_page=5):
+        """Returns (rows, has_more) for a page of query, which must order
+        posts newest first by (timestamp, id)
+        - after: (timestamp, id) of last post on previous page, pages seek
+          past it on the (timestamp, id) index instead of skipping rows,
+          so every page costs the same and new posts don't shift pages"""
+
+        if after is not None:
+            query = query.filter(tuple_(cls.timestamp, cls.id) < tuple_(*after))
+
+        posts = query.limit(per_page + 1).all()
+        return posts[:per_page], len(posts) > per_page
+
+    def delete(self):
+        """Deletes post, taking it off its user's and songs' post counters.
+        Doesn't commit."""
+
+        song_ids = (db.session.query(PostSongs.song_id)
+                    .filter(PostSongs.post_id == self.id))
+        Song.adjust_counts('post_count', {song_id: -1 for song_id, in song_ids})
+        User.adjust_post_count(self.user_id, -1)
+        db.session.delete(self)
+
+
+# (start, length) in hex digits of the 64-bit perceptual hash's seven
+# bands; hashes up to 6 bits apart leave at least one band unchanged
+PHASH_BANDS = ((0, 3), (3, 3), (6, 2), (8, 2), (10, 2), (12, 2), (14, 2))
+
+
+class UploadedImage(db.Model):
+    """Model for a stored post image, identified by its content hash
+    so the same photo is stored and keyworded only once"""
+
+    __tablename__ = 'uploaded_images'
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+
+    # hex SHA-256 of the file bytes, unique index makes lookup constant-time
+    sha256 = db.Column(db.String(64),
+                       unique=True,
+                       nullable=False)
+
+    # hex 64-bit difference hash, close for resized/re-encoded copies
+    phash = db.Column(db.String(16))
+
+    filename = db.Column(db.Text,
+                         nullable=False)
+
+    # keywords from AI image API, reused by later uploads of the same photo
+    keywords = db.Column(db.JSON)
+
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.now)
+
+    @classmethod
+    def find_similar(cls, phash, max_distance=6):
+        """Returns the image with keywords whose perceptual hash is closest
+        to phash, if within max_distance bits, or None.
+
+        Differing bits can touch at most max_distance of the seven bands,
+        so hashes that close share at least one band and candidates are
+        found through the band indexes, not a table scan. max_distance
+        must stay below len(PHASH_BANDS). Postgres ranks the candidates
+        by distance itself and returns only the closest."""
+
+        bands = [func.substr(cls.phash, start + 1, length) == phash[start:start + length]
+                 for start, length in PHASH_BANDS]
+        candidates = cls.query.filter(or_(*bands), cls.keywords.isnot(None))
+
+        if db.session.bind.dialect.name == 'postgresql':
+            distance = phash_distance(cls.phash, phash)
+            return (candidates
+                    .filter(distance <= max_distance)
+                    .order_by(distance, cls.id)
+                    .first())
+
+        # compare every candidate's hash, only loading the closest image
+        ranked = sorted((hash_distance(candidate_hash, phash), image_id)
+                        for image_id, candidate_hash in candidates.with_entities(cls.id, cls.phash))
+        if ranked and ranked[0][0] <= max_distance:
+            return cls.query.get(ranked[0][1])
+        return None
+
+
+# one index per band of the perceptual hash for near-duplicate lookup
+for band, (band_start, band_length) in enumerate(PHASH_BANDS):
+    db.Index(f'ix_uploaded_images_phash_band{band}',
+             func.substr(UploadedImage.phash, band_start + 1, band_length))
+
+
+def recount_counters():
+    """Recomputes post and bookmark counters of songs and users from
+    post_songs, bookmarked_songs and posts, fixing any that drifted.
+    Returns number of songs and users fixed. Doesn't commit."""
+
+    songs, users = Song.__table__, User.__table__
+    post_songs, bookmarks, posts = (PostSongs.__table__, BookmarkedSongs.__table__,
+                                    Post.__table__)
+
+    song_posts = (select([func.count()])
+                  .where(post_songs.c.song_id == songs.c.id)
+                  .as_scalar())
+    song_bookmarks = (select([func.count()])
+                      .where(bookmarks.c.song_id == songs.c.id)
+                      .as_scalar())
+    user_posts = (select([func.count()])
+                  .where(posts.c.user_id == users.c.id)
+                  .as_scalar())
+
+    fixed_songs = db.session.execute(
+        songs.update()
+        .where((songs.c.post_count != song_posts) | (songs.c.bookmark_count != song_bookmarks))
+        .values(post_count=song_posts, bookmark_count=song_bookmarks))
+    fixed_users = db.session.execute(
+        users.update()
+        .where(users.c.post_count != user_posts)
+        .values(post_count=user_posts))
+    return {'songs': fixed_songs.rowcount, 'users': fixed_users.rowcount}
+
+
+def hash_distance(hash1, hash2):
+    """Returns number of differing bits between two hex hashes"""
+
+    return bin(int(hash1, 16) ^ int(hash2, 16)).count('1')
+
+
+def phash_distance(column, phash):
+    """Returns Postgres expression counting differing bits between hex
+    hashes in column and phash (hash_distance in SQL)"""
+
+    column_bits = cast(literal('x').concat(column), postgresql.BIT(64))
+    phash_bits = cast(literal('x' + phash), postgresql.BIT(64))
+    differing = cast(column_bits.op('#')(phash_bits), Text)
+    return func.length(func.replace(differing, '0', ''))
+
+
+class UploadJob(db.Model):
+    """Model for background job that finishes an uploaded post
+    (keywording and song search), kept in db so jobs survive restarts"""
+
+    __tablename__ = 'upload_jobs'
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+
+    post_id = db.Column(db.Integer,
+                        db.ForeignKey('posts.id', ondelete='cascade'),
+                        nullable=False)
+
+    image_id = db.Column(db.Integer,
+                         db.ForeignKey('uploaded_images.id', ondelete='set null'))
+
+    # 'queued', 'running', 'done' or 'failed'
+    status = db.Column(db.String(20),
+                       nullable=False,
+                       default='queued')
+
+    attempts = db.Column(db.Integer,
+                         nullable=False,
+                         default=0)
+
+    last_error = db.Column(db.Text)
+
+    # size of uploaded image vs. downscaled copy sent for keywording,
+    # and time spent making that copy
+    original_bytes = db.Column(db.Integer)
+
+    keyword_bytes = db.Column(db.Integer)
+
+    preprocess_ms = db.Column(db.Float)
+
+    # queued jobs wait until this time (used for retry backoff)
+    run_after = db.Column(db.DateTime,
+                          nullable=False,
+                          default=datetime.now)
+
+    # when a worker claimed the job, to recover jobs from crashed workers
+    locked_at = db.Column(db.DateTime)
+
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.now)
+
+    post = db.relationship('Post')
+
+    image = db.relationship('UploadedImage')
+
+    def __repr__(self):
+        """Change representation of upload job object"""
+
+        return f"<UploadJob #{self.id}: post {self.post_id} {self.status}>"
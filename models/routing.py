@@ -0,0 +1,100 @@
+"""Engine pool settings and read-replica routing for the db session
+
+Routes marked read-only (see app.py) set g.db_replica, and their queries
+go to the engine of the 'replica' bind when one is configured. Flushes and
+INSERT/UPDATE/DELETE statements always go to the primary, and once a
+request has written, the rest of its queries do too (g.db_wrote)."""
+
+import os
+import time
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+from views.metrics import metrics
+
+REPLICA_BIND = 'replica'
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waited for a connection
+    as db.<pool name>.checkout_wait_ms"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            name = getattr(self, 'logging_name', None) or 'primary'
+            metrics.observe(f'db.{name}.checkout_wait_ms',
+                            (time.perf_counter() - start) * 1000)
+
+
+def engine_options(url):
+    """Returns SQLALCHEMY_ENGINE_OPTIONS for database url from DB_POOL_*
+    environment variables (SQLite keeps its own pools)"""
+
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        # seconds to wait for a connection before giving up
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        # reconnect connections older than this, before the server drops them
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+    }
+
+
+def pool_stats(engine):
+    """Returns connection counts of engine's pool"""
+
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {'pool': type(pool).__name__}
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+    }
+
+
+class RoutingSession(SignallingSession):
+    """Session sending reads of read-only routes to the replica"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not has_app_context():
+            return super().get_bind(mapper, clause)
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            g.db_wrote = True
+        elif (g.get('db_replica') and not g.get('db_wrote')
+              and REPLICA_BIND in (self.app.config.get('SQLALCHEMY_BINDS') or {})):
+            metrics.incr('db.replica_queries')
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose session is a RoutingSession"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        """Names pools after their bind, so metrics tell primary and replica apart"""
+
+        if engine_opts.get('poolclass') is TimedQueuePool:
+            replica_url = (self.get_app().config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA_BIND)
+            name = REPLICA_BIND if replica_url and make_url(replica_url) == sa_url else 'primary'
+            engine_opts = dict(engine_opts, pool_logging_name=name)
+        return super().create_engine(sa_url, engine_opts)
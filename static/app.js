@@ -1,15 +1,175 @@
 const BASE_URL = "https://melomap.onrender.com/";
 
 
-// axios request to load more posts on homepage
-let offsetPost = 5;
-async function loadmorePosts(){
-    const htmlResp = await axios.get(`${BASE_URL}loadmore/posts`, {params: {offset: offsetPost}})
-    const htmlRespString = htmlResp.data
-    $('#music-content').append(htmlRespString)
-
-    offsetPost+=5;
-    if (htmlRespString === '\n\n\n' || offsetPost === 30){
+// Cards are rendered from /api/v1 pages with the same HTML as the Jinja macros
+const MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+const HTML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}
+
+// id of logged in user, set on <body> by base.html
+const viewerId = $('body').data('userid')
+
+// Escape API text before putting it in HTML
+function escapeHtml(text){
+    return String(text ?? '').replace(/[&<>"']/g, char => HTML_ESCAPES[char])
+}
+
+
+// Format an API timestamp like post_body does ('%I:%M %p - %b %d, %Y')
+function formatTimestamp(timestamp){
+    const [year, month, day, hour, minute] = timestamp.split(/[-T:]/).map(Number)
+    const pad = number => String(number).padStart(2, '0')
+    return `${pad(hour % 12 || 12)}:${pad(minute)} ${hour < 12 ? 'AM' : 'PM'} - ` +
+           `${MONTHS[month - 1]} ${pad(day)}, ${year}`
+}
+
+
+// URL of an image's sized copy, named like variant_key in views/thumbnails.py
+function variantUrl(url, width, ext){
+    const slash = url.lastIndexOf('/')
+    return `${url.slice(0, slash)}/thumbs/${url.slice(slash + 1)}.${width}.${ext}`
+}
+
+
+// Uploaded image with its sized copies in srcset once they exist,
+// like the picture macro in image-macro.html
+function pictureHtml(url, widths, sizes, alt='', imgClass='', imgId=''){
+    const idAttr = imgId ? `id="${imgId}" ` : ''
+    if (!widths){
+        return `<img class="${imgClass}" ${idAttr}src="${escapeHtml(url)}" alt="${escapeHtml(alt)}">`
+    }
+    const srcset = ext => widths.map(width => `${escapeHtml(variantUrl(url, width, ext))} ${width}w`).join(', ')
+    const src = variantUrl(url, widths[Math.floor(widths.length / 2)], 'jpg')
+    return `<picture>
+    <source type="image/webp" srcset="${srcset('webp')}" sizes="${sizes}">
+    <img class="${imgClass}" ${idAttr}src="${escapeHtml(src)}"
+    srcset="${srcset('jpg')}" sizes="${sizes}" alt="${escapeHtml(alt)}">
+</picture>`
+}
+
+
+// Song card, like song_body and bookmark_icon in posts/post-macro.html
+function songHtml(song, borderStyle, bookmarked){
+    const player = song.audio_url ? `
+            <audio class="m-0" id="audio-${song.id}" src="${escapeHtml(song.audio_url)}"></audio>
+            <button class="play-pause">
+                <i class="bi play bi-play-fill"></i>
+            </button>` : ''
+    return `<div id="${song.id}" class="bg-light ${borderStyle} p-2 m-0 row">
+    <div class="col-11 p-0 d-flex align-items-center">
+        <img class="song-img me-2" src="${escapeHtml(song.image_url)}">
+        <div class="audio-player">${player}
+        </div>
+        <div>
+            <a class="title text-dark m-0" href="${escapeHtml(song.spotify_url)}" target="_blank">${escapeHtml(song.title)}</a>
+            <small class="album d-block fst-italic">${escapeHtml(song.album)} (${escapeHtml(song.album_year)})</small>
+            <small class="artist d-block ">${escapeHtml(song.artists)}</small>
+        </div>
+    </div>
+    <div class="col-1 d-flex align-items-center">
+        <i class="bookmark bi ${bookmarked ? 'bi-bookmark-fill' : 'bi-bookmark'}"></i>
+    </div>
+</div>`
+}
+
+
+// Post card, like post_body in posts/post-macro.html
+function postHtml(post, page){
+    const user = page.users[post.user_id]
+    const bookmarked = new Set(page.bookmarked)
+    let status = ''
+    if (post.status === 'pending'){
+        status = `<p id="pending-post" class="text-center my-3" data-postid="${post.id}">
+                <span class="spinner-border spinner-border-sm me-2"></span>Finding songs for this photo...
+            </p>`
+    }
+    else if (post.status === 'failed'){
+        status = "<p class=\"text-center my-3\">Sorry, we couldn't find songs for this photo.</p>"
+    }
+    const songs = post.song_ids.map(songId => songHtml(page.songs[songId], 'border', bookmarked.has(songId)))
+    const trash = post.user_id === viewerId ? `<div class="col-6 text-end">
+    <button type="button" class="trash-post-btn" data-bs-toggle="modal" data-bs-target=".staticPostModal">
+        <i class="bi bi-trash-fill"></i>
+    </button>
+</div>` : ''
+
+    return `<div class="col-lg-9 col-xl-8 col-xxl-7 my-2">
+    <div id = "${post.id}"class="post bg-light p-4 rounded m-3">
+        <div class="d-flex align-items-center mb-2">
+            <a href="/users/${post.user_id}">
+                ${pictureHtml(user.profile_image_url, user.profile_image_widths, '50px',
+                              user.username, 'profile-img', 'nav-img')}
+                ${user.name ? `<span>${escapeHtml(user.name)}</span>` : ''}
+                <small class="text-primary">@${escapeHtml(user.username)}</small>
+            </a>
+        </div>
+        <p class="my-0 mx-5 px-2">${escapeHtml(post.description)}</p>
+        ${pictureHtml(post.image_url, post.image_widths, '(max-width: 768px) 100vw, 720px', '', 'post-img mt-2')}
+            ${status}
+            ${songs.join('')}
+        <hr class="my-4">
+
+        <div class="row">
+            <small class="col-6">${formatTimestamp(post.timestamp)} </small>
+            ${trash}
+        </div>
+    </div>
+</div>`
+}
+
+
+// User card, like display_user_card in user/user-macro.html
+function userCardHtml(user){
+    return `<div class="d-flex align-items-stretch col-sm-6 col-lg-4 col-xl-3 mb-4">
+  <div class="flex-fill card m-1">
+    <div class="card-body d-flex flex-column align-items-center">
+      <a href="/users/${user.id}">
+        ${pictureHtml(user.profile_image_url, user.profile_image_widths, '150px',
+                      user.username, 'profile-img', 'card-img')}
+      </a>
+      <h5 class="card-title mt-2">@${escapeHtml(user.username)}</h5>
+      ${user.name ? `<h6 class="card-subtitle mb-2 text-body-secondary">${escapeHtml(user.name)}</h6>` : ''}
+      <small class="text-body-secondary">${user.post_count} posts</small>
+    </div>
+  </div>
+</div>`
+}
+
+
+// Song cards of a page of search results or bookmarks
+function songCardsHtml(page){
+    const bookmarked = new Set(page.bookmarked)
+    return page.songs.map(song => `<div class="mb-1 col-lg-9 col-xl-8 col-xxl-7">
+        ${songHtml(song, 'border rounded', bookmarked.has(song.id))}
+    </div>`).join('')
+}
+
+
+// Every page of an /api/v1 list, following next_cursor
+async function getAllPages(url){
+    const pages = []
+    let cursor = null
+    do {
+        const resp = await axios.get(url, {params: {cursor: cursor || undefined}})
+        pages.push(resp.data)
+        cursor = resp.data.next_cursor
+    } while (cursor)
+    return pages
+}
+
+
+// axios request to load more posts on homepage, each page comes with
+// the cursor for the next one (none once all posts are loaded)
+async function loadmorePosts(evt){
+    const $button = $(evt.target)
+    const resp = await axios.get(`${BASE_URL}api/v1/feed`, {params: {cursor: $button.data('cursor')}})
+    const page = resp.data
+    $('#music-content').append(page.posts.map(post => postHtml(post, page)).join(''))
+
+    if (page.next_cursor){
+        $button.data('cursor', page.next_cursor)
+    }
+    else{
         const endMsg = "<h5 class='mb-4 text-white'>You're all caught up!</h5>"
         $('#button-container').empty().append(endMsg)
     }
@@ -18,15 +178,17 @@ $('#button-container').on('click','#load-more', loadmorePosts)
 
 
 // axios request to load more song results on search page
-let offsetSong = 20;
-async function loadmoreSongs(){
+async function loadmoreSongs(evt){
+    const $button = $(evt.target)
     const searchQ = $('#search-query').text()
-    const htmlResp = await axios.get(`${BASE_URL}loadmore/songs`, {params:{q: searchQ, offset: offsetSong}})
-    const htmlRespString = htmlResp.data
-    $('#music-content').append(htmlRespString)
-    
-    offsetSong+=20;
-    if (htmlRespString === '\n\n\n'){
+    const resp = await axios.get(`${BASE_URL}api/v1/search/songs`,
+                                 {params: {q: searchQ, cursor: $button.data('cursor')}})
+    $('#music-content').append(songCardsHtml(resp.data))
+
+    if (resp.data.next_cursor){
+        $button.data('cursor', resp.data.next_cursor)
+    }
+    else{
         const endMsg = "<h5 class='mb-4 text-white'>You've seen all the results!</h5>"
         $('#load-button-container').empty().append(endMsg)
     }
@@ -34,15 +196,41 @@ async function loadmoreSongs(){
 $('#load-button-container').on('click','#load-more-songs', loadmoreSongs)
 
 
-// axios request to view bookmarked songs without reload
+// axios request to load more user results on search page
+async function loadmoreUsers(evt){
+    const $button = $(evt.target)
+    const searchQ = $('#search-query').text()
+    const resp = await axios.get(`${BASE_URL}api/v1/search/users`,
+                                 {params: {q: searchQ, cursor: $button.data('cursor')}})
+    $('#users-content-row').append(resp.data.users.map(userCardHtml).join(''))
+
+    if (resp.data.next_cursor){
+        $button.data('cursor', resp.data.next_cursor)
+    }
+    else{
+        $('#load-users-button-container').empty()
+    }
+}
+$('#load-users-button-container').on('click','#load-more-users', loadmoreUsers)
+
+
+// axios requests to view bookmarked songs without reload
 async function displayBookmarkedSongs(evt){
     let $target = $(evt.target)
     const userId = $target.data("userid")
-    // send request
-    const htmlResp = await axios.get(`${BASE_URL}users/${userId}/bookmarked`)
-    const htmlRespString = htmlResp.data
+    const pages = await getAllPages(`${BASE_URL}api/v1/users/${userId}/bookmarked`)
+    const songCards = pages.map(songCardsHtml).join('')
+    let html
+    if (songCards){
+        html = `<div class="col-lg-9 col-xl-8 col-xxl-7 m-4">${songCards}</div>`
+    }
+    else{
+        const message = userId === viewerId ? 'Start bookmarking songs!'
+                        : `${escapeHtml($target.data('username'))} has nothing bookmarked yet.`
+        html = `<div class="container text-center"><h3 class="mt-4 text-white">${message}</h3></div>`
+    }
     // change display to reflect response data
-    $('#music-content').empty().append(htmlRespString)
+    $('#music-content').empty().append(html)
     // change active-tab 
     $target.parent().prev().removeClass('active-tab')
     $target.parent().addClass('active-tab')
@@ -50,15 +238,25 @@ async function displayBookmarkedSongs(evt){
 $('#my-songs-tab').on('click', displayBookmarkedSongs)
 
 
-//axios request to view posts without reload
+//axios requests to view posts without reload
 async function displayPosts(evt){
     let $target = $(evt.target)
     const userId = $target.data("userid")
-    // send request
-    const htmlResp = await axios.get(`${BASE_URL}users/${userId}/posts`)
-    const htmlRespString = htmlResp.data
+    const pages = await getAllPages(`${BASE_URL}api/v1/users/${userId}/posts`)
+    let html = pages.map(page => page.posts.map(post => postHtml(post, page)).join('')).join('')
+    if (!html && userId === viewerId){
+        html = `<div class="container text-center">
+            <h3 class="mt-4 text-white">Upload a photo to get started!</h3>
+            <a class='btn btn-success' href="/posts/upload">Go!</a>
+        </div>`
+    }
+    else if (!html){
+        html = `<div class="container text-center">
+            <h3 class="mt-4 text-white">${escapeHtml($target.data('username'))} has no posts.</h3>
+        </div>`
+    }
     // change display to reflect response data
-    $('#music-content').empty().append(htmlRespString)
+    $('#music-content').empty().append(html)
     // change active-tab 
     $target.parent().next().removeClass('active-tab')
     $target.parent().addClass('active-tab')
@@ -73,7 +271,8 @@ async function toggleBookmark(evt){
     const songTitle = $target.parent().prev().find('a').first().text()
     const resp = await axios.post(`${BASE_URL}bookmark/${songId}`)
     if (resp){
-        if ($target.hasClass('bi-bookmark')){
+        // response has the new state, in case song was toggled in another tab
+        if (resp.data.bookmarked){
             $target.removeClass('bi-bookmark')
             $target.addClass('bi-bookmark-fill')
             displayToastMessage('Bookmarked', songTitle)
@@ -102,7 +301,7 @@ function deletePost(evt){
     let $target = $(evt.target)
     const postId = $target.closest('.post').attr('id')
     // send request
-    $('#delete-post').on('click', async function () {
+    $('#delete-post').off('click').on('click', async function () {
         const modal = bootstrap.Modal.getInstance($('.staticPostModal'));
         modal.hide();
         const resp = await axios.delete(`${BASE_URL}posts/${postId}/delete`)
@@ -113,7 +312,8 @@ function deletePost(evt){
         }
     })
 }
-$('.bi-trash-fill').on('click', deletePost)
+// delegated, so posts loaded later get it too
+$('#music-content').on('click', '.bi-trash-fill', deletePost)
 
 
 // Change display on search filter select dropdown
@@ -163,4 +363,20 @@ function playPause(evt){
         currentIconBtn = null;
     }
 }
-$('#music-content').on('click','.play-pause', playPause)
\ No newline at end of file
+$('#music-content').on('click','.play-pause', playPause)
+
+
+// Poll status of a post whose songs are still being found, reload once done
+async function pollPendingPost(){
+    const postId = $('#pending-post').data('postid')
+    const resp = await axios.get(`${BASE_URL}posts/${postId}/status`)
+    if (resp.data.status === 'pending'){
+        setTimeout(pollPendingPost, 2000)
+    }
+    else{
+        window.location.reload()
+    }
+}
+if ($('#pending-post').length){
+    setTimeout(pollPendingPost, 2000)
+}
\ No newline at end of file
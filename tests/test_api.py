@@ -0,0 +1,169 @@
+"""JSON API tests"""
+
+import os, sys
+import re
+from datetime import datetime, timedelta
+from unittest import TestCase
+from sqlalchemy import event
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import db, User, Post, Song, BookmarkedSongs
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app, CURR_USER_KEY
+from views.identity import identity_cache
+
+db.drop_all()
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Tests for /api/v1 pages and their cursors."""
+
+    def setUp(self):
+        """Create users with posts sharing songs, and bookmarks."""
+
+        Post.query.delete()
+        User.query.delete()
+        Song.query.delete()
+
+        self.client = app.test_client()
+
+        password = User.hash_pw('testing')
+        self.users = [User(email=f'api{i}@email.com', username=f'apiuser{i}',
+                           password=password) for i in range(2)]
+        # artists in a different order than ids, upper and lower case
+        self.songs = [Song(title=f'Api song {i}', artists=f'{"zYx"[i % 3]} artists {i:02}',
+                           spotify_track_id=f'api{i}',
+                           spotify_url=f'spotify.com/api{i}') for i in range(30)]
+        start = datetime(2024, 1, 1)
+        for i in range(25):
+            post = Post(description=f'Api post {i}', image='test-image.png',
+                        timestamp=start + timedelta(minutes=i))
+            post.songs.extend(self.songs[i % 3:i % 3 + 3])
+            self.users[i % 2].posts.append(post)
+        db.session.add_all(self.users + self.songs)
+        db.session.commit()
+
+        self.id1, self.id2 = self.users[0].id, self.users[1].id
+        for song in self.songs[:25]:
+            BookmarkedSongs.toggle(self.id1, song.id)
+        db.session.commit()
+        self.bookmarked_id = self.songs[0].id
+
+    def tearDown(self):
+        response = super().tearDown()
+        db.session.rollback()
+        return response
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.id1
+
+    def follow(self, c, url, **params):
+        """Returns every page of url, following next_cursor"""
+
+        pages = [c.get(url, query_string=params).json]
+        while pages[-1]['has_more']:
+            params['cursor'] = pages[-1]['next_cursor']
+            pages.append(c.get(url, query_string=params).json)
+        return pages
+
+    def test_feed_pages(self):
+        """Tests that feed pages list every post once, newest first, with
+        their songs and users sent once per page."""
+
+        with self.client as c:
+            self.login(c)
+            pages = self.follow(c, '/api/v1/feed')
+
+        self.assertEqual([len(page['posts']) for page in pages], [10, 10, 5])
+        self.assertIsNone(pages[-1]['next_cursor'])
+        descriptions = [post['description'] for page in pages for post in page['posts']]
+        self.assertEqual(descriptions, [f'Api post {i}' for i in reversed(range(25))])
+
+        page = pages[0]
+        self.assertEqual(len(page['songs']), 5)
+        self.assertEqual(set(page['users']), {str(self.id1), str(self.id2)})
+        for post in page['posts']:
+            self.assertEqual(len(post['song_ids']), 3)
+            self.assertTrue(all(str(song_id) in page['songs'] for song_id in post['song_ids']))
+        # null fields left out
+        self.assertNotIn('album', page['songs'][str(self.bookmarked_id)])
+        self.assertIn(self.bookmarked_id, page['bookmarked'])
+
+    def test_feed_query_count(self):
+        """Tests that a feed page takes a fixed number of queries:
+        g.user, posts, songs, users, bookmarks."""
+
+        statements = []
+        def count_statement(*args):
+            statements.append(args[2])
+
+        with self.client as c:
+            self.login(c)
+            db.session.remove()
+            identity_cache.clear()
+            event.listen(db.engine, 'before_cursor_execute', count_statement)
+            try:
+                resp = c.get('/api/v1/feed')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(statements), 5)
+
+    def test_profile_tabs(self):
+        """Tests that user's posts and bookmarks are paged to the end,
+        bookmarks by artists like the HTML tab."""
+
+        with self.client as c:
+            self.login(c)
+            post_pages = self.follow(c, f'/api/v1/users/{self.id2}/posts')
+            bookmark_pages = self.follow(c, f'/api/v1/users/{self.id1}/bookmarked')
+            tab_html = c.get(f'/users/{self.id1}/bookmarked').get_data(as_text=True)
+
+        self.assertEqual(sum(len(page['posts']) for page in post_pages), 12)
+        self.assertEqual([len(page['songs']) for page in bookmark_pages], [20, 5])
+        titles = [song['title'] for page in bookmark_pages for song in page['songs']]
+        self.assertEqual(titles, [f'Api song {i}' for i in sorted(range(25),
+                                                                   key=lambda i: (2 - i % 3, i))])
+        self.assertEqual(len(bookmark_pages[0]['bookmarked']), 20)
+        # same order as the HTML tab
+        self.assertEqual(titles, re.findall(r'target="_blank">(Api song \d+)</a>', tab_html))
+
+        post = post_pages[0]['posts'][0]
+        self.assertEqual(post['image_url'], '/static/post-images/test-image.png')
+        self.assertEqual(post_pages[0]['users'][str(self.id2)]['profile_image_url'],
+                         '/static/profile-images/default-profile.png')
+
+    def test_search_pages(self):
+        """Tests that search pages follow cursors until has_more is false."""
+
+        with self.client as c:
+            self.login(c)
+            song_pages = self.follow(c, '/api/v1/search/songs', q='api')
+            user_pages = self.follow(c, '/api/v1/search/users', q='apiuser')
+
+        self.assertEqual([len(page['songs']) for page in song_pages], [20, 10])
+        self.assertEqual([user['username'] for user in user_pages[0]['users']],
+                         ['apiuser0', 'apiuser1'])
+        self.assertFalse(user_pages[0]['has_more'])
+
+    def test_errors(self):
+        """Tests JSON errors for anonymous users, bad cursors and unknown users."""
+
+        with self.client as c:
+            self.assertEqual(c.get('/api/v1/feed').status_code, 401)
+
+            self.login(c)
+            resp = c.get('/api/v1/feed?cursor=not-a-cursor')
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {'error': 'Invalid cursor'})
+
+            resp = c.get('/api/v1/users/0/posts')
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json, {'error': 'User not found'})
@@ -1,13 +1,51 @@
 """API Calls Function tests"""
 
 import os, sys
-from unittest import TestCase
+import time
+import urllib.parse
+from unittest import TestCase, mock
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from views import api_funcs
 from views.api_funcs import get_keywords, get_track_data, get_list_of_tracks
+from views.fake_apis import FakeApiServer
 
-class ImageAPITestCase(TestCase):
+# Set LIVE_API_TESTS=1 to run the API call tests against Everypixel and Spotify
+LIVE_API_TESTS = os.environ.get('LIVE_API_TESTS') == '1'
+
+class FakeApiTestCase(TestCase):
+    """Sends the class's API calls to a local fake API server
+    unless LIVE_API_TESTS is set."""
+
+    @classmethod
+    def setUpClass(cls):
+        if LIVE_API_TESTS:
+            return
+        cls.server = FakeApiServer().start()
+        cls.url_patch = mock.patch.multiple(api_funcs,
+                                            IMG_API_BASE_URL=f'{cls.server.url}/v1/keywords',
+                                            SPOTIFY_TOKEN_URL=f'{cls.server.url}/api/token',
+                                            SPOTIFY_SEARCH_BASE_URL=f'{cls.server.url}/v1/search')
+        cls.url_patch.start()
+        cls.reset_api_state()
+
+    @classmethod
+    def tearDownClass(cls):
+        if LIVE_API_TESTS:
+            return
+        cls.url_patch.stop()
+        cls.server.stop()
+        cls.reset_api_state()
+
+    @staticmethod
+    def reset_api_state():
+        """Drops token and search results from the other server"""
+
+        api_funcs.spotify_tokens.invalidate()
+        api_funcs.search_cache.clear()
+
+class ImageAPITestCase(FakeApiTestCase):
     """Tests for AI Image API calls."""
 
     def test_get_keywords(self):
@@ -19,7 +57,7 @@ class ImageAPITestCase(TestCase):
         self.assertIsInstance(keywords, list)
         self.assertEqual(len(keywords), 5)
 
-class SpotifyAPITestCase(TestCase):
+class SpotifyAPITestCase(FakeApiTestCase):
     """Tests for Spotify API calls."""
 
     def test_getting_track_data(self):
@@ -45,4 +83,132 @@ class SpotifyAPITestCase(TestCase):
         self.assertEqual(len(track_data_list), 3)
         self.assertIsInstance(track_data_list[0], dict)
         self.assertIsInstance(track_data_list[1], dict)
-        self.assertIsInstance(track_data_list[2], dict)
\ No newline at end of file
+        self.assertIsInstance(track_data_list[2], dict)
+
+class TrackFanOutTestCase(TestCase):
+    """Tests for running keyword searches concurrently (Spotify calls mocked)."""
+
+    def test_keeps_keyword_order(self):
+        """Tests that results come back in keyword order even when
+        earlier searches finish last."""
+
+        def fake_track_data(keyword):
+            time.sleep({'a': 0.06, 'b': 0.03, 'c': 0.0}[keyword])
+            return {'title': keyword}
+
+        with mock.patch('views.api_funcs.get_track_data', side_effect=fake_track_data):
+            track_data_list = get_list_of_tracks(['a', 'b', 'c'])
+
+        self.assertEqual([track['title'] for track in track_data_list], ['a', 'b', 'c'])
+
+    def test_runs_in_parallel(self):
+        """Tests that searches overlap instead of adding up."""
+
+        def fake_track_data(keyword):
+            time.sleep(0.1)
+            return {'title': keyword}
+
+        with mock.patch('views.api_funcs.get_track_data', side_effect=fake_track_data):
+            start = time.perf_counter()
+            get_list_of_tracks(['a', 'b', 'c', 'd', 'e'], max_workers=5)
+            elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.3)
+
+    def test_failed_search_isolated(self):
+        """Tests that a failed or empty search is dropped without
+        losing the other keywords' tracks."""
+
+        def fake_track_data(keyword):
+            if keyword == 'bad':
+                raise KeyError('tracks')
+            if keyword == 'empty':
+                return None
+            return {'title': keyword}
+
+        with mock.patch('views.api_funcs.get_track_data', side_effect=fake_track_data):
+            track_data_list = get_list_of_tracks(['sky', 'bad', 'empty', 'sea'])
+
+        self.assertEqual([track['title'] for track in track_data_list], ['sky', 'sea'])
+
+
+def make_search_resp(count, offset=0, total=None):
+    """Returns a mock Spotify search response with count tracks
+    starting at offset, out of total results"""
+
+    items = [{
+        'name': f'Song {i}',
+        'id': f'track{i}',
+        'preview_url': None,
+        'external_urls': {'spotify': f'https://open.spotify.com/track/track{i}'},
+        'artists': [{'name': 'Artist'}],
+        'album': {'name': 'Album', 'release_date': '2020-05-01', 'images': []}
+    } for i in range(offset, offset + count)]
+
+    resp = mock.Mock(status_code=200, headers={})
+    resp.json.return_value = {'tracks': {'total': count if total is None else total,
+                                         'items': items}}
+    return resp
+
+
+def search_side_effect(total):
+    """Returns mock api_client.request answering pages of a search with total results"""
+
+    def request(method, url, **kwargs):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        offset, limit = int(query['offset'][0]), int(query['limit'][0])
+        # Spotify rejects offsets past the results
+        assert offset < total
+        return make_search_resp(min(limit, total - offset), offset, total)
+    return request
+
+
+class SearchCacheTestCase(TestCase):
+    """Tests for caching Spotify search results per keyword (Spotify calls mocked)."""
+
+    def setUp(self):
+        api_funcs.search_cache.clear()
+        self.token_patch = mock.patch('views.api_funcs.get_spotify_token', return_value='token')
+        self.token_patch.start()
+
+    def tearDown(self):
+        self.token_patch.stop()
+        api_funcs.search_cache.clear()
+
+    def test_repeated_keyword_cached(self):
+        """Tests that a repeated keyword is answered from cache
+        with tracks picked from the cached page."""
+
+        with mock.patch.object(api_funcs.api_client, 'request',
+                               return_value=make_search_resp(10)) as get:
+            picks = {get_track_data('Sky')['spotify_track_id'] for _ in range(30)}
+            get_track_data('sky ')
+
+        self.assertEqual(get.call_count, 1)
+        self.assertGreater(len(picks), 1)
+        self.assertTrue(picks <= {f'track{i}' for i in range(10)})
+
+    def test_empty_search_cached(self):
+        """Tests that searches with no tracks return None
+        without searching again."""
+
+        with mock.patch.object(api_funcs.api_client, 'request',
+                               return_value=make_search_resp(0)) as get:
+            self.assertIsNone(get_track_data('nothing'))
+            self.assertIsNone(get_track_data('nothing'))
+
+        self.assertEqual(get.call_count, 1)
+
+    def test_picks_sampled_across_pages(self):
+        """Tests that repeat picks come from the keyword's results beyond
+        the first page, each page fetched once and never past total."""
+
+        total = 120
+        with mock.patch.object(api_funcs.api_client, 'request',
+                               side_effect=search_side_effect(total)) as get:
+            picks = {get_track_data('sky')['spotify_track_id'] for _ in range(200)}
+
+        pages = -(-total // api_funcs.SPOTIFY_PAGE_SIZE)
+        self.assertEqual(get.call_count, pages)
+        self.assertTrue(picks <= {f'track{i}' for i in range(total)})
+        self.assertTrue(any(int(pick[5:]) >= api_funcs.SPOTIFY_PAGE_SIZE for pick in picks))
@@ -0,0 +1,58 @@
+"""Static file cache header tests"""
+
+import os, sys
+from unittest import TestCase
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app
+from views.assets import IMMUTABLE_MAX_AGE, fingerprint, is_upload
+
+IMMUTABLE = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+
+
+class AssetsTestCase(TestCase):
+    """Tests for fingerprinted URLs and immutable cache headers."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.upload = next(f'post-images/{name}' for name in
+                           sorted(os.listdir(os.path.join(app.static_folder, 'post-images')))
+                           if name.endswith('.jpg'))
+
+    def test_is_upload(self):
+        """Tests that only UUID-named uploads count as uploads."""
+
+        self.assertTrue(is_upload(self.upload))
+        self.assertTrue(is_upload('profile-images/0e8d0f6c-189e-11ef-9f44-d4619d14ec82_me.png'))
+        self.assertFalse(is_upload('profile-images/default-profile.png'))
+        self.assertFalse(is_upload('app.css'))
+
+    def test_upload_immutable(self):
+        """Tests that uploads are served as immutable."""
+
+        resp = self.client.get(f'/static/{self.upload}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], IMMUTABLE)
+        resp.close()
+
+    def test_fingerprinted_url(self):
+        """Tests that pages link app.css and app.js by content hash, and
+        only the current hash is served as immutable."""
+
+        html = self.client.get('/').get_data(as_text=True)
+        css_url = f'/static/app.css?v={fingerprint(app.static_folder, "app.css")}'
+        self.assertIn(css_url, html)
+        self.assertIn(f'/static/app.js?v={fingerprint(app.static_folder, "app.js")}', html)
+
+        resp = self.client.get(css_url)
+        self.assertEqual(resp.headers['Cache-Control'], IMMUTABLE)
+        resp.close()
+
+        for url in ('/static/app.css', '/static/app.css?v=stale'):
+            resp = self.client.get(url)
+            self.assertNotIn('immutable', resp.headers.get('Cache-Control', ''))
+            resp.close()
@@ -0,0 +1,76 @@
+"""In-process cache tests"""
+
+import os, sys
+from unittest import TestCase
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from views.caches import LRUTTLCache
+
+
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUTTLCacheTestCase(TestCase):
+    """Tests for LRU eviction, expiry and stats."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUTTLCache(maxsize=2, ttl=60, clock=self.clock)
+
+    def test_get_set(self):
+        """Tests that cached values are returned and misses give default."""
+
+        self.cache.set('sky', ['song'])
+
+        self.assertEqual(self.cache.get('sky'), ['song'])
+        self.assertIsNone(self.cache.get('sea'))
+        self.assertEqual(self.cache.get('sea', 'default'), 'default')
+
+    def test_least_recently_used_evicted(self):
+        """Tests that the least recently used key is evicted when full."""
+
+        self.cache.set('sky', 1)
+        self.cache.set('sea', 2)
+        # touching sky makes sea the least recently used
+        self.cache.get('sky')
+        self.cache.set('nature', 3)
+
+        self.assertEqual(self.cache.get('sky'), 1)
+        self.assertIsNone(self.cache.get('sea'))
+        self.assertEqual(self.cache.get('nature'), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        """Tests that entries are dropped once their ttl passes."""
+
+        self.cache.set('sky', 1)
+        self.cache.set('sea', 2, ttl=120)
+        self.clock.now += 61
+
+        self.assertIsNone(self.cache.get('sky'))
+        self.assertEqual(self.cache.get('sea'), 2)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_stats(self):
+        """Tests that stats report size and hit ratio."""
+
+        self.cache.set('sky', 1)
+        self.cache.get('sky')
+        self.cache.get('sky')
+        self.cache.get('sea')
+        self.cache.get('nature')
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['maxsize'], 2)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hit_ratio'], 0.5)
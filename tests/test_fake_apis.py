@@ -0,0 +1,115 @@
+"""Fake Everypixel/Spotify API tests"""
+
+import os, sys
+import json
+import shutil
+import tempfile
+import time
+from unittest import TestCase, mock
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from views import api_funcs
+from views.fake_apis import FakeApiConfig, FakeApiServer, Latency
+from views.spotify_token import SpotifyTokenManager
+
+
+class FakeApiTestCase(TestCase):
+    """Tests for running the API functions against the fake server."""
+
+    def start_server(self, **config):
+        """Starts fake server and points api_funcs at it for this test"""
+
+        server = FakeApiServer(FakeApiConfig(seed=0, **config)).start()
+        self.addCleanup(server.stop)
+
+        for name, path in [('IMG_API_BASE_URL', '/v1/keywords'),
+                           ('SPOTIFY_TOKEN_URL', '/api/token'),
+                           ('SPOTIFY_SEARCH_BASE_URL', '/v1/search')]:
+            patcher = mock.patch.object(api_funcs, name, server.url + path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(api_funcs, 'spotify_tokens',
+                                    SpotifyTokenManager(api_funcs.request_spotify_token))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        api_funcs.search_cache.clear()
+        self.addCleanup(api_funcs.search_cache.clear)
+        return server
+
+    def test_upload_path_offline(self):
+        """Tests that keywords and tracks come back from the fake APIs."""
+
+        self.start_server()
+
+        keywords = api_funcs.get_keywords('test_image.jpeg')
+        self.assertEqual(len(keywords), 5)
+        # same image, same keywords
+        self.assertEqual(api_funcs.get_keywords('test_image.jpeg'), keywords)
+
+        tracks = api_funcs.get_list_of_tracks(['sky', 'sea'])
+        self.assertEqual(len(tracks), 2)
+        self.assertTrue(tracks[0]['spotify_url'].startswith('https://open.spotify.com/'))
+        self.assertEqual(len(tracks[0]['album_year']), 4)
+
+    def test_latency_injected(self):
+        """Tests that configured latency delays responses."""
+
+        server = self.start_server(endpoint_latency={'token': 'fixed:200'})
+
+        start = time.perf_counter()
+        requests.post(f'{server.url}/api/token')
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+
+    def test_rate_limited(self):
+        """Tests that requests over the rate limit get 429 with Retry-After."""
+
+        server = self.start_server(rate_limit=2)
+
+        statuses = [requests.post(f'{server.url}/api/token') for _ in range(4)]
+        self.assertEqual([resp.status_code for resp in statuses[:2]], [200, 200])
+        self.assertEqual(statuses[-1].status_code, 429)
+        self.assertIn('Retry-After', statuses[-1].headers)
+        self.assertGreaterEqual(server.stats['token.throttled'], 1)
+
+    def test_errors_injected(self):
+        """Tests that error_rate makes the API answer with 5xx."""
+
+        server = self.start_server(error_rate=1.0)
+
+        resp = requests.get(f'{server.url}/v1/search?q=sky', headers={'Authorization': 'Bearer x'})
+        self.assertIn(resp.status_code, (500, 503))
+
+    def test_replay(self):
+        """Tests that recorded responses are served instead of generated ones."""
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        recordings_path = os.path.join(tmp_dir, 'recordings.json')
+        with open(recordings_path, 'w') as recordings_file:
+            json.dump({'POST /api/token?': {'status': 200,
+                                             'body': {'access_token': 'recorded',
+                                                      'expires_in': 60}}},
+                      recordings_file)
+
+        server = self.start_server(replay=recordings_path)
+
+        self.assertEqual(requests.post(f'{server.url}/api/token').json()['access_token'],
+                         'recorded')
+        self.assertEqual(server.stats['replayed'], 1)
+
+
+class LatencyTestCase(TestCase):
+    """Tests for latency distribution specs."""
+
+    def test_latency_specs(self):
+        self.assertEqual(Latency('fixed:150').sample(), 0.15)
+        self.assertTrue(0.05 <= Latency('uniform:50:100').sample() <= 0.1)
+        self.assertGreater(Latency('lognormal:80:0.5').sample(), 0)
+
+        with self.assertRaises(ValueError):
+            Latency('pareto:1')
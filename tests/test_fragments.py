@@ -0,0 +1,138 @@
+"""Post and song card cache tests"""
+
+import io
+import os, sys
+from unittest import TestCase
+
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import db, User, Post, Song, BookmarkedSongs
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app, CURR_USER_KEY
+from views.fragments import fragment_cache
+from views.storage import MemoryStorage
+from views.thumbnails import POST_WIDTHS, make_variants
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class FragmentCacheTestCase(TestCase):
+    """Tests that cards are rendered once and shared across viewers."""
+
+    def setUp(self):
+        """Create two users and a post with songs."""
+
+        Post.query.delete()
+        User.query.delete()
+        Song.query.delete()
+        fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        password = User.hash_pw('testing')
+        self.user1 = User(email='test@email.com', username='testuser1', password=password)
+        self.user2 = User(email='test2@email.com', username='testuser2', password=password)
+        post = Post(description='Cached post', image='test-image.png')
+        post.songs.extend(Song(title=f'Card song {i}',
+                               artists='Card artists',
+                               spotify_track_id=f'card{i}',
+                               spotify_url=f'spotify.com/card{i}') for i in range(2))
+        self.user1.posts.append(post)
+        db.session.add_all([self.user1, self.user2])
+        db.session.commit()
+
+        self.id1, self.id2 = self.user1.id, self.user2.id
+        self.postid = post.id
+        self.songid = post.songs[0].id
+
+    def tearDown(self):
+        response = super().tearDown()
+        db.session.rollback()
+        return response
+
+    def get_post(self, user_id):
+        """Returns HTML of results page of post as seen by user_id"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            return c.get(f'/posts/{self.postid}').get_data(as_text=True)
+
+    def test_card_shared_across_viewers(self):
+        """Tests that a post is rendered once, with each viewer's own
+        trash button and bookmark icons."""
+
+        BookmarkedSongs.toggle(self.id2, self.songid)
+        db.session.commit()
+
+        owner_html = self.get_post(self.id1)
+        viewer_html = self.get_post(self.id2)
+
+        self.assertEqual(fragment_cache.stats()['post'],
+                         {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+        self.assertIn('bi-trash-fill', owner_html)
+        self.assertNotIn('bi-trash-fill', viewer_html)
+        self.assertEqual(owner_html.count('bi-bookmark-fill'), 0)
+        self.assertEqual(viewer_html.count('bi-bookmark-fill'), 1)
+        self.assertEqual(viewer_html.count('bi bi-bookmark"'), 1)
+        self.assertNotIn('<!--bookmark', viewer_html)
+        self.assertNotIn('<!--trash-->', viewer_html)
+
+    def test_profile_edit_invalidates(self):
+        """Tests that posts show user's new username after a profile edit."""
+
+        self.assertIn('@testuser1', self.get_post(self.id2))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+            c.post('/user/edit', data={'email': 'test@email.com',
+                                       'username': 'renamed1',
+                                       'password': 'testing'},
+                   content_type='multipart/form-data')
+
+        html = self.get_post(self.id2)
+        self.assertIn('@renamed1', html)
+        self.assertNotIn('@testuser1', html)
+        self.assertEqual(fragment_cache.stats()['post']['hits'], 0)
+
+    def test_delete_post_invalidates(self):
+        """Tests that deleting a post drops its cached card."""
+
+        self.get_post(self.id1)
+        self.assertEqual(fragment_cache.stats()['size'], 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+            c.delete(f'/posts/{self.postid}/delete')
+
+        self.assertEqual(fragment_cache.stats()['size'], 0)
+
+    def test_sized_copies_invalidate(self):
+        """Tests that posts list their image's sized copies once made."""
+
+        storage = MemoryStorage()
+        app_storage = app.extensions['storage']
+        app.extensions['storage'] = storage
+        try:
+            data = io.BytesIO()
+            Image.new('RGB', (600, 400), 'teal').save(data, 'PNG')
+            storage.put('post-images/test-image.png', data.getvalue())
+
+            self.assertNotIn('srcset', self.get_post(self.id2))
+            make_variants(storage, 'post-images/test-image.png', POST_WIDTHS)
+            html = self.get_post(self.id2)
+        finally:
+            app.extensions['storage'] = app_storage
+
+        self.assertIn('post-images/thumbs/test-image.png.480.webp 480w', html)
+        self.assertEqual(fragment_cache.stats()['post']['hits'], 0)
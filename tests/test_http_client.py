@@ -0,0 +1,107 @@
+"""Shared HTTP client tests"""
+
+import os, sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from views.http_client import HttpClient
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    """Local test server: /ok answers, /slow stalls, /flaky fails once"""
+
+    protocol_version = 'HTTP/1.1'
+    flaky_calls = 0
+    slow_calls = 0
+
+    def do_GET(self):
+        if self.path == '/slow':
+            LocalHandler.slow_calls += 1
+            time.sleep(0.5)
+        if self.path == '/flaky':
+            LocalHandler.flaky_calls += 1
+            if LocalHandler.flaky_calls == 1:
+                return self._reply(503, b'unavailable')
+        self._reply(200, b'{"ok": true}')
+
+    do_POST = do_GET
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpClientTestCase(TestCase):
+    """Tests for pooled connections, timeouts, retries and stats."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), LocalHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        cls.host = f'127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.client = HttpClient(retries=1, backoff_factor=0, timeout=(1, 0.2))
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_connection_reused(self):
+        """Tests that sequential requests share one keep-alive connection."""
+
+        for _ in range(3):
+            self.assertEqual(self.client.get(f'{self.base_url}/ok').json(), {'ok': True})
+
+        stats = self.client.stats()[self.host]
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['pool']['connections_opened'], 1)
+        self.assertEqual(stats['pool']['requests_sent'], 3)
+
+    def test_read_timeout(self):
+        """Tests that a stalled response raises instead of hanging."""
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.client.get(f'{self.base_url}/slow')
+
+        self.assertEqual(self.client.stats()[self.host]['errors'], 1)
+
+    def test_retries_server_error(self):
+        """Tests that a 503 is retried and the retry's response returned."""
+
+        LocalHandler.flaky_calls = 0
+        resp = self.client.get(f'{self.base_url}/flaky')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(LocalHandler.flaky_calls, 2)
+
+    def test_post_not_retried(self):
+        """Tests that a POST is not repeated after a read timeout or 503."""
+
+        LocalHandler.slow_calls = 0
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.client.post(f'{self.base_url}/slow')
+        self.assertEqual(LocalHandler.slow_calls, 1)
+
+        LocalHandler.flaky_calls = 0
+        resp = self.client.post(f'{self.base_url}/flaky')
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(LocalHandler.flaky_calls, 1)
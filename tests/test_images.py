@@ -0,0 +1,80 @@
+"""Image processing tests"""
+
+import os, sys
+import io
+import shutil
+import tempfile
+from unittest import TestCase
+
+from PIL import Image, ImageOps
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import hash_distance
+from views.images import prepare_for_keywording, perceptual_hash
+
+
+class KeywordingImageTestCase(TestCase):
+    """Tests for the downscaled copy sent to the keywording API."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_large_image_downscaled(self):
+        """Tests that a large photo is sent smaller and the original kept."""
+
+        image_path = os.path.join(self.tmp_dir, 'large.png')
+        Image.effect_noise((3000, 2000), 64).convert('RGB').save(image_path)
+        original_size = os.path.getsize(image_path)
+
+        image_file, stats = prepare_for_keywording(image_path, max_side=1024)
+
+        with Image.open(image_file) as img:
+            self.assertEqual(img.format, 'JPEG')
+            self.assertEqual(max(img.size), 1024)
+        self.assertEqual(stats['original_bytes'], original_size)
+        self.assertLess(stats['sent_bytes'], original_size)
+        self.assertEqual(stats['bytes_saved'], original_size - stats['sent_bytes'])
+        self.assertGreaterEqual(stats['preprocess_ms'], 0)
+        # original untouched
+        self.assertEqual(os.path.getsize(image_path), original_size)
+        with Image.open(image_path) as img:
+            self.assertEqual(img.size, (3000, 2000))
+
+    def test_unreadable_image_sent_as_is(self):
+        """Tests that a file Pillow can't read falls back to its own bytes."""
+
+        image_file, stats = prepare_for_keywording('test_file.pdf')
+
+        with open('test_file.pdf', 'rb') as original:
+            self.assertEqual(image_file.read(), original.read())
+        self.assertEqual(stats['bytes_saved'], 0)
+
+
+class PerceptualHashTestCase(TestCase):
+    """Tests for near-duplicate image hashing."""
+
+    def test_resized_copy_same_hash(self):
+        """Tests that a resized, re-encoded copy hashes a few bits
+        apart and a different photo doesn't."""
+
+        with Image.open('test_image.jpeg') as img:
+            copy_file = io.BytesIO()
+            img.resize((img.width // 2, img.height // 2)).save(copy_file, 'JPEG', quality=60)
+            flipped_file = io.BytesIO()
+            ImageOps.mirror(img).save(flipped_file, 'JPEG')
+        copy_file.seek(0)
+        flipped_file.seek(0)
+
+        original_hash = perceptual_hash('test_image.jpeg')
+        self.assertEqual(len(original_hash), 16)
+        self.assertLessEqual(hash_distance(perceptual_hash(copy_file), original_hash), 6)
+        self.assertGreater(hash_distance(perceptual_hash(flipped_file), original_hash), 6)
+
+    def test_unreadable_image(self):
+        """Tests that files that aren't images have no hash."""
+
+        self.assertIsNone(perceptual_hash('test_file.pdf'))
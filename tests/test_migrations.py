@@ -0,0 +1,101 @@
+"""Schema migration tests"""
+
+import os, sys
+from unittest import TestCase
+from sqlalchemy import exc, inspect, text
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import db
+from models.migrations import migrate, migration_status, schema_migrations
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app
+
+
+def index_names(table_name):
+    """Returns names of table's indexes, including expression indexes
+    (which the SQLite inspector leaves out)"""
+
+    if db.engine.dialect.name == 'postgresql':
+        sql = 'SELECT indexname FROM pg_indexes WHERE tablename = :table'
+    else:
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+    return {row[0] for row in db.engine.execute(text(sql), table=table_name)}
+
+
+class MigrationTestCase(TestCase):
+    """Tests for applying migrations to new and existing databases."""
+
+    def setUp(self):
+        """Start from an empty database."""
+
+        db.session.remove()
+        db.drop_all()
+        schema_migrations.drop(db.engine, checkfirst=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        schema_migrations.drop(db.engine, checkfirst=True)
+        db.create_all()
+
+    def test_fresh_database(self):
+        """Tests that migrations build the schema models expect,
+        and running them again changes nothing."""
+
+        applied = migrate(db.engine)
+        self.assertEqual([migration.version for migration in applied],
+                         ['0001', '0002', '0003', '0004', '0005', '0006'])
+        self.assertEqual(migrate(db.engine), [])
+        self.assertTrue(all(applied for _, applied in migration_status(db.engine)))
+
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            self.assertEqual(columns, set(table.columns.keys()), table.name)
+
+            indexes = index_names(table.name)
+            for index in table.indexes:
+                self.assertIn(index.name, indexes)
+
+    def test_upgrade_existing_database(self):
+        """Tests upgrading a database from the first version, with duplicate
+        songs and bookmarks saved before they were unique, and counters
+        filled from existing rows."""
+
+        migrate(db.engine, target='0001')
+
+        with db.engine.begin() as conn:
+            conn.execute(text("INSERT INTO users (id, email, username, password) "
+                              "VALUES (1, 'a@email.com', 'user1', 'pw')"))
+            conn.execute(text("INSERT INTO posts (id, user_id, image, timestamp) "
+                              "VALUES (1, 1, 'test.jpg', '2024-01-01 00:00:00')"))
+            for song_id in [1, 2]:
+                conn.execute(text("INSERT INTO songs (id, title, artists, spotify_track_id, spotify_url) "
+                                  "VALUES (:id, 'Song', 'Artist', 'same', 'spotify.com/same')"),
+                             id=song_id)
+                conn.execute(text("INSERT INTO post_songs (post_id, song_id) VALUES (1, :id)"),
+                             id=song_id)
+                conn.execute(text("INSERT INTO bookmarked_songs (user_id, song_id) VALUES (1, :id)"),
+                             id=song_id)
+
+        self.assertEqual([migration.version for migration in migrate(db.engine)],
+                         ['0002', '0003', '0004', '0005', '0006'])
+
+        with db.engine.begin() as conn:
+            self.assertEqual(conn.execute(text('SELECT id FROM songs')).fetchall(), [(1,)])
+            self.assertEqual(conn.execute(text('SELECT song_id FROM post_songs')).fetchall(),
+                             [(1,), (1,)])
+            self.assertEqual(conn.execute(text('SELECT song_id FROM bookmarked_songs')).fetchall(),
+                             [(1,)])
+            self.assertEqual(conn.execute(text('SELECT status FROM posts')).scalar(), 'ready')
+            self.assertEqual(conn.execute(text('SELECT post_count, bookmark_count FROM songs')).fetchall(),
+                             [(2, 1)])
+            self.assertEqual(conn.execute(text('SELECT post_count FROM users')).scalar(), 1)
+
+        with self.assertRaises(exc.IntegrityError):
+            with db.engine.begin() as conn:
+                conn.execute(text("INSERT INTO bookmarked_songs (user_id, song_id) VALUES (1, 1)"))
@@ -11,6 +11,7 @@ from flask_bcrypt import Bcrypt
 bcrypt = Bcrypt()
 
 os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
 
 from app import app
 
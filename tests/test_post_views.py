@@ -1,17 +1,20 @@
 """Music search/Post-related views tests"""
 
 import os, sys
+import re
 from unittest import TestCase
 from flask import g
-from sqlalchemy import exc
+from sqlalchemy import exc, event
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from models.models import db, User, Post, Song
+from models.models import db, User, Post, Song, recount_counters
 
 os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
 
 from app import app, CURR_USER_KEY
+from views.identity import identity_cache
 
 app.config['WTF_CSRF_ENABLED'] = False
 
@@ -204,4 +207,197 @@ class PostViewsTestCase(TestCase):
             self.assertIsInstance(self.test_song2, Song)
             self.assertIsInstance(self.test_song3, Song)
             self.assertIsInstance(self.test_song4, Song)
-            self.assertIsInstance(self.test_song5, Song)
\ No newline at end of file
+            self.assertIsInstance(self.test_song5, Song)
+
+    def test_post_deletion_counters(self):
+        """Tests that deleting a post takes it off its user's and songs' counters."""
+
+        recount_counters()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+
+            c.delete(f'/posts/{self.postid}/delete')
+
+        self.assertEqual(User.query.get(self.id1).post_count, 0)
+        self.assertEqual({song.post_count for song in Song.query}, {0})
+        self.assertEqual(recount_counters(), {'songs': 0, 'users': 0})
+
+    ############## Popular Songs Tests
+    def test_popular_pages(self):
+        """Tests that popular songs and top users pages list by counters."""
+
+        recount_counters()
+        db.session.commit()
+        song_id = self.test_song2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+
+            c.post(f'/bookmark/{song_id}')
+
+            html = c.get('/songs/most-bookmarked').get_data(as_text=True)
+            self.assertIn('1 bookmarks', html)
+            self.assertIn('TEST song!', html)
+            self.assertNotIn('third TEST song!', html)
+
+            html = c.get('/songs/most-posted').get_data(as_text=True)
+            self.assertEqual(html.count('1 posts'), 5)
+
+            html = c.get('/users/top').get_data(as_text=True)
+            self.assertIn('@testuser1', html)
+
+
+def count_queries(client, url):
+    """Returns (response, number of SQL statements run) for GET url,
+    starting from an empty session and identity cache so nothing is
+    already loaded"""
+
+    statements = []
+    def count_statement(*args):
+        statements.append(args[2])
+
+    db.session.remove()
+    identity_cache.clear()
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    return resp, len(statements)
+
+
+class PostQueryCountTestCase(TestCase):
+    """Tests that post pages run a fixed number of queries."""
+
+    def setUp(self):
+        """Create users with posts that each have songs."""
+
+        Post.query.delete()
+        User.query.delete()
+        Song.query.delete()
+
+        self.client = app.test_client()
+
+        songs = [Song(title=f'Count song {i}',
+                      artists='Count artists',
+                      spotify_track_id=f'count{i}',
+                      spotify_url=f'spotify.com/count{i}') for i in range(10)]
+        self.users = []
+        for i in range(3):
+            user = User.signup(email=f'count{i}@email.com',
+                               username=f'countuser{i}',
+                               password='testing')
+            for j in range(4):
+                post = Post(description=f'Count post {i}-{j}', image='test-image.png')
+                post.songs.extend(songs[j:j + 3])
+                user.posts.append(post)
+            self.users.append(user)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in self.users]
+        self.post_id = self.users[0].posts[0].id
+
+    def tearDown(self):
+        response = super().tearDown()
+        db.session.rollback()
+        return response
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_ids[0]
+
+    def test_feed_query_count(self):
+        """Tests that feed pages load users and songs in a fixed
+        number of queries: g.user, posts with users, songs, bookmarks."""
+
+        with self.client as c:
+            self.login(c)
+
+            resp, count = count_queries(c, '/')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_data(as_text=True).count('class="post '), 5)
+            self.assertEqual(count, 4)
+
+            cursor = re.search(r'data-cursor="([^"]+)"', resp.get_data(as_text=True)).group(1)
+            resp, count = count_queries(c, f'/loadmore/posts?cursor={cursor}')
+            self.assertEqual(resp.get_data(as_text=True).count('class="post '), 5)
+            self.assertEqual(count, 4)
+
+    def test_feed_cursor_pages(self):
+        """Tests that following cursors shows every post once, newest first,
+        even when posts are added while scrolling."""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+            seen = re.findall(r'Count post (\d-\d)', html)
+            cursor = re.search(r'data-cursor="([^"]+)"', html).group(1)
+
+            # new post would shift every offset-based page by one
+            user = User.query.get(self.user_ids[0])
+            user.posts.append(Post(description='Newer post', image='test-image.png'))
+            db.session.commit()
+
+            while cursor:
+                resp = c.get(f'/loadmore/posts?cursor={cursor}')
+                self.assertEqual(resp.status_code, 200)
+                seen += re.findall(r'Count post (\d-\d)', resp.get_data(as_text=True))
+                cursor = resp.headers.get('X-Next-Cursor')
+
+            self.assertEqual(seen, [f'{i}-{j}' for i in reversed(range(3))
+                                    for j in reversed(range(4))])
+            self.assertNotIn("You're all caught up", html)
+
+            resp = c.get('/loadmore/posts?cursor=not-a-cursor')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_feed_bookmarks_query(self):
+        """Tests that bookmark state comes from one query of song IDs,
+        however many songs the user has bookmarked."""
+
+        user = User.query.get(self.user_ids[0])
+        user.bookmarked_songs.extend(Song.query.filter(Song.spotify_track_id.in_(['count0', 'count9'])))
+        for i in range(30):
+            user.bookmarked_songs.append(Song(title=f'Saved song {i}',
+                                              artists='Saved artists',
+                                              spotify_track_id=f'saved{i}',
+                                              spotify_url=f'spotify.com/saved{i}'))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+
+            resp, count = count_queries(c, '/')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(count, 4)
+            # of the 5 newest posts, only one has count0 (count9 is on none)
+            self.assertEqual(html.count('bi-bookmark-fill'), 1)
+
+    def test_profile_query_count(self):
+        """Tests that profile pages load posts and songs in a fixed number
+        of queries: g.user, user, posts, songs, bookmarks."""
+
+        with self.client as c:
+            self.login(c)
+
+            for url in [f'/users/{self.user_ids[1]}', f'/users/{self.user_ids[1]}/posts']:
+                resp, count = count_queries(c, url)
+                self.assertEqual(resp.get_data(as_text=True).count('class="post '), 4)
+                self.assertEqual(count, 5)
+
+    def test_results_query_count(self):
+        """Tests that results page loads post, user and songs in a fixed
+        number of queries: g.user, post with user, songs, bookmarks."""
+
+        with self.client as c:
+            self.login(c)
+
+            resp, count = count_queries(c, f'/posts/{self.post_id}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(count, 4)
@@ -0,0 +1,234 @@
+"""Rate limiter and circuit breaker tests"""
+
+import io
+import os, sys
+import time
+from unittest import TestCase, mock
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from views import api_funcs
+from views.fake_apis import FakeApiConfig, FakeApiServer
+from views.http_client import HttpClient
+from views.resilience import (ApiGuard, ApiUnavailable, CircuitBreaker,
+                              RateLimiter, parse_retry_after)
+
+
+class FakeClock:
+    """Clock whose time only moves when sleep() is called"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_resp(status_code, headers=None, body=None):
+    resp = mock.Mock(status_code=status_code, headers=headers or {})
+    resp.json.return_value = body or {}
+    return resp
+
+
+class RateLimiterTestCase(TestCase):
+    """Tests for spacing out calls and honoring Retry-After."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_limiter(self, **kwargs):
+        return RateLimiter(clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_rate_spaces_calls(self):
+        """Tests that calls past the burst wait for their turn."""
+
+        limiter = self.make_limiter(rate=2, burst=2)
+        for _ in range(4):
+            limiter.acquire()
+
+        # 2 calls right away, then one every half second
+        self.assertAlmostEqual(self.clock.now, 1001.0)
+        self.assertEqual(limiter.waits, 2)
+
+    def test_throttle_holds_callers(self):
+        """Tests that a 429 holds callers for Retry-After, and callers
+        that would wait past max_wait are refused."""
+
+        limiter = self.make_limiter(max_wait=5)
+        limiter.throttle(3)
+        limiter.acquire()
+        self.assertEqual(self.clock.now, 1003.0)
+
+        limiter.throttle(30)
+        with self.assertRaises(ApiUnavailable) as cm:
+            limiter.acquire()
+        self.assertEqual(cm.exception.retry_after, 30)
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('7'), 7)
+        self.assertEqual(parse_retry_after(None), 1)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertEqual(parse_retry_after('soon'), 1)
+
+
+class CircuitBreakerTestCase(TestCase):
+    """Tests for opening, half opening and closing the circuit."""
+
+    def test_breaker_cycle(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=clock)
+
+        for _ in range(2):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+        # one trial call after reset_timeout
+        clock.sleep(30)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, 'half_open')
+
+        # failed trial opens circuit again
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+
+        clock.sleep(30)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.stats()['opened'], 2)
+
+
+class ApiGuardTestCase(TestCase):
+    """Tests for sending requests through the limiter and breaker."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.client = mock.Mock()
+        self.guard = ApiGuard('test',
+                              RateLimiter(max_wait=5, clock=self.clock, sleep=self.clock.sleep),
+                              CircuitBreaker(failure_threshold=2, clock=self.clock))
+
+    def test_retries_short_throttle(self):
+        """Tests that a 429 with a short Retry-After is waited out and retried."""
+
+        self.client.request.side_effect = [make_resp(429, {'Retry-After': '2'}),
+                                           make_resp(200)]
+
+        self.assertEqual(self.guard.request(self.client, 'GET', 'url').status_code, 200)
+        self.assertEqual(self.clock.now, 1002.0)
+        self.assertEqual(self.guard.limiter.throttled, 1)
+
+    def test_throttled_upload_resent_whole(self):
+        """Tests that a multipart upload retried after a 429 sends the
+        whole file again, not what's left after the first send."""
+
+        sent_sizes = []
+        def request(method, url, **kwargs):
+            sent_sizes.append(len(kwargs['files']['data'][1].read()))
+            return make_resp(429, {'Retry-After': '1'}) if len(sent_sizes) == 1 else make_resp(200)
+        self.client.request.side_effect = request
+
+        image_file = io.BytesIO(b'x' * 5000)
+        resp = self.guard.request(self.client, 'POST', 'url',
+                                  files={'data': ('image.jpg', image_file, 'image/jpeg')})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sent_sizes, [5000, 5000])
+
+    def test_long_throttle_fails_fast(self):
+        """Tests that a long Retry-After fails this and later calls
+        without sending them."""
+
+        self.client.request.return_value = make_resp(429, {'Retry-After': '60'})
+
+        with self.assertRaises(ApiUnavailable) as cm:
+            self.guard.request(self.client, 'GET', 'url')
+        self.assertEqual(cm.exception.retry_after, 60)
+        with self.assertRaises(ApiUnavailable):
+            self.guard.request(self.client, 'GET', 'url')
+        self.assertEqual(self.client.request.call_count, 1)
+        # throttling isn't an outage
+        self.assertEqual(self.guard.breaker.state, 'closed')
+
+    def test_failures_open_circuit(self):
+        """Tests that repeated errors open the circuit so calls fail fast."""
+
+        self.client.request.side_effect = [make_resp(503),
+                                           requests.ConnectionError('down')]
+        for _ in range(2):
+            with self.assertRaises(ApiUnavailable):
+                self.guard.request(self.client, 'GET', 'url')
+
+        with self.assertRaises(ApiUnavailable) as cm:
+            self.guard.request(self.client, 'GET', 'url')
+        self.assertIn('circuit open', str(cm.exception))
+        self.assertEqual(self.client.request.call_count, 2)
+        self.assertEqual(self.guard.stats()['circuit']['state'], 'open')
+
+
+class ThrottledHttpClientTestCase(TestCase):
+    """Tests a throttling API through the real HTTP client (fake APIs)."""
+
+    def test_throttle_not_retried_by_client(self):
+        """Tests that a 429 with a long Retry-After goes out once and fails
+        fast, instead of the HTTP client sleeping and retrying it."""
+
+        config = FakeApiConfig(throttle_rate=1.0, retry_after=3)
+        client = HttpClient()
+        guard = ApiGuard('fake', RateLimiter(max_wait=1))
+
+        with FakeApiServer(config) as server:
+            start = time.perf_counter()
+            with self.assertRaises(ApiUnavailable) as cm:
+                guard.request(client, 'GET', f'{server.url}/v1/search', params={'q': 'rain'})
+            elapsed = time.perf_counter() - start
+
+        client.close()
+        self.assertEqual(cm.exception.retry_after, 3)
+        self.assertEqual(server.stats['search.requests'], 1)
+        self.assertLess(elapsed, 1)
+
+
+class SpotifyThrottledTestCase(TestCase):
+    """Tests for Spotify searches while Spotify is throttling us (Spotify mocked)."""
+
+    def setUp(self):
+        api_funcs.search_cache.clear()
+        patches = [mock.patch('views.api_funcs.get_spotify_token', return_value='token'),
+                   mock.patch.object(api_funcs, 'spotify_guard',
+                                     ApiGuard('spotify', RateLimiter(max_wait=0.01)))]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_throttled_search_raises(self):
+        """Tests that a 429 without search results doesn't crash track lookups,
+        and the post's searches give up with the Retry-After."""
+
+        throttled = make_resp(429, {'Retry-After': '10'},
+                              {'error': {'status': 429, 'message': 'API rate limit exceeded'}})
+        with mock.patch.object(api_funcs.api_client, 'request', return_value=throttled) as request:
+            with self.assertRaises(ApiUnavailable) as cm:
+                api_funcs.get_list_of_tracks(['sky', 'sea', 'sun'], max_workers=1)
+
+        self.assertAlmostEqual(cm.exception.retry_after, 10, delta=1)
+        # later searches held back by the shared limiter
+        self.assertEqual(request.call_count, 1)
+
+    def test_error_body_raises(self):
+        """Tests that a response without 'tracks' raises ApiUnavailable."""
+
+        resp = make_resp(400, body={'error': {'status': 400, 'message': 'Invalid limit'}})
+        with mock.patch.object(api_funcs.api_client, 'request', return_value=resp):
+            with self.assertRaises(ApiUnavailable):
+                api_funcs.get_track_data('sky')
@@ -0,0 +1,144 @@
+"""Engine pool and read-replica routing tests"""
+
+import os, sys
+import tempfile
+from unittest import TestCase, mock
+from flask_sqlalchemy import get_state
+from sqlalchemy import create_engine
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import db, User, Post, Song
+from models.routing import REPLICA_BIND, TimedQueuePool, engine_options, pool_stats
+from views.metrics import metrics
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app, CURR_USER_KEY, PRIMARY_UNTIL_KEY
+
+db.drop_all()
+db.create_all()
+
+
+class EnginePoolTestCase(TestCase):
+    """Tests for pool settings and checkout wait metric."""
+
+    def test_engine_options(self):
+        """Tests that pool settings come from the environment, except on SQLite."""
+
+        self.assertEqual(engine_options('sqlite:///melomap.db'), {})
+
+        with mock.patch.dict(os.environ, {'DB_POOL_SIZE': '20', 'DB_POOL_PRE_PING': '0'}):
+            options = engine_options('postgresql:///melomap')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertFalse(options['pool_pre_ping'])
+
+    def test_checkout_wait_recorded(self):
+        """Tests that each pool checkout records its wait under the pool's name."""
+
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_logging_name='testpool')
+        metrics.reset()
+        with engine.connect():
+            self.assertEqual(pool_stats(engine)['checked_out'], 1)
+        engine.execute('SELECT 1')
+
+        timings = metrics.snapshot()['timings']
+        self.assertEqual(timings['db.testpool.checkout_wait_ms']['count'], 2)
+        engine.dispose()
+
+
+class MetricsRouteTestCase(TestCase):
+    """Tests that /metrics is only served when enabled."""
+
+    def test_metrics_hidden_by_default(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get('/metrics').status_code, 404)
+
+            with mock.patch.dict(app.config, {'METRICS_ENABLED': True}):
+                resp = client.get('/metrics')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('timings', resp.json)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Tests that read-only routes read the replica and writes the primary."""
+
+    def setUp(self):
+        """Create a replica database holding different songs than the primary."""
+
+        Post.query.delete()
+        User.query.delete()
+        Song.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup(email='test@email.com', username='testuser1', password='testing')
+        song = Song(title='Primary song', artists='Test artists',
+                    spotify_track_id='primary', spotify_url='spotify.com/primary',
+                    post_count=1)
+        db.session.add(song)
+        db.session.commit()
+        self.id1, self.songid = user.id, song.id
+
+        fd, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        replica = create_engine(f'sqlite:///{self.replica_path}')
+        db.metadata.create_all(replica)
+        replica.execute(User.__table__.insert(),
+                        id=self.id1, email='test@email.com', username='testuser1',
+                        password='x', post_count=0)
+        replica.execute(Song.__table__.insert(),
+                        id=self.songid + 1000, title='Replica song', artists='Test artists',
+                        spotify_track_id='replica', spotify_url='spotify.com/replica',
+                        post_count=1, bookmark_count=0)
+        replica.dispose()
+
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: f'sqlite:///{self.replica_path}'}
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        if REPLICA_BIND in get_state(app).connectors:
+            db.get_engine(app, REPLICA_BIND).dispose()
+            del get_state(app).connectors[REPLICA_BIND]
+        app.config.pop('SQLALCHEMY_BINDS')
+        os.remove(self.replica_path)
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.id1
+
+    def test_read_only_route_uses_replica(self):
+        """Tests that read-only routes query the replica."""
+
+        with self.client as c:
+            self.login(c)
+
+            html = c.get('/songs/most-posted').get_data(as_text=True)
+            self.assertIn('Replica song', html)
+            self.assertNotIn('Primary song', html)
+
+    def test_reads_follow_writes(self):
+        """Tests that writes go to the primary, and the browser's reads
+        stay there until the replica has caught up."""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.post(f'/bookmark/{self.songid}')
+            self.assertTrue(resp.json['bookmarked'])
+
+            html = c.get('/songs/most-bookmarked').get_data(as_text=True)
+            self.assertIn('Primary song', html)
+
+            with c.session_transaction() as sess:
+                self.assertIn(PRIMARY_UNTIL_KEY, sess)
+                sess[PRIMARY_UNTIL_KEY] = 0
+
+            html = c.get('/songs/most-bookmarked').get_data(as_text=True)
+            self.assertNotIn('Primary song', html)
@@ -0,0 +1,160 @@
+"""Song and user search tests"""
+
+import os, sys
+from unittest import TestCase, mock
+
+from sqlalchemy.dialects import postgresql
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import db, User, Post, Song
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app, CURR_USER_KEY
+from views import search
+from views.search import has_trigrams, search_songs, search_users
+
+db.drop_all()
+db.create_all()
+
+
+class SearchTestCase(TestCase):
+    """Tests for searching and paging songs and users."""
+
+    def setUp(self):
+        """Create users and songs to search."""
+
+        Post.query.delete()
+        User.query.delete()
+        Song.query.delete()
+
+        self.client = app.test_client()
+
+        for i in range(30):
+            db.session.add(Song(title=f'Ocean song {i}' if i % 2 else f'Desert song {i}',
+                                album='Blue album' if i < 5 else None,
+                                artists='Wave artists',
+                                spotify_track_id=f'search{i}',
+                                spotify_url=f'spotify.com/search{i}'))
+        db.session.add(Song(title='100% pure',
+                            artists='Percent artists',
+                            spotify_track_id='percent',
+                            spotify_url='spotify.com/percent'))
+
+        # hash once, signing up 30 users would hash 30 times
+        password = User.hash_pw('testing')
+        self.users = [User(email=f'search{i}@email.com',
+                           username=f'searcher{i:02}',
+                           password=password) for i in range(30)]
+        db.session.add_all(self.users)
+        self.users[0].name = 'Ocean Lover'
+        db.session.commit()
+        self.id1 = self.users[0].id
+
+    def tearDown(self):
+        response = super().tearDown()
+        db.session.rollback()
+        return response
+
+    def test_search_songs_columns(self):
+        """Tests that songs match on title, album or artists."""
+
+        songs, has_more = search_songs('Ocean')
+        self.assertEqual(len(songs), 15)
+        self.assertFalse(has_more)
+
+        songs, _ = search_songs('blue ALBUM')
+        self.assertEqual({song.spotify_track_id for song in songs},
+                         {f'search{i}' for i in range(5)})
+
+        songs, _ = search_songs('percent')
+        self.assertEqual([song.title for song in songs], ['100% pure'])
+
+    def test_wildcards_escaped(self):
+        """Tests that % and _ in a search match themselves only."""
+
+        songs, _ = search_songs('%')
+        self.assertEqual([song.title for song in songs], ['100% pure'])
+        self.assertEqual(search_songs('_')[0], [])
+
+    def test_search_pages(self):
+        """Tests that pages don't overlap and has_more ends paging."""
+
+        page1, more1 = search_songs('song', page=0, per_page=20)
+        page2, more2 = search_songs('song', page=1, per_page=20)
+        self.assertTrue(more1)
+        self.assertFalse(more2)
+        self.assertEqual(len(page1) + len(page2), 30)
+        self.assertFalse(set(page1) & set(page2))
+
+    def test_empty_search_users_paged(self):
+        """Tests that an empty search pages users instead of loading all."""
+
+        users, has_more = search_users('', per_page=24)
+        self.assertEqual(len(users), 24)
+        self.assertTrue(has_more)
+        self.assertEqual(users[0].username, 'searcher00')
+
+        users, has_more = search_users('ocean lover')
+        self.assertEqual(users, [self.users[0]])
+
+    def test_loadmore_routes(self):
+        """Tests that load-more routes send following page number until the end."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+
+            resp = c.get('/search')
+            html = resp.get_data(as_text=True)
+            self.assertIn('load-more-songs', html)
+            self.assertIn('load-more-users', html)
+
+            resp = c.get('/loadmore/songs?q=song&page=1')
+            self.assertEqual(resp.get_data(as_text=True).count('class="title'), 10)
+            self.assertNotIn('X-Next-Page', resp.headers)
+
+            resp = c.get('/loadmore/users?q=&page=1')
+            self.assertEqual(resp.get_data(as_text=True).count('card-title'), 6)
+            self.assertNotIn('X-Next-Page', resp.headers)
+
+            # page 0 is the search page itself, sends page 1
+            resp = c.get('/loadmore/songs?q=song&page=0')
+            self.assertEqual(resp.get_data(as_text=True).count('class="title'), 10)
+
+            with mock.patch('app.search_songs',
+                            side_effect=lambda q, page: search_songs(q, page, per_page=5)):
+                resp = c.get('/loadmore/songs?q=song&page=1')
+            self.assertEqual(resp.headers['X-Next-Page'], '2')
+
+    def test_postgres_without_trigrams(self):
+        """Tests that Postgres search orders by ts_rank alone when pg_trgm
+        is missing (migration 0005 not run)."""
+
+        with mock.patch('views.search.uses_postgres', return_value=True), \
+             mock.patch('views.search.has_trigrams', return_value=False), \
+             mock.patch('views.search.paginate') as paginate:
+            search_songs('ocean')
+            search_users('ocean')
+
+        (songs_query, _, _), (users_query, _, _) = [call.args for call in paginate.call_args_list]
+        songs_sql = str(songs_query.statement.compile(dialect=postgresql.dialect()))
+        users_sql = str(users_query.statement.compile(dialect=postgresql.dialect()))
+        self.assertIn('ts_rank', songs_sql)
+        self.assertNotIn('similarity', songs_sql)
+        self.assertNotIn('similarity', users_sql)
+
+    def test_missing_trigrams_rechecked(self):
+        """Tests that a database found without pg_trgm is checked again,
+        and one found with it isn't."""
+
+        self.addCleanup(search._trigram_support.clear)
+        with mock.patch.object(db.session, 'execute') as execute:
+            execute.return_value.scalar.side_effect = [None, 1]
+            self.assertFalse(has_trigrams())
+            self.assertTrue(has_trigrams())
+            self.assertTrue(has_trigrams())
+
+        self.assertEqual(execute.call_count, 2)
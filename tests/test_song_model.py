@@ -2,15 +2,16 @@
 
 import os, sys
 from unittest import TestCase
-from sqlalchemy import exc
+from sqlalchemy import exc, event
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from models.models import db, User, Post, Song
+from models.models import db, User, Post, Song, recount_counters
 from flask_bcrypt import Bcrypt
 bcrypt = Bcrypt()
 
 os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
 
 from app import app
 
@@ -149,6 +150,85 @@ class SongModelTestCase(TestCase):
             db.session.add_all(Song.create_song(invalid_song_obj2))
             db.session.commit()
 
+    def test_resolve_songs(self):
+        """Tests that resolve_songs finds existing songs and inserts
+        missing ones in a fixed number of statements."""
+
+        song_objs = [{
+            'title': f'Resolved song {i}',
+            'artists': 'Artists',
+            'album': None,
+            'album_year': None,
+            'spotify_track_id': track_id,
+            'spotify_url': f'spotify.com/{track_id}',
+            'image_url': None,
+            'audio_url': None
+        } for i, track_id in enumerate(['r1', '12345', 'r2', 'r3', 'r1'])]
+
+        statements = []
+        def count_statement(*args):
+            statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            songs = Song.resolve_songs(song_objs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        # SELECT existing, INSERT missing, SELECT inserted
+        self.assertEqual(len(statements), 3)
+        self.assertEqual([song.spotify_track_id for song in songs],
+                         ['r1', '12345', 'r2', 'r3'])
+        self.assertEqual(songs[1], self.test_song)
+
+        db.session.commit()
+        self.assertEqual(Song.query.count(), 4)
+        # resolving again adds nothing
+        self.assertEqual(Song.resolve_songs(song_objs), songs)
+        self.assertEqual(Song.query.count(), 4)
+
+    def test_duplicate_track_id(self):
+        """Tests that a track can only be saved once."""
+
+        with self.assertRaises(exc.IntegrityError):
+            db.session.add(Song(title='Same track',
+                                artists='Test artists',
+                                spotify_track_id='12345',
+                                spotify_url='spotify.com/testsong'))
+            db.session.commit()
+
+    def test_recount_counters(self):
+        """Tests that repair job fixes counters that drifted, and only those."""
+
+        # added through ORM collections, which don't maintain counters
+        self.user1.bookmarked_songs.append(self.test_song)
+        db.session.commit()
+        self.assertEqual(self.test_song.post_count, 0)
+
+        self.assertEqual(recount_counters(), {'songs': 1, 'users': 1})
+        db.session.commit()
+        self.assertEqual(self.test_song.post_count, 1)
+        self.assertEqual(self.test_song.bookmark_count, 1)
+        self.assertEqual(self.user1.post_count, 1)
+
+        self.assertEqual(recount_counters(), {'songs': 0, 'users': 0})
+
+    def test_most_popular_songs(self):
+        """Tests that popular songs are ordered by counters, skipping zeros."""
+
+        songs = [Song(title=f'Popular song {i}',
+                      artists='Test artists',
+                      spotify_track_id=f'popular{i}',
+                      spotify_url=f'spotify.com/popular{i}') for i in range(3)]
+        db.session.add_all(songs)
+        db.session.commit()
+
+        Song.adjust_counts('bookmark_count', {songs[0].id: 2, songs[1].id: 5})
+        Song.adjust_counts('post_count', {songs[2].id: 1})
+        db.session.commit()
+
+        self.assertEqual(Song.most_bookmarked(), [songs[1], songs[0]])
+        self.assertEqual(Song.most_posted(limit=1), [songs[2]])
+
     ############## Relationship Tests
     def test_user_bookmarked_songs(self):
 
@@ -0,0 +1,124 @@
+"""Spotify token manager tests"""
+
+import os, sys
+import threading
+import time
+from unittest import TestCase
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from views.spotify_token import SpotifyTokenManager
+
+
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SpotifyTokenManagerTestCase(TestCase):
+    """Tests for caching and refreshing Spotify tokens."""
+
+    def setUp(self):
+        """Create manager with a counting fake token endpoint."""
+
+        self.calls = 0
+        self.clock = FakeClock()
+
+        def fetch_token():
+            self.calls += 1
+            return {'access_token': f'token-{self.calls}', 'expires_in': 3600}
+
+        self.manager = SpotifyTokenManager(fetch_token,
+                                           refresh_margin=300,
+                                           clock=self.clock)
+
+    def test_token_cached(self):
+        """Tests that token is only requested once while valid."""
+
+        self.assertEqual(self.manager.get_token(), 'token-1')
+        self.assertEqual(self.manager.get_token(), 'token-1')
+        self.assertEqual(self.calls, 1)
+
+        stats = self.manager.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['refreshes'], 1)
+
+    def test_expired_token_refreshed(self):
+        """Tests that an expired token is replaced before being returned."""
+
+        self.manager.get_token()
+        self.clock.now += 3601
+
+        self.assertEqual(self.manager.get_token(), 'token-2')
+        self.assertEqual(self.manager.stats()['misses'], 2)
+
+    def test_background_refresh(self):
+        """Tests that a token close to expiry is still returned
+        while a new one is fetched in the background."""
+
+        self.manager.get_token()
+        self.clock.now += 3400
+
+        self.assertEqual(self.manager.get_token(), 'token-1')
+
+        # wait for background thread to swap in the new token
+        for _ in range(100):
+            if self.calls == 2 and not self.manager._refreshing:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(self.manager.get_token(), 'token-2')
+        self.assertEqual(self.calls, 2)
+
+    def test_hits_not_held_by_background_refresh(self):
+        """Tests that cached tokens are returned while a background
+        refresh is still waiting on Spotify."""
+
+        release = threading.Event()
+        def fetch_token():
+            self.calls += 1
+            if self.calls > 1:
+                release.wait(5)
+            return {'access_token': f'token-{self.calls}', 'expires_in': 3600}
+
+        manager = SpotifyTokenManager(fetch_token, refresh_margin=300, clock=self.clock)
+        manager.get_token()
+        self.clock.now += 3400
+        self.assertEqual(manager.get_token(), 'token-1')
+
+        # refresh is blocked in fetch_token, hits still return right away
+        tokens = []
+        reader = threading.Thread(target=lambda: tokens.extend(manager.get_token() for _ in range(3)))
+        reader.start()
+        reader.join(1)
+        release.set()
+
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(tokens, ['token-1'] * 3)
+        self.assertEqual(self.calls, 2)
+
+    def test_concurrent_callers_share_refresh(self):
+        """Tests that callers arriving together trigger one token request."""
+
+        def slow_fetch():
+            self.calls += 1
+            time.sleep(0.05)
+            return {'access_token': 'shared', 'expires_in': 3600}
+
+        manager = SpotifyTokenManager(slow_fetch)
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(manager.get_token()))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ['shared'] * 10)
+        self.assertEqual(self.calls, 1)
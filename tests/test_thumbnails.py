@@ -0,0 +1,152 @@
+"""Sized image copy tests"""
+
+import io
+import os, sys
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from flask import get_template_attribute
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import db, User, Post
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app
+from views.storage import LocalStorage
+from views import thumbnails
+from views.thumbnails import (POST_WIDTHS, make_variants, submit_variants, variant_key,
+                              variant_widths, has_variants)
+
+db.drop_all()
+db.create_all()
+
+
+def photo_bytes(size):
+    """Returns a JPEG photo of size with EXIF data"""
+
+    exif = Image.Exif()
+    exif[0x010F] = 'Test camera'
+    data = io.BytesIO()
+    Image.new('RGB', size, 'teal').save(data, 'JPEG', exif=exif)
+    return data.getvalue()
+
+
+class ThumbnailsTestCase(TestCase):
+    """Tests for making sized copies and listing them in srcset."""
+
+    def setUp(self):
+        """Use scratch local storage served from /static."""
+
+        Post.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.storage = LocalStorage(tempfile.mkdtemp())
+        self.app_storage = app.extensions['storage']
+        app.extensions['storage'] = self.storage
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions['storage'] = self.app_storage
+        shutil.rmtree(self.storage.root)
+
+    def test_make_variants(self):
+        """Tests that copies are resized (never enlarged, the original's
+        width standing in for wider ones), in WebP and JPEG, without EXIF."""
+
+        self.storage.put('post-images/photo.jpg', photo_bytes((1000, 500)))
+        keys = make_variants(self.storage, 'post-images/photo.jpg', POST_WIDTHS)
+
+        self.assertEqual(len(keys), 6)
+        self.assertIn('post-images/thumbs/photo.jpg.480.webp', keys)
+        self.assertNotIn('post-images/thumbs/photo.jpg.1440.jpg', keys)
+        self.assertTrue(has_variants(self.storage, 'post-images/photo.jpg'))
+        self.assertEqual(variant_widths(self.storage, 'post-images/photo.jpg'), (480, 960, 1000))
+        expected = {480: (480, 240), 960: (960, 480), 1000: (1000, 500)}
+        for width, size in expected.items():
+            with self.storage.open(variant_key('post-images/photo.jpg', width, 'webp')) as file:
+                with Image.open(file) as img:
+                    self.assertEqual((img.format, img.size), ('WEBP', size))
+            with self.storage.open(variant_key('post-images/photo.jpg', width, 'jpg')) as file:
+                with Image.open(file) as img:
+                    self.assertEqual((img.format, img.size), ('JPEG', size))
+                    self.assertEqual(len(img.getexif()), 0)
+
+        self.storage.put('post-images/small.jpg', photo_bytes((300, 200)))
+        make_variants(self.storage, 'post-images/small.jpg', POST_WIDTHS)
+        self.assertEqual(variant_widths(self.storage, 'post-images/small.jpg'), (300,))
+
+    def test_submit_without_pool(self):
+        """Tests that copies made in the caller's thread (no pool running)
+        are made outside the pool lock, and a second submit of the same
+        image waits on the first one's Future."""
+
+        started, release = threading.Event(), threading.Event()
+        def slow_make_variants(storage, key, widths):
+            started.set()
+            release.wait(5)
+            return [key]
+
+        with mock.patch.object(thumbnails, '_pool', None), \
+             mock.patch.object(thumbnails, 'make_variants', side_effect=slow_make_variants):
+            first = threading.Thread(target=submit_variants,
+                                     args=(self.storage, 'post-images/photo.jpg', POST_WIDTHS))
+            first.start()
+            started.wait(5)
+
+            self.assertFalse(thumbnails._pool_lock.locked())
+            future = submit_variants(self.storage, 'post-images/photo.jpg', POST_WIDTHS)
+            release.set()
+            first.join()
+
+        self.assertEqual(future.result(5), ['post-images/photo.jpg'])
+
+    def test_picture_srcset(self):
+        """Tests that pictures list copies in srcset once they exist."""
+
+        stored = self.storage.save(io.BytesIO(photo_bytes((1000, 500))), 'photo.jpg')
+
+        with app.test_request_context():
+            picture = get_template_attribute('image-macro.html', 'picture')
+            html = str(picture('post-images', stored.key, '720px', img_class='post-img'))
+            self.assertNotIn('srcset', html)
+            self.assertIn(f'src="/static/{stored.key}"', html)
+
+            make_variants(self.storage, stored.key, POST_WIDTHS)
+            html = str(picture('post-images', stored.key, '720px', img_class='post-img'))
+
+        folder, filename = stored.key.rsplit('/', 1)
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn(f'/static/{folder}/thumbs/{filename}.480.webp 480w', html)
+        self.assertIn(' 1000w', html)
+        self.assertNotIn(' 1440w', html)
+        self.assertIn(f'src="/static/{folder}/thumbs/{filename}.960.jpg"', html)
+
+    def test_backfill(self):
+        """Tests that backfill makes copies of post and profile images
+        without them, skipping missing files and images already done."""
+
+        stored = self.storage.save(io.BytesIO(photo_bytes((800, 600))), 'photo.jpg')
+        self.storage.put('profile-images/me.jpg', photo_bytes((300, 300)))
+        user = User.signup(email='thumbs@email.com', username='thumbs', password='testing')
+        user.profile_image = 'me.jpg'
+        user.posts.append(Post(image=stored.key))
+        user.posts.append(Post(image='missing.jpg'))
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['thumbnails-backfill'])
+        self.assertIn('Made sized copies of 2 images (0 failed, 0 already done, 1 missing)',
+                      result.output)
+        self.assertTrue(has_variants(self.storage, 'profile-images/me.jpg'))
+        self.assertTrue(has_variants(self.storage, stored.key))
+
+        result = runner.invoke(args=['thumbnails-backfill'])
+        self.assertIn('Made sized copies of 0 images (0 failed, 2 already done, 1 missing)',
+                      result.output)
@@ -0,0 +1,262 @@
+"""Background upload job tests"""
+
+import os, sys
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from models.models import db, User, Post, Song, UploadJob, UploadedImage
+
+os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
+
+from app import app, CURR_USER_KEY, start_background_work
+from views import thumbnails, upload_jobs
+from views.upload_jobs import enqueue_upload, MAX_ATTEMPTS
+from views.storage import LocalStorage
+from views.thumbnails import POST_WIDTHS, ensure_variants, has_variants
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+SONG_DATA = [{
+    'title': f'Job song {i}',
+    'album': 'Job album',
+    'album_year': '2024',
+    'artists': 'Job artists',
+    'spotify_track_id': f'job{i}',
+    'spotify_url': f'spotify.com/job{i}',
+    'image_url': None,
+    'audio_url': None
+} for i in range(3)]
+
+
+class UploadJobTestCase(TestCase):
+    """Tests for queuing and processing uploaded posts (APIs mocked)."""
+
+    def setUp(self):
+        """Create user with a pending post and its queued job."""
+
+        UploadJob.query.delete()
+        UploadedImage.query.delete()
+        Post.query.delete()
+        User.query.delete()
+        Song.query.delete()
+
+        self.client = app.test_client()
+
+        # storage with a copy of test image for jobs to read, and make
+        # sized copies of
+        self.upload_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.upload_dir, 'post-images'))
+        shutil.copy('test_image.jpeg', os.path.join(self.upload_dir, 'post-images'))
+        self.storage = LocalStorage(self.upload_dir)
+        self.app_storage = app.extensions['storage']
+        app.extensions['storage'] = self.storage
+
+        self.user1 = User.signup(email='test@email.com',
+                                 username='testuser1',
+                                 password='testing')
+        self.post = Post(image='test_image.jpeg', status='pending')
+        self.user1.posts.append(self.post)
+        enqueue_upload(self.post)
+        db.session.commit()
+
+        self.id1 = self.user1.id
+        self.postid = self.post.id
+
+    def tearDown(self):
+        response = super().tearDown()
+        db.session.rollback()
+        app.extensions['storage'] = self.app_storage
+        shutil.rmtree(self.upload_dir)
+        return response
+
+    def run_next_job(self):
+        """Runs one job inside an app context, like the worker does"""
+
+        with app.app_context():
+            return upload_jobs.run_next_job()
+
+    def test_job_makes_post_ready(self):
+        """Tests that processing a job adds songs and marks post ready."""
+
+        with mock.patch.object(upload_jobs, 'request_keywords', return_value=['a', 'b', 'c']), \
+             mock.patch.object(upload_jobs, 'get_list_of_tracks', return_value=SONG_DATA):
+            self.assertTrue(self.run_next_job())
+            self.assertFalse(self.run_next_job())
+
+        post = Post.query.get(self.postid)
+        job = UploadJob.query.filter_by(post_id=self.postid).one()
+        self.assertEqual(post.status, 'ready')
+        self.assertEqual(len(post.songs), 3)
+        self.assertEqual([song.post_count for song in post.songs], [1, 1, 1])
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.attempts, 1)
+        # keywording preprocessing recorded for upload
+        self.assertEqual(job.original_bytes, os.path.getsize('test_image.jpeg'))
+        self.assertLessEqual(job.keyword_bytes, job.original_bytes)
+        self.assertIsNotNone(job.preprocess_ms)
+        # sized copies made before post is shown
+        self.assertTrue(has_variants(self.storage, 'post-images/test_image.jpeg'))
+
+    def test_failed_job_retried(self):
+        """Tests that a failed job is requeued with backoff,
+        then fails the post after MAX_ATTEMPTS."""
+
+        with mock.patch.object(upload_jobs, 'request_keywords', return_value=None):
+            self.assertTrue(self.run_next_job())
+
+            job = UploadJob.query.filter_by(post_id=self.postid).one()
+            self.assertEqual(job.status, 'queued')
+            self.assertGreater(job.run_after, datetime.now())
+            self.assertIn('no keywords', job.last_error)
+            # not due yet
+            self.assertFalse(self.run_next_job())
+
+            for _ in range(MAX_ATTEMPTS - 1):
+                job = UploadJob.query.filter_by(post_id=self.postid).one()
+                job.run_after = datetime.now() - timedelta(seconds=1)
+                db.session.commit()
+                self.assertTrue(self.run_next_job())
+
+        job = UploadJob.query.filter_by(post_id=self.postid).one()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, MAX_ATTEMPTS)
+        self.assertEqual(Post.query.get(self.postid).status, 'failed')
+
+    def test_stale_job_reclaimed(self):
+        """Tests that a job left running by a crashed worker is picked up again."""
+
+        job = UploadJob.query.filter_by(post_id=self.postid).one()
+        job.status = 'running'
+        job.locked_at = datetime.now() - timedelta(hours=1)
+        db.session.commit()
+
+        with mock.patch.object(upload_jobs, 'request_keywords', return_value=['a']), \
+             mock.patch.object(upload_jobs, 'get_list_of_tracks', return_value=SONG_DATA[:1]):
+            self.assertTrue(self.run_next_job())
+
+        self.assertEqual(Post.query.get(self.postid).status, 'ready')
+
+    def test_pending_post_status(self):
+        """Tests that results page and status route show a pending post."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+
+            resp = c.get(f'/posts/{self.postid}')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('pending-post', html)
+
+            resp = c.get(f'/posts/{self.postid}/status')
+            self.assertEqual(resp.json['status'], 'pending')
+
+            # pending posts stay out of the feed
+            resp = c.get('/')
+            self.assertNotIn(f'id = "{self.postid}"', resp.get_data(as_text=True))
+
+    def test_keywords_reused(self):
+        """Tests that keywords saved for an earlier upload of the same
+        photo are used without calling the image API."""
+
+        image = UploadedImage(sha256='a' * 64, filename='test_image.jpeg',
+                              keywords=['sky', 'sea'])
+        job = UploadJob.query.filter_by(post_id=self.postid).one()
+        job.image = image
+        db.session.commit()
+
+        with mock.patch.object(upload_jobs, 'request_keywords') as request_keywords, \
+             mock.patch.object(upload_jobs, 'get_list_of_tracks', return_value=SONG_DATA) as get_tracks:
+            self.assertTrue(self.run_next_job())
+
+        request_keywords.assert_not_called()
+        get_tracks.assert_called_once_with(['sky', 'sea'])
+        self.assertEqual(Post.query.get(self.postid).status, 'ready')
+
+    def test_find_similar_image(self):
+        """Tests near-duplicate lookup by perceptual hash distance."""
+
+        image = UploadedImage(sha256='b' * 64, filename='test_image.jpeg',
+                              phash='4adb25d9b1f47474', keywords=['sky'])
+        db.session.add(image)
+        db.session.commit()
+
+        # 2 bits apart
+        self.assertEqual(UploadedImage.find_similar('4bd925d9b1f47474'), image)
+        # 4 bits apart, one in each 16-bit quarter of the hash
+        self.assertEqual(UploadedImage.find_similar('5adb35d9a1f46474'), image)
+        # every band different
+        self.assertIsNone(UploadedImage.find_similar('b524da264e0b8b8b'))
+
+    def test_find_similar_closest_image(self):
+        """Tests that the closest near-duplicate is returned, not the
+        first one sharing a band."""
+
+        farther = UploadedImage(sha256='b' * 64, filename='far.jpeg',
+                                phash='5adb35d9a1f46474', keywords=['sea'])
+        closer = UploadedImage(sha256='c' * 64, filename='near.jpeg',
+                               phash='4bd925d9b1f47474', keywords=['sky'])
+        db.session.add_all([farther, closer])
+        db.session.commit()
+
+        self.assertEqual(UploadedImage.find_similar('4adb25d9b1f47474'), closer)
+
+    def test_upload_queues_job(self):
+        """Tests that uploading a photo creates a pending post and job
+        without calling the APIs, and same photo is stored once."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+
+            for description in ['queued post', 'same photo again']:
+                with open('test_image.jpeg', 'rb') as img:
+                    resp = c.post('/posts/upload',
+                                  data={'description': description,
+                                        'image': (img, 'test_image.jpeg')},
+                                  content_type='multipart/form-data')
+                self.assertEqual(resp.status_code, 302)
+
+        post1 = Post.query.filter_by(description='queued post').one()
+        post2 = Post.query.filter_by(description='same photo again').one()
+        self.assertEqual(post1.status, 'pending')
+        self.assertEqual(User.query.get(self.id1).post_count, 2)
+        self.assertEqual(UploadJob.query.filter_by(post_id=post1.id).one().status, 'queued')
+
+        # identical bytes share one stored file (keyed by content) and image record
+        self.assertEqual(post1.image, post2.image)
+        image = UploadedImage.query.one()
+        self.assertEqual(post1.image, f'uploads/{image.sha256[:2]}/{image.sha256[2:4]}/'
+                                      f'{image.sha256}.jpg')
+        # sized copies started by the upload
+        self.assertTrue(ensure_variants(self.storage, post1.image, POST_WIDTHS, timeout=30))
+        shard = os.path.dirname(self.storage.path(post1.image))
+        self.assertEqual(sorted(os.listdir(shard)), [f'{image.sha256}.jpg', 'thumbs'])
+
+    def test_background_work_only_when_serving(self):
+        """Tests that CLI commands don't start worker threads or the
+        thumbnail pool, which are started for serving requests."""
+
+        threads = app.config['UPLOAD_WORKER_THREADS']
+        app.config['UPLOAD_WORKER_THREADS'] = 1
+        try:
+            with mock.patch('app.start_upload_workers') as start_workers, \
+                 mock.patch.object(thumbnails, 'start_thumbnail_pool') as start_pool:
+                result = app.test_cli_runner().invoke(args=['repair-counters'])
+                self.assertIn('Fixed counters', result.output)
+                start_workers.assert_not_called()
+                start_pool.assert_not_called()
+
+                start_background_work()
+                start_workers.assert_called_once_with(app, 1)
+                start_pool.assert_called_once_with(app.config['THUMBNAIL_PROCESSES'])
+        finally:
+            app.config['UPLOAD_WORKER_THREADS'] = threads
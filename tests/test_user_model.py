@@ -2,15 +2,16 @@
 
 import os, sys
 from unittest import TestCase
-from sqlalchemy import exc
+from sqlalchemy import exc, event
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from models.models import db, User, Post, Song
+from models.models import db, User, Post, Song, BookmarkedSongs
 from flask_bcrypt import Bcrypt
 bcrypt = Bcrypt()
 
 os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
 
 from app import app
 
@@ -98,6 +99,57 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(self.user1.bookmarked_songs), 1)
         self.assertEqual(self.user1.bookmarked_songs[0].title, 'Test song')
 
+    def test_bookmarked_song_ids(self):
+        """Tests that bookmarked_song_ids returns IDs of bookmarked songs only"""
+
+        songs = [Song(title=f'Test song {i}',
+                      artists='Test artists',
+                      spotify_track_id=f'ids{i}',
+                      spotify_url=f'spotify.com/ids{i}') for i in range(3)]
+        db.session.add_all(songs)
+        self.user1.bookmarked_songs.extend(songs[:2])
+        db.session.commit()
+
+        self.assertEqual(self.user1.bookmarked_song_ids(), {songs[0].id, songs[1].id})
+
+    def test_toggle_bookmark(self):
+        """Tests that toggle adds then removes a bookmark and updates song's
+        bookmark counter with a fixed number of statements, however many
+        songs user has bookmarked."""
+
+        songs = [Song(title=f'Test song {i}',
+                      artists='Test artists',
+                      spotify_track_id=f'toggle{i}',
+                      spotify_url=f'spotify.com/toggle{i}') for i in range(50)]
+        db.session.add_all(songs)
+        self.user1.bookmarked_songs.extend(songs[1:])
+        db.session.commit()
+        user_id, song_id = self.user1.id, songs[0].id
+
+        statements = []
+        def record_statement(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            self.assertTrue(BookmarkedSongs.toggle(user_id, song_id))
+            # delete finding nothing, insert, counter update
+            self.assertEqual(len(statements), 3)
+            db.session.commit()
+            self.assertEqual(Song.query.get(song_id).bookmark_count, 1)
+
+            del statements[:]
+            self.assertFalse(BookmarkedSongs.toggle(user_id, song_id))
+            # delete, counter update
+            self.assertEqual(len(statements), 2)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+        db.session.commit()
+
+        self.assertEqual(Song.query.get(song_id).bookmark_count, 0)
+        self.assertFalse(any(sql.lstrip().upper().startswith('SELECT') for sql in statements))
+        self.assertEqual(len(self.user1.bookmarked_song_ids()), 49)
+
     ############## Signup Tests
     def test_valid_signup(self):
         """Tests class method signup works as expected."""
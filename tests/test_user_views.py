@@ -3,15 +3,17 @@
 import os, sys
 from unittest import TestCase
 from flask import g
-from sqlalchemy import exc
+from sqlalchemy import exc, event
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from models.models import db, User, Post, Song
 
 os.environ['DATABASE_URL'] = "postgresql:///melomap-test"
+os.environ['UPLOAD_WORKER_THREADS'] = '0'
 
 from app import app, CURR_USER_KEY
+from views.identity import identity_cache, CurrentUser
 
 app.config['WTF_CSRF_ENABLED'] = False
 
@@ -201,6 +203,55 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp2.status_code, 404)
             self.assertIn('404. Page not found', html2)
 
+    ############## Identity Tests
+    def test_slim_identity(self):
+        """Tests that g.user is a slim identity, selected by id, username
+        and profile image once, then cached for following requests."""
+
+        identity_cache.clear()
+        statements = []
+        def record_statement(*args):
+            statements.append(args[2])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+
+            db.session.remove()
+            event.listen(db.engine, 'before_cursor_execute', record_statement)
+            try:
+                c.get('/posts/0/status')
+                self.assertIsInstance(g.user, CurrentUser)
+                self.assertEqual(g.user.username, 'testuser1')
+                self.assertEqual(len(statements), 2)
+                self.assertNotIn('bio', statements[0])
+
+                del statements[:]
+                c.get('/posts/0/status')
+                self.assertEqual(g.user.id, self.id1)
+                self.assertEqual(len(statements), 1)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+            self.assertIsInstance(g.user.load(), User)
+            self.assertEqual(g.user.load().bio, None)
+
+    def test_edit_refreshes_identity(self):
+        """Tests that cached identity is dropped when user edits profile."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.id1
+
+            c.get('/')
+            data = {'email': 'test@email.com',
+                    'username': 'renameduser',
+                    'password': 'testing'}
+            c.post('/user/edit', data=data, content_type='multipart/form-data')
+
+            c.get('/')
+            self.assertEqual(g.user.username, 'renameduser')
+
     ############## Edit Profile Tests
     def test_edit_profile(self):
         """Tests edit profile route works as expected."""
@@ -350,6 +401,11 @@ class UserViewsTestCase(TestCase):
 
             self.assertEqual(post_resp2.status_code, 200)
             self.assertEqual('removed', message2)
+            self.assertFalse(post_resp2.json['bookmarked'])
+
+        # song that doesn't exist
+            post_resp3 = c.post('/bookmark/0')
+            self.assertEqual(post_resp3.status_code, 404)
 
     def test_displays_bookmarking_songs(self):
         """Tests that (un)bookmarked songs are (un)displayed."""
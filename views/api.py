@@ -0,0 +1,188 @@
+"""Payloads of the JSON API (/api/v1)
+
+Pages are built from column-only queries, so rows are plain tuples
+serialized straight to dicts, never ORM objects or templates. Songs and
+users shared by several posts are sent once, keyed by id, and fields
+that are null are left out. Uploaded images come with their URL and the
+widths of their sized copies, so clients can build srcset."""
+
+import json
+
+from flask import current_app
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import aliased
+
+from models.models import db, User, Post, Song, PostSongs, BookmarkedSongs
+from views.pagination import encode_post_cursor, encode_int_cursor
+from views.search import search_songs, search_users
+from views.storage import current_storage, image_key
+from views.thumbnails import variant_widths
+
+POSTS_PER_PAGE = 10
+BOOKMARKS_PER_PAGE = 20
+
+POST_COLUMNS = (Post.id, Post.user_id, Post.description, Post.image,
+                Post.status, Post.timestamp)
+SONG_COLUMNS = (Song.id, Song.title, Song.artists, Song.album, Song.album_year,
+                Song.spotify_url, Song.image_url, Song.audio_url)
+USER_COLUMNS = (User.id, User.username, User.name, User.profile_image, User.post_count)
+
+
+def json_response(payload, status=200):
+    """Returns response with payload as compact JSON"""
+
+    return current_app.response_class(json.dumps(payload, separators=(',', ':')),
+                                      status=status, mimetype='application/json')
+
+
+def compact(row):
+    """Returns dict of row's non-null fields"""
+
+    return {key: value for key, value in row._asdict().items() if value is not None}
+
+
+def compact_song(song):
+    """Returns dict of non-null fields of a song row from SONG_COLUMNS"""
+
+    return {column.key: value for column, value in zip(SONG_COLUMNS, song)
+            if value is not None}
+
+
+def compact_user(row):
+    """Returns dict of non-null fields of a user row from USER_COLUMNS,
+    with its profile image's URL"""
+
+    user = compact(row)
+    user.update(image_fields('profile_image', 'profile-images', row.profile_image))
+    return user
+
+
+def image_fields(name, folder, image):
+    """Returns {name_url, name_widths} of an uploaded image saved in a
+    post or user row; widths of its sized copies are left out until
+    they exist"""
+
+    storage = current_storage()
+    key = image_key(folder, image)
+    fields = {f'{name}_url': storage.url(key)}
+    widths = variant_widths(storage, key)
+    if widths:
+        fields[f'{name}_widths'] = list(widths)
+    return fields
+
+
+def viewer_bookmarks(songs, bookmarked_song_ids):
+    """Returns sorted IDs of songs bookmarked by viewer"""
+
+    if not songs:
+        return []
+    bookmarked = bookmarked_song_ids()
+    return sorted(song['id'] for song in songs if song['id'] in bookmarked)
+
+
+def page_payload(name, items, has_more, next_cursor, **extra):
+    """Returns payload of a page of items listed under name"""
+
+    return dict({name: items, 'next_cursor': next_cursor if has_more else None,
+                 'has_more': has_more}, **extra)
+
+
+def posts_payload(base_query, after, per_page, bookmarked_song_ids):
+    """Returns payload of a page of posts from base_query (POST_COLUMNS
+    ordered newest first), with their users and songs"""
+
+    rows, has_more = Post.page_after(base_query, after, per_page)
+    post_ids = [row.id for row in rows]
+    user_ids = {row.user_id for row in rows}
+
+    song_ids_by_post = {post_id: [] for post_id in post_ids}
+    song_rows = {}
+    if post_ids:
+        for post_id, *song in (db.session.query(PostSongs.post_id, *SONG_COLUMNS)
+                               .join(Song, Song.id == PostSongs.song_id)
+                               .filter(PostSongs.post_id.in_(post_ids))
+                               .order_by(PostSongs.id)):
+            song_ids_by_post[post_id].append(song[0])
+            song_rows[song[0]] = song
+    songs = {str(song_id): compact_song(song) for song_id, song in song_rows.items()}
+
+    users = {}
+    if user_ids:
+        users = {str(row.id): compact_user(row)
+                 for row in db.session.query(*USER_COLUMNS).filter(User.id.in_(user_ids))}
+
+    posts = []
+    for row in rows:
+        post = compact(row)
+        post.update(image_fields('image', 'post-images', row.image))
+        post['timestamp'] = row.timestamp.isoformat()
+        post['song_ids'] = song_ids_by_post[row.id]
+        posts.append(post)
+
+    return page_payload('posts', posts, has_more,
+                        encode_post_cursor(rows[-1]) if rows else None,
+                        users=users, songs=songs,
+                        bookmarked=viewer_bookmarks(songs.values(), bookmarked_song_ids))
+
+
+def feed_payload(after, bookmarked_song_ids, per_page=POSTS_PER_PAGE):
+    """Returns payload of a page of the feed after (timestamp, id)"""
+
+    return posts_payload(Post.feed(db.session.query(*POST_COLUMNS)),
+                         after, per_page, bookmarked_song_ids)
+
+
+def user_posts_payload(user_id, after, bookmarked_song_ids, per_page=POSTS_PER_PAGE):
+    """Returns payload of a page of user's posts after (timestamp, id)"""
+
+    query = (db.session.query(*POST_COLUMNS)
+             .filter(Post.user_id == user_id)
+             .order_by(Post.timestamp.desc(), Post.id.desc()))
+    return posts_payload(query, after, per_page, bookmarked_song_ids)
+
+
+def artists_key(song):
+    """Returns sort key of songs by artists, ignoring case like the
+    profile's bookmarks tab"""
+
+    return func.lower(func.coalesce(song.artists, ''))
+
+
+def bookmarks_payload(user_id, after, bookmarked_song_ids, per_page=BOOKMARKS_PER_PAGE):
+    """Returns payload of a page of user's bookmarked songs by artists
+    (then id), after song id after"""
+
+    query = (db.session.query(*SONG_COLUMNS)
+             .join(BookmarkedSongs, BookmarkedSongs.song_id == Song.id)
+             .filter(BookmarkedSongs.user_id == user_id)
+             .order_by(artists_key(Song), Song.id))
+    if after is not None:
+        after_song = aliased(Song)
+        after_artists = (db.session.query(artists_key(after_song))
+                         .filter(after_song.id == after)
+                         .as_scalar())
+        query = query.filter(tuple_(artists_key(Song), Song.id) > tuple_(after_artists, after))
+
+    rows = query.limit(per_page + 1).all()
+    rows, has_more = rows[:per_page], len(rows) > per_page
+    songs = [compact_song(row) for row in rows]
+    return page_payload('songs', songs, has_more,
+                        encode_int_cursor(rows[-1].id) if rows else None,
+                        bookmarked=viewer_bookmarks(songs, bookmarked_song_ids))
+
+
+def song_search_payload(search, page, bookmarked_song_ids):
+    """Returns payload of a page of songs matching search"""
+
+    rows, has_more = search_songs(search, page, query=db.session.query(*SONG_COLUMNS))
+    songs = [compact_song(row) for row in rows]
+    return page_payload('songs', songs, has_more, encode_int_cursor(page + 1),
+                        bookmarked=viewer_bookmarks(songs, bookmarked_song_ids))
+
+
+def user_search_payload(search, page):
+    """Returns payload of a page of users matching search"""
+
+    rows, has_more = search_users(search, page, query=db.session.query(*USER_COLUMNS))
+    return page_payload('users', [compact_user(row) for row in rows], has_more,
+                        encode_int_cursor(page + 1))
@@ -1,35 +1,90 @@
-import requests
+import os
+import logging
 import random
 import base64
 import urllib
-from secret import IMG_CLIENT_ID, IMG_API_KEY, SPOTIFY_CLIENT_ID, SPOTIFY_API_KEY
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from secret import IMG_CLIENT_ID, IMG_API_KEY, SPOTIFY_CLIENT_ID, SPOTIFY_API_KEY
+except ImportError:
+    # no secret module (e.g. running against the fake APIs), use env vars
+    IMG_CLIENT_ID = os.environ.get('IMG_CLIENT_ID', '')
+    IMG_API_KEY = os.environ.get('IMG_API_KEY', '')
+    SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID', '')
+    SPOTIFY_API_KEY = os.environ.get('SPOTIFY_API_KEY', '')
+from views.metrics import metrics
+from views.http_client import api_client
+from views.caches import LRUTTLCache
+from views.images import prepare_for_keywording
+from views.spotify_token import SpotifyTokenManager
+from views.resilience import ApiGuard, ApiUnavailable, CircuitBreaker, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Set FAKE_API_URL to send all API calls to a local fake server
+# (python -m views.fake_apis) instead of Everypixel and Spotify
+FAKE_API_URL = os.environ.get('FAKE_API_URL', '').rstrip('/')
+
+
+def make_api_guard(name, rate_env):
+    """Returns ApiGuard for API name, configured from env vars
+    (rate_env holds the API's calls per second, unset for no limit)"""
+
+    rate = os.environ.get(rate_env)
+    guard = ApiGuard(name,
+                     RateLimiter(rate=float(rate) if rate else None,
+                                 max_wait=float(os.environ.get('API_MAX_WAIT', 5))),
+                     CircuitBreaker(failure_threshold=int(os.environ.get('API_FAILURE_THRESHOLD', 5)),
+                                    reset_timeout=float(os.environ.get('API_RESET_TIMEOUT', 30))))
+    metrics.register(f'{name}_api', guard.stats)
+    return guard
+
 ###############################################################
 # AI IMAGE API REQUEST FUNCTIONS
 
-IMG_API_BASE_URL = 'https://api.everypixel.com/v1/keywords'
+IMG_API_BASE_URL = (f'{FAKE_API_URL}/v1/keywords' if FAKE_API_URL
+                    else 'https://api.everypixel.com/v1/keywords')
+# Shared by all keywording calls in this process
+img_api_guard = make_api_guard('everypixel', 'IMG_API_RATE_LIMIT')
+
 def get_keywords(image_path):
     """Gets keywords from AI image keywording API 
-    and returns them as a list"""
-
-    with open(image_path, 'rb') as image:
-        data = {'data': image}
-        params = {'num_keywords': 5}
-        json_resp = requests.post(IMG_API_BASE_URL,
-                                 files=data,
-                                 params=params,
-                                 auth=(IMG_CLIENT_ID, IMG_API_KEY)).json()
-        if (json_resp['status'] == 'ok'):
-            keywords_resp = json_resp['keywords']
-            keywords = [keyword_obj['keyword'] for keyword_obj in keywords_resp]
-            return keywords
-        return None
+    and returns them as a list
+    - sends a downscaled copy of the image, original file stays as is"""
+
+    image_file, _ = prepare_for_keywording(image_path)
+    return request_keywords(image_file)
+
+
+def request_keywords(image_file):
+    """Sends image file object to AI image keywording API,
+    returns keywords as a list or None if API fails
+    - raises ApiUnavailable if API is throttling us or down"""
+
+    data = {'data': ('image.jpg', image_file, 'image/jpeg')}
+    params = {'num_keywords': 5}
+    json_resp = img_api_guard.request(api_client, 'POST', IMG_API_BASE_URL,
+                                      files=data,
+                                      params=params,
+                                      auth=(IMG_CLIENT_ID, IMG_API_KEY)).json()
+    if (json_resp.get('status') == 'ok'):
+        keywords_resp = json_resp['keywords']
+        keywords = [keyword_obj['keyword'] for keyword_obj in keywords_resp]
+        return keywords
+    return None
     
 
 ###############################################################
 # SPOTIFY REQUEST FUNCTIONS
 
-def get_spotify_token():
-    """Get access token to make requests to Spotify API 
+SPOTIFY_TOKEN_URL = (f'{FAKE_API_URL}/api/token' if FAKE_API_URL
+                     else 'https://accounts.spotify.com/api/token')
+# Shared by all Spotify calls (token and search) in this process
+spotify_guard = make_api_guard('spotify', 'SPOTIFY_RATE_LIMIT')
+
+def request_spotify_token():
+    """Requests a new access token from Spotify's OAuth service
+    and returns the token response (access_token, expires_in)
     Resource tutorial used: https://www.youtube.com/watch?v=WAmEZBEeNmg
     """
 
@@ -39,7 +94,7 @@ def get_spotify_token():
     #encode with base64
     auth_base64 = str(base64.b64encode(auth_bytes), 'utf-8')
     #send post request to Spotify OAuth Service
-    url = 'https://accounts.spotify.com/api/token'
+    url = SPOTIFY_TOKEN_URL
     headers = {
         'Authorization': 'Basic ' + auth_base64,
         'Content-Type': 'application/x-www-form-urlencoded'
@@ -47,23 +102,44 @@ def get_spotify_token():
     data = {
         'grant_type': 'client_credentials'
     }
-    result = requests.post(url, headers=headers, data=data)
-    json_result = result.json()
-    token = json_result['access_token']
-    return token
+    result = spotify_guard.request(api_client, 'POST', url, headers=headers, data=data)
+    return result.json()
 
 
-SPOTIFY_SEARCH_BASE_URL = 'https://api.spotify.com/v1/search'
-def get_track_data(track_keyword):
-    """Makes GET request to Spotify search endpoint and returns data in object
-    Resource Tutorial used: https://www.youtube.com/watch?v=uXf7IRDIQS4"""
+# Token is shared by all requests in this process and renewed before it expires
+spotify_tokens = SpotifyTokenManager(request_spotify_token)
+metrics.register('spotify_token', spotify_tokens.stats)
+
+def get_spotify_token():
+    """Get access token to make requests to Spotify API"""
 
-    # Randomize offset where search response list begins
-    rand_offset = random.randint(0, 150)
+    return spotify_tokens.get_token()
+
+
+SPOTIFY_SEARCH_BASE_URL = (f'{FAKE_API_URL}/v1/search' if FAKE_API_URL
+                           else 'https://api.spotify.com/v1/search')
+# Number of tracks requested per search (Spotify's max), all of them are 
+# cached for later picks
+SPOTIFY_PAGE_SIZE = 50
+# Tracks are picked from the first SPOTIFY_SAMPLE_RANGE results of a keyword
+SPOTIFY_SAMPLE_RANGE = 200
+
+# Search results per keyword: the keyword's total result count and the pages 
+# fetched so far ({offset: [song-objects]}), so tracks can be sampled locally
+search_cache = LRUTTLCache(maxsize=int(os.environ.get('SPOTIFY_CACHE_SIZE', 512)),
+                           ttl=int(os.environ.get('SPOTIFY_CACHE_TTL', 3600)))
+metrics.register('spotify_search_cache', search_cache.stats)
+
+def search_tracks(track_keyword, offset=0):
+    """Makes GET request to Spotify search endpoint for one page of results,
+    returns (list of song-objects, total number of results for keyword)
+    - raises ApiUnavailable if Spotify is throttling us, down,
+      or answers without search results
+    Resource Tutorial used: https://www.youtube.com/watch?v=uXf7IRDIQS4"""
 
     # Parse keywords to be url-compatible
     search_keyword = urllib.parse.quote(f'%{track_keyword}%')
-    query = f'?q={search_keyword}&type=track&limit=1&offset={rand_offset}'
+    query = f'?q={search_keyword}&type=track&limit={SPOTIFY_PAGE_SIZE}&offset={offset}'
     query_url = SPOTIFY_SEARCH_BASE_URL + query
 
     # Grab token
@@ -73,34 +149,112 @@ def get_track_data(track_keyword):
     headers = {'Authorization': 'Bearer ' + token}
 
     # Send request to API and dissect response
-    resp = requests.get(query_url, headers=headers)
+    resp = spotify_guard.request(api_client, 'GET', query_url, headers=headers)
+    if resp.status_code == 401:
+        # token was revoked or expired early, next search gets a new one
+        spotify_tokens.invalidate()
     resp_json = resp.json()
-    tracks = resp_json['tracks']['items']
-    
-    for track in tracks:
-        title = track['name']
-        album = track['album']['name']
-        album_year = track['album']['release_date'][:4]
-        artists = ', '.join([artist['name'] for artist in track['artists']])
-        spotify_track_id = track['id']
-        spotify_url = track['external_urls']['spotify']
-        image_url = track['album']['images'][0]['url']
-        audio_url = track['preview_url']
-
-        return{
-            'title': title,
-            'album': album, 
-            'album_year': album_year,
-            'artists': artists,
-            'spotify_track_id': spotify_track_id,
-            'spotify_url': spotify_url,
-            'image_url': image_url,
-            'audio_url': audio_url
-        }
-
-
-def get_list_of_tracks(keywords):
-    """Returns a list of all song-objects"""
-
-    return [get_track_data(keyword) for keyword in keywords]
+    results = resp_json.get('tracks')
+    if results is None:
+        raise ApiUnavailable(f'Spotify search failed ({resp.status_code}): '
+                             f'{resp_json.get("error")}')
+
+    songs = [track_to_song(track) for track in results['items'] if track]
+    return songs, results['total']
+
+
+def track_to_song(track):
+    """Dissects a Spotify track into a song-object"""
+
+    images = track['album']['images']
+    return {
+        'title': track['name'],
+        'album': track['album']['name'],
+        'album_year': track['album']['release_date'][:4],
+        'artists': ', '.join([artist['name'] for artist in track['artists']]),
+        'spotify_track_id': track['id'],
+        'spotify_url': track['external_urls']['spotify'],
+        'image_url': images[0]['url'] if images else None,
+        'audio_url': track['preview_url']
+    }
+
+
+def get_track_data(track_keyword):
+    """Returns a random song-object for keyword, or None if search
+    finds no tracks
+    - first search for a keyword fetches page at offset 0 and remembers the
+      keyword's total, later picks use a random position within that total
+    - pages are cached, so repeat keywords only hit Spotify for pages
+      not fetched yet and random positions never overshoot the results"""
+
+    cache_key = track_keyword.strip().lower()
+    results = search_cache.get(cache_key)
+
+    if results is None:
+        songs, total = search_tracks(track_keyword)
+        results = {'total': total, 'pages': {0: songs}}
+        search_cache.set(cache_key, results)
+        position = random.randrange(len(songs)) if songs else None
+    else:
+        sample_range = min(results['total'], SPOTIFY_SAMPLE_RANGE)
+        position = random.randrange(sample_range) if sample_range else None
+
+    if position is None:
+        return None
+
+    page_offset = position - position % SPOTIFY_PAGE_SIZE
+    page = results['pages'].get(page_offset)
+    if page is None:
+        page, _ = search_tracks(track_keyword, page_offset)
+        results['pages'][page_offset] = page
+        metrics.incr('spotify.search.page_fetches')
+
+    # total can be an estimate, so page may be shorter than expected
+    if not page:
+        page = results['pages'][0]
+        if not page:
+            return None
+    song = page[(position - page_offset) % len(page)]
+    # copy so callers can't modify the cached song-object
+    return dict(song)
+
+
+# Max number of Spotify searches run at once for a single upload
+SPOTIFY_MAX_WORKERS = int(os.environ.get('SPOTIFY_MAX_WORKERS', 5))
+
+def get_list_of_tracks(keywords, max_workers=None):
+    """Returns a list of all song-objects, in the same order as keywords
+    - searches for each keyword run in parallel on a bounded thread pool
+    - a keyword whose search fails or finds no track is left out,
+      so one bad search doesn't sink the whole post
+    - if no track was found because Spotify is throttling us or down,
+      raises that ApiUnavailable so the caller can retry later"""
+
+    if not keywords:
+        return []
+
+    max_workers = max_workers or SPOTIFY_MAX_WORKERS
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keywords))) as pool:
+        futures = [pool.submit(get_track_data, keyword) for keyword in keywords]
+
+    tracks = []
+    unavailable = None
+    for keyword, future in zip(keywords, futures):
+        try:
+            track = future.result()
+        except ApiUnavailable as err:
+            metrics.incr('spotify.search.errors')
+            logger.warning('Spotify search failed for keyword %r: %s', keyword, err)
+            unavailable = err
+            continue
+        except Exception:
+            metrics.incr('spotify.search.errors')
+            logger.exception('Spotify search failed for keyword %r', keyword)
+            continue
+        if track:
+            tracks.append(track)
+
+    if not tracks and unavailable is not None:
+        raise unavailable
+    return tracks
 
@@ -0,0 +1,74 @@
+"""Cache headers and fingerprinted URLs for static files
+
+Uploaded post and profile images are saved under content-hash keys (or,
+before those, UUID-prefixed names) that are never reused, so they are
+served as immutable for a year. Other static files (app.css, app.js, home
+images) are linked through asset_url, which adds a hash of the file's
+content; a request carrying the current hash is immutable too, and
+editing the file changes its URL."""
+
+import hashlib
+import os
+import re
+
+from flask import url_for
+
+# uploads/ab/cd/<sha256>.<ext> (content keys), post-images/<uuid1>_<name>
+# or profile-images/<uuid1>_<name>, and their sized copies in thumbs/
+UPLOAD_NAME = re.compile(r'^(uploads/[0-9a-f]{2}/[0-9a-f]{2}/(thumbs/)?[0-9a-f]{64}\.[^/]+'
+                         r'|(post|profile)-images/(thumbs/)?'
+                         r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_[^/]+)$')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# filename => (mtime, size, hash)
+_fingerprints = {}
+
+
+def is_upload(filename):
+    """Returns True if filename is a UUID-named upload"""
+
+    return bool(UPLOAD_NAME.match(filename))
+
+
+def fingerprint(static_folder, filename):
+    """Returns short hash of static file's content, rehashed only
+    when its modification time or size changes, None if missing"""
+
+    try:
+        stat = os.stat(os.path.join(static_folder, filename))
+    except OSError:
+        return None
+
+    cached = _fingerprints.get(filename)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+
+    with open(os.path.join(static_folder, filename), 'rb') as file:
+        digest = hashlib.md5(file.read()).hexdigest()[:12]
+    _fingerprints[filename] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+
+def asset_url(static_folder, filename):
+    """Returns URL of static file, fingerprinted with its content hash
+    unless it's an upload (whose name never changes content)"""
+
+    if is_upload(filename):
+        return url_for('static', filename=filename)
+    digest = fingerprint(static_folder, filename)
+    if digest is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=digest)
+
+
+def set_cache_headers(response, static_folder, filename, version):
+    """Marks response to a static file immutable if filename is an
+    upload or version is its current fingerprint"""
+
+    if response.status_code not in (200, 304):
+        return response
+    if is_upload(filename) or (version and version == fingerprint(static_folder, filename)):
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        response.headers.pop('Expires', None)
+    return response
@@ -0,0 +1,87 @@
+"""In-process caches"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUTTLCache:
+    """Bounded least-recently-used cache whose entries also expire.
+
+    - maxsize: max number of entries, least recently used is evicted first
+    - ttl: seconds an entry stays valid after being set
+    Safe to share between threads."""
+
+    def __init__(self, maxsize=512, ttl=3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Returns cached value for key, or default if missing or expired"""
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if self._clock() >= expires_at:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Caches value under key, evicting least recently used entries
+        when cache is full"""
+
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Removes key from cache if present"""
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Removes all entries"""
+
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Returns size, settings and hit ratio"""
+
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hits / lookups if lookups else 0
+        }
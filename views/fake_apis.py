@@ -0,0 +1,367 @@
+"""Local stand-in for the Everypixel and Spotify APIs
+
+Serves the three endpoints Melomap uses (keywords, token, search) so the
+upload path can be tested, benchmarked and load-tested offline. Supports
+latency distributions, 429 rate limiting, error injection and
+record/replay of real API responses.
+
+Run it and point the app at it with FAKE_API_URL:
+
+    python -m views.fake_apis --port 5050 --latency lognormal:80:0.5 --error-rate 0.02
+    FAKE_API_URL=http://127.0.0.1:5050 flask run
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+KEYWORD_VOCABULARY = ['sky', 'nature', 'people', 'sea', 'sunset', 'city', 'night',
+                      'beach', 'mountain', 'dog', 'food', 'travel', 'summer',
+                      'winter', 'love', 'flower', 'street', 'car', 'coffee', 'music']
+
+# Real endpoints used when recording responses
+UPSTREAM_URLS = {
+    '/v1/keywords': 'https://api.everypixel.com/v1/keywords',
+    '/api/token': 'https://accounts.spotify.com/api/token',
+    '/v1/search': 'https://api.spotify.com/v1/search'
+}
+
+# Spotify rejects searches past this offset
+MAX_SEARCH_OFFSET = 1000
+
+
+class Latency:
+    """Latency distribution in milliseconds, from a spec like
+    'fixed:100', 'uniform:50:200', 'normal:100:20' or 'lognormal:80:0.5'
+    (lognormal takes the median and sigma)"""
+
+    def __init__(self, spec='fixed:0', rng=None):
+        self.spec = spec
+        self.rng = rng or random.Random()
+        kind, *params = spec.split(':')
+        self.kind = kind
+        self.params = [float(param) for param in params]
+        if kind not in ('fixed', 'uniform', 'normal', 'lognormal'):
+            raise ValueError(f'Unknown latency distribution {kind!r}')
+
+    def sample(self):
+        """Returns a delay in seconds"""
+
+        if self.kind == 'fixed':
+            ms = self.params[0] if self.params else 0
+        elif self.kind == 'uniform':
+            ms = self.rng.uniform(*self.params)
+        elif self.kind == 'normal':
+            ms = self.rng.gauss(*self.params)
+        else:
+            median, sigma = self.params
+            ms = self.rng.lognormvariate(math.log(median), sigma)
+        return max(ms, 0) / 1000
+
+
+class RateLimiter:
+    """Token bucket allowing rate requests per second (bursts up to rate)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Returns 0 if request is allowed, else seconds until it would be"""
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class FakeApiConfig:
+    """Behavior of the fake APIs.
+
+    - latency: Latency spec for all endpoints, endpoint_latency overrides
+      it per endpoint ('keywords', 'token', 'search')
+    - error_rate: chance of answering with a 500/503
+    - throttle_rate: chance of answering with a 429
+    - rate_limit: requests per second before answering 429 (None for no limit)
+    - retry_after: Retry-After seconds sent with injected 429s
+    - replay: JSON file of recorded responses to serve when they match
+    - record: JSON file to save responses to, forwarding requests to the real APIs
+    """
+
+    def __init__(self, latency='fixed:0', endpoint_latency=None, error_rate=0.0,
+                 throttle_rate=0.0, rate_limit=None, retry_after=1,
+                 token_expires_in=3600, replay=None, record=None, seed=None):
+        self.rng = random.Random(seed)
+        self.latency = Latency(latency, self.rng)
+        self.endpoint_latency = {endpoint: Latency(spec, self.rng)
+                                 for endpoint, spec in (endpoint_latency or {}).items()}
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.retry_after = retry_after
+        self.token_expires_in = token_expires_in
+        self.record = record
+        self.recordings = {}
+        if replay and os.path.exists(replay):
+            with open(replay) as recordings_file:
+                self.recordings = json.load(recordings_file)
+
+
+def create_fake_app(config=None):
+    """Returns Flask app serving the fake keywords, token and search endpoints"""
+
+    config = config or FakeApiConfig()
+    fake_app = Flask(__name__)
+    fake_app.config['FAKE_API'] = config
+    stats = Counter()
+    record_lock = threading.Lock()
+
+    def recording_key():
+        """Key identifying a request in recordings"""
+
+        if request.path == '/v1/keywords':
+            image = request.files.get('data')
+            digest = hashlib.sha256(image.read()).hexdigest() if image else ''
+            if image:
+                image.seek(0)
+            return f'POST /v1/keywords {digest}'
+        query = '&'.join(f'{key}={value}' for key, value in sorted(request.args.items()))
+        return f'{request.method} {request.path}?{query}'
+
+    def forward_upstream(key):
+        """Sends request to the real API and saves its response under key"""
+
+        files = {name: (upload.filename, upload.read(), upload.mimetype)
+                 for name, upload in request.files.items()}
+        headers = {}
+        if 'Authorization' in request.headers:
+            headers['Authorization'] = request.headers['Authorization']
+        resp = requests.request(request.method, UPSTREAM_URLS[request.path],
+                                params=request.args, data=request.form or None,
+                                files=files or None, headers=headers, timeout=30)
+        recorded = {'status': resp.status_code, 'body': resp.json()}
+        with record_lock:
+            config.recordings[key] = recorded
+            with open(config.record, 'w') as recordings_file:
+                json.dump(config.recordings, recordings_file, indent=2, sort_keys=True)
+        return recorded
+
+    @fake_app.before_request
+    def inject_faults():
+        """Applies latency, rate limiting and injected errors"""
+
+        endpoint = request.path.rsplit('/', 1)[-1]
+        if not endpoint or endpoint == 'stats':
+            return None
+        stats[f'{endpoint}.requests'] += 1
+
+        time.sleep(config.endpoint_latency.get(endpoint, config.latency).sample())
+
+        wait = config.rate_limiter.acquire() if config.rate_limiter else 0
+        if wait or config.rng.random() < config.throttle_rate:
+            stats[f'{endpoint}.throttled'] += 1
+            resp = jsonify(error={'status': 429, 'message': 'API rate limit exceeded'})
+            resp.status_code = 429
+            resp.headers['Retry-After'] = str(math.ceil(wait) or config.retry_after)
+            return resp
+
+        if config.rng.random() < config.error_rate:
+            stats[f'{endpoint}.errors'] += 1
+            status = config.rng.choice([500, 503])
+            resp = jsonify(error={'status': status, 'message': 'Injected error'})
+            resp.status_code = status
+            return resp
+
+        return None
+
+    def respond(generate):
+        """Serves recorded response if there is one, else a recorded
+        upstream response when recording, else a generated one"""
+
+        key = recording_key()
+        recorded = config.recordings.get(key)
+        if recorded is None and config.record:
+            recorded = forward_upstream(key)
+        if recorded is not None:
+            stats['replayed'] += 1
+            resp = jsonify(recorded['body'])
+            resp.status_code = recorded['status']
+            return resp
+        return generate()
+
+    @fake_app.route('/v1/keywords', methods=['POST'])
+    def keywords():
+        """Everypixel keywording: keywords picked from image's hash"""
+
+        def generate():
+            image = request.files.get('data')
+            if image is None:
+                return jsonify(status='error', message='No image'), 400
+
+            seed = hashlib.sha256(image.read()).digest()
+            rng = random.Random(seed)
+            count = int(request.args.get('num_keywords', 5))
+            picked = rng.sample(KEYWORD_VOCABULARY, min(count, len(KEYWORD_VOCABULARY)))
+            return jsonify(status='ok',
+                           keywords=[{'keyword': keyword, 'score': round(rng.uniform(0.5, 1), 3)}
+                                     for keyword in picked])
+        return respond(generate)
+
+    @fake_app.route('/api/token', methods=['POST'])
+    def token():
+        """Spotify client-credentials token"""
+
+        def generate():
+            return jsonify(access_token=f'fake-{random.getrandbits(64):016x}',
+                           token_type='Bearer',
+                           expires_in=config.token_expires_in)
+        return respond(generate)
+
+    @fake_app.route('/v1/search')
+    def search():
+        """Spotify track search: each keyword has a fixed number of
+        results (0-400), tracks are generated from keyword and position"""
+
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            return jsonify(error={'status': 401, 'message': 'No token provided'}), 401
+
+        def generate():
+            keyword = request.args.get('q', '').strip('%').lower()
+            limit = min(int(request.args.get('limit', 20)), 50)
+            offset = int(request.args.get('offset', 0))
+            if offset > MAX_SEARCH_OFFSET:
+                return jsonify(error={'status': 400, 'message': 'Invalid offset'}), 400
+
+            total = int(hashlib.sha256(keyword.encode('utf-8')).hexdigest(), 16) % 401
+            items = [fake_track(keyword, position)
+                     for position in range(offset, min(offset + limit, total))]
+            return jsonify(tracks={'items': items, 'limit': limit,
+                                   'offset': offset, 'total': total})
+        return respond(generate)
+
+    @fake_app.route('/_fake/stats')
+    def show_stats():
+        """Request, throttle and error counts per endpoint"""
+
+        return jsonify(dict(stats))
+
+    fake_app.fake_stats = stats
+    return fake_app
+
+
+def fake_track(keyword, position):
+    """Returns a Spotify-shaped track for keyword at position in results"""
+
+    track_id = hashlib.md5(f'{keyword}:{position}'.encode('utf-8')).hexdigest()[:22]
+    return {
+        'id': track_id,
+        'name': f'{keyword.title()} Song {position + 1}',
+        'preview_url': None,
+        'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+        'artists': [{'name': f'{keyword.title()} Artist {position % 7 + 1}'}],
+        'album': {
+            'name': f'{keyword.title()} Album {position // 10 + 1}',
+            'release_date': f'{1990 + position % 35}-01-01',
+            'images': [{'url': f'https://i.scdn.co/image/{track_id}'}]
+        }
+    }
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler that doesn't log every request"""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class FakeApiServer:
+    """Runs the fake APIs on a local port in a background thread
+
+        with FakeApiServer(FakeApiConfig(latency='fixed:100')) as server:
+            ... requests to server.url ...
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0, quiet=True):
+        self.app = create_fake_app(config)
+        self.server = make_server(host, port, self.app, threaded=True,
+                                  request_handler=QuietRequestHandler if quiet else None)
+        self.url = f'http://{host}:{self.server.server_port}'
+        self._thread = None
+
+    @property
+    def stats(self):
+        return self.app.fake_stats
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def parse_endpoint_latency(specs):
+    """Parses ['search=lognormal:80:0.5', ...] into a dict"""
+
+    return dict(spec.split('=', 1) for spec in specs or [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Everypixel and Spotify APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--latency', default='fixed:0',
+                        help="fixed:MS, uniform:LO:HI, normal:MEAN:SD or lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--endpoint-latency', action='append',
+                        help='per endpoint latency, e.g. search=fixed:200 (repeatable)')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, help='requests per second before 429s')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--token-expires-in', type=int, default=3600)
+    parser.add_argument('--replay', help='JSON file of recorded responses to serve')
+    parser.add_argument('--record', help='JSON file to record real API responses to')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    config = FakeApiConfig(latency=args.latency,
+                           endpoint_latency=parse_endpoint_latency(args.endpoint_latency),
+                           error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate,
+                           rate_limit=args.rate_limit,
+                           retry_after=args.retry_after,
+                           token_expires_in=args.token_expires_in,
+                           replay=args.replay or args.record,
+                           record=args.record,
+                           seed=args.seed)
+    server = FakeApiServer(config, args.host, args.port, quiet=False)
+    print(f'Fake APIs on {server.url} (set FAKE_API_URL={server.url})')
+    server.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
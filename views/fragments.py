@@ -0,0 +1,144 @@
+"""Cache of rendered post and song cards
+
+Cards are rendered once from the *_body macros in posts/post-macro.html
+and cached by ID with a version of everything the HTML shows that can
+change, so a stale card is never served. The cached HTML is the same for
+every viewer: the trash button and bookmark icons are left as slots and
+filled in per request."""
+
+import os
+import re
+import threading
+
+from flask import get_template_attribute
+from markupsafe import Markup
+
+from models.models import Post
+from views.caches import LRUTTLCache
+from views.metrics import metrics
+from views.storage import current_storage, image_key
+from views.thumbnails import has_variants
+
+MACROS = 'posts/post-macro.html'
+
+# bump when post-macro.html changes, so cards rendered before are ignored
+TEMPLATE_VERSION = 2
+
+TRASH_SLOT = '<!--trash-->'
+BOOKMARK_SLOT = re.compile(r'<!--bookmark:(\d+)-->')
+
+
+class FragmentCache:
+    """LRU/TTL cache of rendered cards with hit and miss counts per kind"""
+
+    def __init__(self, maxsize=2048, ttl=3600):
+        self._cache = LRUTTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = {'post': 0, 'song': 0}
+        self.misses = {'post': 0, 'song': 0}
+
+    def get_or_render(self, kind, key, version, render):
+        """Returns cached HTML for (kind, key) if rendered for version,
+        otherwise calls render() and caches its HTML"""
+
+        cached = self._cache.get((kind, key))
+        if cached is not None and cached[0] == version:
+            with self._lock:
+                self.hits[kind] += 1
+            return cached[1]
+
+        with self._lock:
+            self.misses[kind] += 1
+        html = str(render())
+        self._cache.set((kind, key), (version, html))
+        return html
+
+    def forget(self, kind, key):
+        """Drops cached HTML for (kind, key)"""
+
+        self._cache.delete((kind, key))
+
+    def clear(self):
+        """Drops all cached HTML and counts"""
+
+        self._cache.clear()
+        with self._lock:
+            self.hits = dict.fromkeys(self.hits, 0)
+            self.misses = dict.fromkeys(self.misses, 0)
+
+    def stats(self):
+        """Returns size and hit ratio per kind of card"""
+
+        stats = {'size': len(self._cache), 'maxsize': self._cache.maxsize}
+        for kind in self.hits:
+            lookups = self.hits[kind] + self.misses[kind]
+            stats[kind] = {'hits': self.hits[kind],
+                           'misses': self.misses[kind],
+                           'hit_ratio': self.hits[kind] / lookups if lookups else 0}
+        return stats
+
+
+fragment_cache = FragmentCache(maxsize=int(os.environ.get('FRAGMENT_CACHE_SIZE', 2048)),
+                               ttl=int(os.environ.get('FRAGMENT_CACHE_TTL', 3600)))
+metrics.register('fragment_cache', fragment_cache.stats)
+
+
+def post_version(post):
+    """Returns version of post's card: everything it shows that can change,
+    including whether the sized copies of its images are made yet"""
+
+    user = post.user
+    storage = current_storage()
+    return (TEMPLATE_VERSION, post.status, len(post.songs),
+            user.username, user.name, user.profile_image,
+            has_variants(storage, image_key('post-images', post.image)),
+            has_variants(storage, image_key('profile-images', user.profile_image)))
+
+
+def fill_slots(html, viewer_owns, bookmarked_song_ids):
+    """Returns card HTML with viewer's trash button and bookmark icons
+    - bookmarked_song_ids: function returning set of viewer's bookmarked
+      song IDs, only called if card shows songs"""
+
+    if BOOKMARK_SLOT.search(html):
+        bookmarked_ids = bookmarked_song_ids()
+        bookmark_icon = get_template_attribute(MACROS, 'bookmark_icon')
+        icons = {bookmarked: str(bookmark_icon(bookmarked)) for bookmarked in (True, False)}
+        html = BOOKMARK_SLOT.sub(lambda match: icons[int(match.group(1)) in bookmarked_ids], html)
+    if TRASH_SLOT in html:
+        trash = str(get_template_attribute(MACROS, 'trash_button')()) if viewer_owns else ''
+        html = html.replace(TRASH_SLOT, trash)
+    return Markup(html)
+
+
+def post_card(post, viewer_id, bookmarked_song_ids):
+    """Returns HTML of post's card as seen by viewer_id"""
+
+    html = fragment_cache.get_or_render(
+        'post', post.id, post_version(post),
+        lambda: get_template_attribute(MACROS, 'post_body')(post))
+    return fill_slots(html, viewer_id is not None and viewer_id == post.user_id,
+                      bookmarked_song_ids)
+
+
+def song_card(song, border_style, bookmarked_song_ids):
+    """Returns HTML of song's card with viewer's bookmark icon"""
+
+    html = fragment_cache.get_or_render(
+        'song', (song.id, border_style), TEMPLATE_VERSION,
+        lambda: get_template_attribute(MACROS, 'song_body')(song, border_style))
+    return fill_slots(html, False, bookmarked_song_ids)
+
+
+def forget_post(post_id):
+    """Drops cached card of a deleted or changed post"""
+
+    fragment_cache.forget('post', post_id)
+
+
+def forget_user_posts(user_id):
+    """Drops cached cards of user's posts, e.g. after their profile image
+    or name changed"""
+
+    for post_id, in Post.query.with_entities(Post.id).filter_by(user_id=user_id):
+        forget_post(post_id)
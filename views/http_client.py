@@ -0,0 +1,135 @@
+"""Shared HTTP client for the external APIs (Everypixel, Spotify)"""
+
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from views.metrics import metrics
+
+# (connect, read) timeouts in seconds so a stalled API can't hold a worker forever
+DEFAULT_TIMEOUT = (float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05)),
+                   float(os.environ.get('HTTP_READ_TIMEOUT', 15)))
+
+
+class HttpClient:
+    """Keep-alive HTTP client with a connection pool per host.
+
+    - pool_maxsize: max connections kept open to each host
+    - retries: max retries for connection errors, and for read errors and 5xx
+      responses to GETs (never 429s, see ApiGuard)
+    - timeout: default (connect, read) timeout for every request
+    Tracks per-host request counts, errors, latency and pool usage."""
+
+    def __init__(self, pool_maxsize=10, retries=2, backoff_factor=0.3,
+                 timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=retries,
+                      status=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      # 429s and Retry-After waits are left to ApiGuard, which
+                      # shares them across callers and caps them at max_wait
+                      respect_retry_after_header=False,
+                      # A POST (keywording, token) that timed out or failed may
+                      # still have been processed, so only retry it when it
+                      # couldn't connect
+                      allowed_methods=frozenset(['GET']),
+                      raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=4,
+                                   pool_maxsize=pool_maxsize,
+                                   max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def request(self, method, url, **kwargs):
+        """Sends request through the shared session and records host stats"""
+
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).netloc
+        host_stats = self._start(host)
+        start = time.perf_counter()
+
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._finish(host_stats, time.perf_counter() - start, error=True)
+            metrics.incr(f'http.{host}.errors')
+            raise
+
+        self._finish(host_stats, time.perf_counter() - start,
+                     error=resp.status_code >= 500)
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Returns request and connection pool stats per host"""
+
+        with self._lock:
+            result = {host: dict(host_stats) for host, host_stats in self._hosts.items()}
+
+        for host_stats in result.values():
+            host_stats['avg_ms'] = (host_stats['total_ms'] / host_stats['requests']
+                                    if host_stats['requests'] else 0)
+
+        # Connection pool usage as reported by urllib3
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = key.key_host if key.key_port in (None, 80, 443) else f'{key.key_host}:{key.key_port}'
+            host_stats = result.setdefault(host, {})
+            host_stats['pool'] = {
+                'maxsize': pool.pool.maxsize if pool.pool else 0,
+                'idle': pool.pool.qsize() if pool.pool else 0,
+                'connections_opened': pool.num_connections,
+                'requests_sent': pool.num_requests
+            }
+        return result
+
+    def close(self):
+        """Closes all pooled connections"""
+
+        self.session.close()
+
+    def _start(self, host):
+        with self._lock:
+            host_stats = self._hosts.get(host)
+            if host_stats is None:
+                host_stats = self._hosts[host] = {'requests': 0, 'errors': 0,
+                                                  'in_flight': 0, 'max_in_flight': 0,
+                                                  'total_ms': 0.0}
+            host_stats['requests'] += 1
+            host_stats['in_flight'] += 1
+            host_stats['max_in_flight'] = max(host_stats['max_in_flight'],
+                                              host_stats['in_flight'])
+            return host_stats
+
+    def _finish(self, host_stats, elapsed, error=False):
+        with self._lock:
+            host_stats['in_flight'] -= 1
+            host_stats['total_ms'] += elapsed * 1000
+            if error:
+                host_stats['errors'] += 1
+
+
+# Client shared by all external API calls in this process
+api_client = HttpClient()
+metrics.register('http', api_client.stats)
@@ -0,0 +1,69 @@
+"""Slim identity of the logged-in user, set as g.user before every request
+
+Most requests only show who is logged in (navbar, ownership checks,
+bookmark icons), so g.user holds just the user's id, username and profile
+image. These come from a small in-process cache, falling back to a
+three-column query, instead of loading the full User row every request.
+Routes that change the user load the full row with g.user.load()."""
+
+import os
+import time
+
+from models.models import db, User, BookmarkedSongs
+from views.caches import LRUTTLCache
+from views.metrics import metrics
+
+IDENTITY_FIELDS = (User.id, User.username, User.profile_image)
+
+# Username/image edits made by other processes show up after at most ttl seconds
+identity_cache = LRUTTLCache(maxsize=int(os.environ.get('IDENTITY_CACHE_SIZE', 1024)),
+                             ttl=int(os.environ.get('IDENTITY_CACHE_TTL', 60)))
+metrics.register('identity_cache', identity_cache.stats)
+
+
+class CurrentUser:
+    """Fields of the logged-in user needed on every request"""
+
+    __slots__ = ('id', 'username', 'profile_image', '_user')
+
+    def __init__(self, id, username, profile_image):
+        self.id = id
+        self.username = username
+        self.profile_image = profile_image
+        self._user = None
+
+    def __repr__(self):
+        return f'<CurrentUser #{self.id}: {self.username}>'
+
+    def load(self):
+        """Returns full User row, loaded once per request"""
+
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def bookmarked_song_ids(self):
+        return BookmarkedSongs.song_ids_for(self.id)
+
+
+def load_identity(user_id):
+    """Returns CurrentUser for user_id, or None if user doesn't exist"""
+
+    start = time.perf_counter()
+    fields = identity_cache.get(user_id)
+    if fields is None:
+        row = (db.session.query(*IDENTITY_FIELDS)
+               .filter(User.id == user_id)
+               .first())
+        if row is not None:
+            fields = tuple(row)
+            identity_cache.set(user_id, fields)
+
+    metrics.observe('identity.load_ms', (time.perf_counter() - start) * 1000)
+    return CurrentUser(*fields) if fields else None
+
+
+def forget_identity(user_id):
+    """Drops cached identity after user is edited or deleted"""
+
+    identity_cache.delete(user_id)
@@ -0,0 +1,67 @@
+"""In-process metrics registry for Melomap"""
+
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    """Thread-safe counters and timing summaries kept in process memory.
+
+    Components with their own state (caches, pools, token managers) can also
+    register a stats function, which is called whenever a snapshot is taken."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timings = {}
+        self._providers = {}
+
+    def incr(self, name, amount=1):
+        """Increments counter by amount"""
+
+        with self._lock:
+            self._counters[name] += amount
+
+    def observe(self, name, value):
+        """Records a single measurement (e.g. a duration in ms) for name"""
+
+        with self._lock:
+            summary = self._timings.get(name)
+            if summary is None:
+                summary = self._timings[name] = {'count': 0, 'total': 0.0,
+                                                 'min': value, 'max': value}
+            summary['count'] += 1
+            summary['total'] += value
+            summary['min'] = min(summary['min'], value)
+            summary['max'] = max(summary['max'], value)
+
+    def register(self, name, stats_func):
+        """Registers a function returning a dict of stats under name"""
+
+        with self._lock:
+            self._providers[name] = stats_func
+
+    def snapshot(self):
+        """Returns all counters, timings and registered stats as a dict"""
+
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {name: dict(summary, avg=summary['total'] / summary['count'])
+                       for name, summary in self._timings.items()}
+            providers = dict(self._providers)
+
+        return {
+            'counters': counters,
+            'timings': timings,
+            'stats': {name: stats_func() for name, stats_func in providers.items()}
+        }
+
+    def reset(self):
+        """Clears counters and timings (registered stats are kept)"""
+
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+metrics = Metrics()
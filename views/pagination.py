@@ -0,0 +1,60 @@
+"""Opaque cursors for keyset and page-numbered pagination"""
+
+import base64
+import binascii
+from datetime import datetime
+
+
+def encode_cursor(*parts):
+    """Returns opaque cursor holding parts (joined as strings)"""
+
+    key = '|'.join(str(part) for part in parts)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, count):
+    """Returns list of count string parts from a cursor made by
+    encode_cursor, raises ValueError if cursor is invalid"""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        parts = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8').split('|')
+    except (binascii.Error, UnicodeError, ValueError) as err:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from err
+    if len(parts) != count:
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+    return parts
+
+
+def encode_post_cursor(post):
+    """Returns cursor pointing just after post in the feed
+    (built from its timestamp and id, the feed's sort key)"""
+
+    return encode_cursor(post.timestamp.isoformat(), post.id)
+
+
+def decode_post_cursor(cursor):
+    """Returns (timestamp, id) from a cursor made by encode_post_cursor,
+    raises ValueError if cursor is invalid"""
+
+    timestamp, post_id = decode_cursor(cursor, 2)
+    try:
+        return datetime.fromisoformat(timestamp), int(post_id)
+    except ValueError as err:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from err
+
+
+def encode_int_cursor(value):
+    """Returns cursor holding a page number or row id"""
+
+    return encode_cursor(value)
+
+
+def decode_int_cursor(cursor):
+    """Returns non-negative int from a cursor made by encode_int_cursor,
+    raises ValueError if cursor is invalid"""
+
+    value, = decode_cursor(cursor, 1)
+    if not value.isdigit():
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+    return int(value)
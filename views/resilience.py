@@ -0,0 +1,295 @@
+"""Rate limiting and circuit breaking for the external APIs
+
+One ApiGuard per API is shared by every caller in the process (request
+threads, upload workers, search fan-out threads), so when an API throttles
+us or goes down all callers back off together instead of each finding out
+on its own."""
+
+import email.utils
+import logging
+import threading
+import time
+
+import requests
+
+from views.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Retry-After seconds assumed when a 429 doesn't say how long to wait
+DEFAULT_RETRY_AFTER = 1
+
+
+class ApiUnavailable(Exception):
+    """Raised when an API call is refused or fails
+    - retry_after: seconds until the API is worth trying again (or None)"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value, default=DEFAULT_RETRY_AFTER):
+    """Returns seconds to wait from a Retry-After header value,
+    which is either a number of seconds or an HTTP date"""
+
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RateLimiter:
+    """Spaces out calls to one API.
+
+    - rate: calls per second allowed (None for no client-side limit),
+      with bursts of up to burst calls
+    - max_wait: longest a caller will sleep for its turn, callers that would
+      wait longer get ApiUnavailable right away
+    Calling throttle() after a 429 holds every caller until Retry-After passes."""
+
+    def __init__(self, rate=None, burst=None, max_wait=5,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.max_wait = max_wait
+        self._clock = clock
+        self._sleep = sleep
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = clock()
+        self._blocked_until = 0
+
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.rejected = 0
+        self.throttled = 0
+
+    def acquire(self):
+        """Waits for this caller's turn, raises ApiUnavailable
+        if that would take longer than max_wait"""
+
+        with self._lock:
+            now = self._clock()
+            wait = max(0, self._blocked_until - now)
+
+            if self.rate:
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens < 1:
+                    wait = max(wait, (1 - self._tokens) / self.rate)
+
+            if wait > self.max_wait:
+                self.rejected += 1
+                raise ApiUnavailable('Rate limited', retry_after=wait)
+
+            # Tokens may go negative, reserving turns for callers already waiting
+            if self.rate:
+                self._tokens -= 1
+            if wait:
+                self.waits += 1
+                self.wait_seconds += wait
+
+        if wait:
+            self._sleep(wait)
+
+    def throttle(self, retry_after):
+        """Holds all callers for retry_after seconds (API answered 429)"""
+
+        with self._lock:
+            self.throttled += 1
+            self._blocked_until = max(self._blocked_until,
+                                      self._clock() + retry_after)
+
+    def stats(self):
+        """Returns limiter counters"""
+
+        return {
+            'rate': self.rate,
+            'waits': self.waits,
+            'wait_seconds': round(self.wait_seconds, 3),
+            'rejected': self.rejected,
+            'throttled': self.throttled,
+            'blocked_for': max(0, round(self._blocked_until - self._clock(), 3))
+        }
+
+
+class CircuitBreaker:
+    """Stops calling an API that keeps failing.
+
+    - failure_threshold: consecutive failures that open the circuit
+    - reset_timeout: seconds the circuit stays open before one trial call
+      is let through (half open), success closes it, failure opens it again
+    While open, allow() returns False so callers fail fast."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_running = False
+
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Returns True if a call may go through now"""
+
+        with self._lock:
+            if self.state == 'open':
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = 'half_open'
+                self._trial_running = False
+
+            if self.state == 'half_open':
+                # only one trial call at a time while half open
+                if self._trial_running:
+                    self.rejected += 1
+                    return False
+                self._trial_running = True
+            return True
+
+    def retry_after(self):
+        """Returns seconds until an open circuit lets a trial call through"""
+
+        if self.state != 'open':
+            return 0
+        return max(0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._failures = 0
+            self._trial_running = False
+
+    def cancel(self):
+        """Lets another trial call through when an allowed call wasn't made"""
+
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        """Counts a failed call, returns True if it opened the circuit"""
+
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or self._failures >= self.failure_threshold:
+                was_open = self.state == 'open'
+                self.state = 'open'
+                self._opened_at = self._clock()
+                self._trial_running = False
+                if not was_open:
+                    self.opened += 1
+                    return True
+            return False
+
+    def stats(self):
+        """Returns breaker state and counters"""
+
+        return {
+            'state': self.state,
+            'consecutive_failures': self._failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
+            'retry_after': round(self.retry_after(), 3)
+        }
+
+
+def file_bodies(kwargs):
+    """Returns {file object: position} of files a request would upload
+    (in files=, or as its data=), so they can be rewound to resend it"""
+
+    files = kwargs.get('files') or {}
+    values = list(files.values() if isinstance(files, dict) else (value for _, value in files))
+    values.append(kwargs.get('data'))
+    bodies = {}
+    for value in values:
+        # files= values are file objects or (filename, file object, ...) tuples
+        file = value[1] if isinstance(value, (tuple, list)) and len(value) > 1 else value
+        if hasattr(file, 'seek') and hasattr(file, 'read'):
+            bodies[file] = file.tell()
+    return bodies
+
+
+class ApiGuard:
+    """Sends requests to one API through a shared rate limiter and circuit breaker.
+
+    - 429 responses throttle the limiter for Retry-After seconds and, if that
+      wait fits in the limiter's max_wait, the request is sent once more
+    - 5xx responses (after the HTTP client's own retries) and connection
+      errors count as failures for the breaker
+    Requests that are refused or fail raise ApiUnavailable."""
+
+    def __init__(self, name, limiter=None, breaker=None):
+        self.name = name
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+
+    def request(self, client, method, url, **kwargs):
+        """Sends request with client (an HttpClient) and returns the response"""
+
+        # sending reads files to the end, a retry has to start them over
+        bodies = file_bodies(kwargs)
+        for attempt in range(2):
+            for file, position in bodies.items():
+                file.seek(position)
+            if not self.breaker.allow():
+                metrics.incr(f'{self.name}.circuit_rejected')
+                raise ApiUnavailable(f'{self.name} circuit open',
+                                     retry_after=self.breaker.retry_after())
+            try:
+                self.limiter.acquire()
+            except ApiUnavailable:
+                # call never went out, so it can't count for or against the API
+                self.breaker.cancel()
+                metrics.incr(f'{self.name}.rate_limited')
+                raise
+
+            try:
+                resp = client.request(method, url, **kwargs)
+            except requests.RequestException as err:
+                self._failed()
+                raise ApiUnavailable(f'{self.name} request failed: {err}') from err
+
+            if resp.status_code == 429:
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+                self.limiter.throttle(retry_after)
+                # being throttled means the API is up
+                self.breaker.record_success()
+                metrics.incr(f'{self.name}.throttled')
+                logger.warning('%s throttled us for %.1fs', self.name, retry_after)
+                if attempt == 0 and retry_after <= self.limiter.max_wait:
+                    continue
+                raise ApiUnavailable(f'{self.name} rate limit exceeded',
+                                     retry_after=retry_after)
+
+            if resp.status_code >= 500:
+                self._failed()
+                raise ApiUnavailable(f'{self.name} returned {resp.status_code}')
+
+            self.breaker.record_success()
+            return resp
+
+    def stats(self):
+        return {'circuit': self.breaker.stats(), 'rate_limiter': self.limiter.stats()}
+
+    def _failed(self):
+        metrics.incr(f'{self.name}.failures')
+        if self.breaker.record_failure():
+            metrics.incr(f'{self.name}.circuit_opened')
+            logger.error('%s circuit opened after repeated failures', self.name)
@@ -0,0 +1,129 @@
+"""Song and user search for /search and its load-more endpoints
+
+On Postgres, songs match on full-text (word prefixes, ranked with ts_rank)
+or on substring, and users on substring. Both use GIN indexes from
+migration 0005: tsvector for words, pg_trgm for substrings. Without
+pg_trgm (0005 not run yet) matches are ordered by ts_rank alone. Other
+databases (SQLite test runs) fall back to unindexed LIKE queries."""
+
+import re
+
+from sqlalchemy import func, or_, text
+
+from models.models import db, Song, User
+
+SONGS_PER_PAGE = 20
+USERS_PER_PAGE = 24
+
+# Expressions must match the ones indexed in migrations/0005_search_indexes.py
+song_text = (func.coalesce(Song.title, '') + ' ' + func.coalesce(Song.album, '')
+             + ' ' + func.coalesce(Song.artists, ''))
+user_text = User.username + ' ' + func.coalesce(User.name, '')
+
+# URLs of databases known to have the pg_trgm extension
+_trigram_support = set()
+
+
+def uses_postgres():
+    return db.session.bind.dialect.name == 'postgresql'
+
+
+def has_trigrams():
+    """Returns True if the Postgres database has pg_trgm (for similarity).
+    Only found extensions are remembered, so one installed later (after
+    migration 0005) is picked up without a restart."""
+
+    url = str(db.session.bind.url)
+    if url not in _trigram_support:
+        if db.session.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is None:
+            return False
+        _trigram_support.add(url)
+    return True
+
+
+def similarity_order(column_text, search):
+    """Returns ORDER BY terms putting closest trigram matches first,
+    none without pg_trgm"""
+
+    if has_trigrams():
+        return [func.similarity(func.lower(column_text), search).desc()]
+    return []
+
+
+def like_pattern(search):
+    """Returns LIKE pattern matching search anywhere, with
+    wildcards typed by the user escaped"""
+
+    escaped = re.sub(r'([\\%_])', r'\\\1', search)
+    return f'%{escaped}%'
+
+
+def paginate(query, page, per_page):
+    """Returns (items on page, whether more pages follow)"""
+
+    items = query.limit(per_page + 1).offset(page * per_page).all()
+    return items[:per_page], len(items) > per_page
+
+
+def search_songs(search, page=0, per_page=SONGS_PER_PAGE, query=None):
+    """Returns (songs matching search, has_more) for page,
+    best matches first (all songs if search is empty)
+    - query: base query instead of Song.query, e.g. selecting only some columns"""
+
+    search = (search or '').strip().lower()
+    if query is None:
+        query = Song.query
+
+    if not search:
+        query = query.order_by(Song.id)
+
+    elif uses_postgres():
+        pattern = like_pattern(search)
+        words = re.findall(r'\w+', search)
+        matches = func.lower(song_text).like(pattern, escape='\\')
+
+        if words:
+            document = func.to_tsvector('simple', song_text)
+            # every word, as typed so far
+            terms = func.to_tsquery('simple', ' & '.join(f'{word}:*' for word in words))
+            query = (query.filter(or_(document.op('@@')(terms), matches))
+                     .order_by(func.ts_rank(document, terms).desc(),
+                               *similarity_order(song_text, search),
+                               Song.id))
+        else:
+            query = (query.filter(matches)
+                     .order_by(*similarity_order(song_text, search), Song.id))
+
+    else:
+        pattern = like_pattern(search)
+        query = (query.filter(or_(*[func.lower(column).like(pattern, escape='\\')
+                                    for column in [Song.title, Song.album, Song.artists]]))
+                 .order_by(Song.id))
+
+    return paginate(query, page, per_page)
+
+
+def search_users(search, page=0, per_page=USERS_PER_PAGE, query=None):
+    """Returns (users matching search, has_more) for page
+    (all users by username if search is empty)
+    - query: base query instead of User.query, as for search_songs()"""
+
+    search = (search or '').strip().lower()
+    if query is None:
+        query = User.query
+
+    if not search:
+        query = query.order_by(User.username)
+
+    elif uses_postgres():
+        query = (query.filter(func.lower(user_text).like(like_pattern(search), escape='\\'))
+                 .order_by(*similarity_order(user_text, search), User.username))
+
+    else:
+        pattern = like_pattern(search)
+        query = (query.filter(or_(func.lower(User.username).like(pattern, escape='\\'),
+                                  func.lower(User.name).like(pattern, escape='\\')))
+                 .order_by(User.username))
+
+    return paginate(query, page, per_page)
@@ -0,0 +1,121 @@
+"""Cached Spotify client-credentials token"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SpotifyTokenManager:
+    """Caches a Spotify access token in process until it expires.
+
+    - fetch_token: function returning Spotify's token response as a dict
+      (with 'access_token' and 'expires_in' in seconds)
+    - refresh_margin: seconds before expiry when a background refresh starts,
+      so request threads keep getting the cached token while it renews
+    Callers that find no valid token wait on a lock, so concurrent callers
+    share a single refresh instead of each requesting their own token.
+    Background refreshes fetch outside that lock, so callers only wait on
+    them for the moment the new token is swapped in.
+    """
+
+    def __init__(self, fetch_token, refresh_margin=300, clock=time.monotonic):
+        self._fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._refreshing = False
+        self._refreshing_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def get_token(self):
+        """Returns a valid access token, only requesting a new one when
+        there is no cached token or it has expired"""
+
+        token, expires_at = self._token, self._expires_at
+        now = self._clock()
+
+        if token and now < expires_at:
+            self.hits += 1
+            # Renew off the request path when token is about to expire
+            if now >= expires_at - self.refresh_margin:
+                self._start_background_refresh()
+            return token
+
+        self.misses += 1
+        with self._lock:
+            # Another caller may have refreshed while this one waited
+            if self._token and self._clock() < self._expires_at:
+                return self._token
+            return self._refresh()
+
+    def invalidate(self):
+        """Drops cached token (e.g. after Spotify rejects it with a 401)"""
+
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+
+    def stats(self):
+        """Returns token cache counters"""
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures,
+            'expires_in': max(0, round(self._expires_at - self._clock())) if self._token else 0
+        }
+
+    def _refresh(self):
+        """Requests a new token and caches it, must be called holding lock"""
+
+        started = self._clock()
+        return self._store(self._fetch_token(), started)
+
+    def _store(self, token_resp, started):
+        """Caches token from token_resp requested at started,
+        must be called holding lock"""
+
+        self._token = token_resp['access_token']
+        self._expires_at = started + int(token_resp.get('expires_in', 3600))
+        self.refreshes += 1
+        return self._token
+
+    def _start_background_refresh(self):
+        """Starts one refresh thread unless one is already running"""
+
+        with self._refreshing_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        thread = threading.Thread(target=self._background_refresh, daemon=True)
+        thread.start()
+
+    def _background_refresh(self):
+        """Refreshes token, keeping the current one if the request fails"""
+
+        try:
+            if self._clock() < self._expires_at - self.refresh_margin:
+                return
+            started = self._clock()
+            token_resp = self._fetch_token()
+            with self._lock:
+                # Keep a newer token a waiting caller fetched meanwhile
+                if started + int(token_resp.get('expires_in', 3600)) > self._expires_at:
+                    self._store(token_resp, started)
+        except Exception:
+            self.refresh_failures += 1
+            logger.exception('Background Spotify token refresh failed')
+        finally:
+            with self._refreshing_lock:
+                self._refreshing = False
@@ -0,0 +1,250 @@
+"""Storage of uploaded images
+
+Uploads are stored by content: a file's key is built from the SHA-256 of
+its bytes (uploads/ab/cd/abcd...ef.jpg), sharded into two levels of
+folders so no folder grows past a few thousand files. The same bytes
+always get the same key, so keys never change content and can be cached
+forever, and every app node can read the same files from a shared mount
+or object store.
+
+Storage backends implement the Storage interface. LocalStorage keeps
+files under a folder (by default the app's static folder, so they're
+served at /static); MemoryStorage is an in-process stand-in for an
+object store. Images uploaded before keys existed are plain filenames,
+stored under post-images/ or profile-images/ in the same backend."""
+
+import abc
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import namedtuple
+
+from flask import current_app
+
+UPLOAD_PREFIX = 'uploads'
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+
+# key of a stored file, hex SHA-256 of its bytes and their size
+StoredFile = namedtuple('StoredFile', ['key', 'sha256', 'size'])
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload is bigger than the size limit"""
+
+
+def content_key(digest, filename):
+    """Returns sharded key of a file with SHA-256 digest, keeping the
+    extension of its filename"""
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.jpeg':
+        ext = '.jpg'
+    return f'{UPLOAD_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{ext}'
+
+
+def image_key(folder, name):
+    """Returns storage key of an image saved in a post or user row:
+    content keys as is, older plain filenames under their folder"""
+
+    return name if '/' in name else f'{folder}/{name}'
+
+
+def read_chunks(stream, max_size):
+    """Yields chunks of stream, raises UploadTooLarge once more than
+    max_size bytes were read"""
+
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        if size > max_size:
+            raise UploadTooLarge(f'Upload is larger than {max_size} bytes')
+        yield chunk
+
+
+class Storage(abc.ABC):
+    """Interface of storage backends. Keys are '/'-separated paths."""
+
+    # whether pool processes can write to it (False for in-process stores)
+    process_safe = True
+
+    @abc.abstractmethod
+    def save(self, stream, filename, max_size=MAX_UPLOAD_BYTES):
+        """Reads stream in chunks and stores it under its content key,
+        returns StoredFile. Raises UploadTooLarge past max_size bytes."""
+
+    @abc.abstractmethod
+    def put(self, key, data):
+        """Stores bytes under key, replacing what was there"""
+
+    @abc.abstractmethod
+    def open(self, key):
+        """Returns binary file of key's content, raises FileNotFoundError"""
+
+    @abc.abstractmethod
+    def exists(self, key):
+        """Returns True if key is stored"""
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """Removes key if stored"""
+
+    @abc.abstractmethod
+    def url(self, key):
+        """Returns URL browsers load key from"""
+
+
+class LocalStorage(Storage):
+    """Stores files under root folder (a local disk or shared mount)"""
+
+    def __init__(self, root, base_url='/static'):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+
+    def __repr__(self):
+        return f'<LocalStorage {self.root}>'
+
+    def path(self, key):
+        """Returns path of key's file"""
+
+        return os.path.join(self.root, *key.split('/'))
+
+    def save(self, stream, filename, max_size=MAX_UPLOAD_BYTES):
+        sha256 = hashlib.sha256()
+        size = 0
+        tmp_dir = os.path.join(self.root, UPLOAD_PREFIX, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+            try:
+                for chunk in read_chunks(stream, max_size):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+
+        key = content_key(sha256.hexdigest(), filename)
+        if os.path.exists(self.path(key)):
+            # same bytes stored before
+            os.remove(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+            os.chmod(tmp.name, 0o644)
+            os.replace(tmp.name, self.path(key))
+        return StoredFile(key, sha256.hexdigest(), size)
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write whole file before it's visible to readers
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key):
+        return f'{self.base_url}/{key}'
+
+
+class MemoryStorage(Storage):
+    """Keeps files in a dict, standing in for an object store (S3, GCS)
+    in tests and benchmarks. Objects are only visible in this process."""
+
+    process_safe = False
+
+    def __init__(self, base_url='https://objects.example.com'):
+        self.base_url = base_url.rstrip('/')
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<MemoryStorage {len(self.objects)} objects>'
+
+    def save(self, stream, filename, max_size=MAX_UPLOAD_BYTES):
+        # object stores take multipart uploads, gathered in a buffer here
+        sha256 = hashlib.sha256()
+        buffer = io.BytesIO()
+        for chunk in read_chunks(stream, max_size):
+            sha256.update(chunk)
+            buffer.write(chunk)
+
+        key = content_key(sha256.hexdigest(), filename)
+        with self._lock:
+            self.objects.setdefault(key, buffer.getvalue())
+        return StoredFile(key, sha256.hexdigest(), buffer.tell())
+
+    def put(self, key, data):
+        with self._lock:
+            self.objects[key] = bytes(data)
+
+    def open(self, key):
+        try:
+            return io.BytesIO(self.objects[key])
+        except KeyError:
+            raise FileNotFoundError(key) from None
+
+    def exists(self, key):
+        return key in self.objects
+
+    def delete(self, key):
+        with self._lock:
+            self.objects.pop(key, None)
+
+    def url(self, key):
+        return f'{self.base_url}/{key}'
+
+
+def create_storage(config, static_folder):
+    """Returns storage backend set by STORAGE_BACKEND ('local' or 'memory')"""
+
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config.get('STORAGE_ROOT') or static_folder,
+                            config.get('STORAGE_URL') or '/static')
+    if backend == 'memory':
+        return MemoryStorage(config.get('STORAGE_URL') or 'https://objects.example.com')
+    raise ValueError(f'Unknown storage backend: {backend!r}')
+
+
+def init_storage(app):
+    """Sets up app's storage backend from its config"""
+
+    app.extensions['storage'] = create_storage(app.config, app.static_folder)
+    return app.extensions['storage']
+
+
+def current_storage():
+    """Returns storage backend of current app"""
+
+    return current_app.extensions['storage']
+
+
+def import_file(storage, key, path):
+    """Copies file at path into storage under key unless it's there,
+    returns True if copied"""
+
+    if storage.exists(key):
+        return False
+    with open(path, 'rb') as file:
+        storage.put(key, file.read())
+    return True
@@ -0,0 +1,189 @@
+"""Sized WebP and JPEG copies of uploaded images
+
+Feed pages show post photos at most ~700px wide and profile images as
+50-180px avatars, so every upload gets copies at a few widths, stored
+in a thumbs/ folder next to it in the same storage backend. Images are
+never enlarged: widths at or above the original's are replaced by one
+copy at its own width. A small JSON file listing the widths made is
+stored last, marking the copies complete. Templates list them in srcset
+(WebP first, JPEG for browsers without WebP) and fall back to the
+original until the copies exist. Resizing is CPU-bound, so it runs in a
+process pool.
+
+Copies are re-encoded from decoded pixels, so EXIF (camera, GPS) is not
+carried over; camera rotation is applied first."""
+
+import io
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from views.caches import LRUTTLCache
+from views.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+THUMBS_DIR = 'thumbs'
+POST_WIDTHS = (480, 960, 1440)
+AVATAR_WIDTHS = (64, 192, 384)
+# (file extension, Pillow format); WebP listed first in srcset
+FORMATS = (('webp', 'WEBP'), ('jpg', 'JPEG'))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+
+_pool = None
+_pool_lock = threading.Lock()
+# (storage, key) => Future of copies being made by this process
+_pending = {}
+# (storage, key) => widths of images known to have all their copies
+_made_widths = LRUTTLCache(maxsize=int(os.environ.get('THUMBNAIL_CACHE_SIZE', 4096)),
+                           ttl=int(os.environ.get('THUMBNAIL_CACHE_TTL', 24 * 3600)))
+metrics.register('thumbnail_widths_cache', _made_widths.stats)
+
+
+def start_thumbnail_pool(processes=2):
+    """Starts pool of processes making copies in the background"""
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=processes)
+    return _pool
+
+
+def variant_key(key, width, ext):
+    """Returns key of image's copy at width"""
+
+    folder, filename = key.rpartition('/')[::2]
+    return f'{folder}/{THUMBS_DIR}/{filename}.{width}.{ext}'.lstrip('/')
+
+
+def widths_key(key):
+    """Returns key of the list of widths image's copies were made at"""
+
+    folder, filename = key.rpartition('/')[::2]
+    return f'{folder}/{THUMBS_DIR}/{filename}.json'.lstrip('/')
+
+
+def variant_widths(storage, key):
+    """Returns widths of image's copies, None until all of them exist"""
+
+    widths = _made_widths.get((storage, key))
+    if widths is not None:
+        return widths
+    try:
+        with storage.open(widths_key(key)) as file:
+            widths = tuple(json.load(file))
+    except FileNotFoundError:
+        return None
+    _made_widths.set((storage, key), widths)
+    return widths
+
+
+def has_variants(storage, key):
+    """Returns True if all copies of image exist"""
+
+    return variant_widths(storage, key) is not None
+
+
+def fitting_widths(widths, original_width):
+    """Returns widths narrower than the original, plus the original's
+    own width in place of any that aren't"""
+
+    fitting = [width for width in widths if width < original_width]
+    if len(fitting) < len(widths):
+        fitting.append(original_width)
+    return fitting
+
+
+def make_variants(storage, key, widths, quality=THUMBNAIL_QUALITY):
+    """Stores WebP and JPEG copies of image at each width (never wider
+    than the original, see fitting_widths) and then the list of widths
+    made, returns keys of the copies. Runs in pool processes."""
+
+    keys = []
+    with storage.open(key) as file, Image.open(file) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        icc_profile = img.info.get('icc_profile')
+
+        made_widths = fitting_widths(widths, img.width)
+        for width in made_widths:
+            copy = img
+            if width < img.width:
+                copy = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+            for ext, fmt in FORMATS:
+                data = io.BytesIO()
+                copy.save(data, fmt, quality=quality, icc_profile=icc_profile,
+                          **({'optimize': True} if fmt == 'JPEG' else {'method': 4}))
+                keys.append(variant_key(key, width, ext))
+                storage.put(keys[-1], data.getvalue())
+    storage.put(widths_key(key), json.dumps(made_widths).encode('utf-8'))
+    return keys
+
+
+def submit_variants(storage, key, widths):
+    """Starts making copies of image in the pool (or right away when no
+    pool is running, or storage is only visible to this process) unless
+    they exist. Returns Future of their keys."""
+
+    if has_variants(storage, key):
+        future = Future()
+        future.set_result([])
+        return future
+
+    # only pool state under the lock, resizing here happens after it
+    pending_key = (storage, key)
+    with _pool_lock:
+        future = _pending.get(pending_key)
+        if future is not None:
+            return future
+        run_here = _pool is None or not storage.process_safe
+        if run_here:
+            future = Future()
+        else:
+            future = _pool.submit(make_variants, storage, key, widths)
+        _pending[pending_key] = future
+
+    future.add_done_callback(lambda done: _finished(pending_key, done))
+    if run_here:
+        try:
+            future.set_result(make_variants(storage, key, widths))
+        except Exception as err:
+            future.set_exception(err)
+    return future
+
+
+def _finished(pending_key, future):
+    with _pool_lock:
+        _pending.pop(pending_key, None)
+    if future.exception() is None:
+        metrics.incr('thumbnails.made', len(future.result()))
+    else:
+        metrics.incr('thumbnails.failed')
+
+
+def ensure_variants(storage, key, widths, timeout=None):
+    """Makes copies of image unless they exist, waiting up to timeout
+    seconds. Returns True if they exist, logs and returns False if the
+    image couldn't be processed."""
+
+    try:
+        submit_variants(storage, key, widths).result(timeout)
+    except Exception:
+        logger.warning('Could not make sized copies of %s', key, exc_info=True)
+        return False
+    return has_variants(storage, key)
+
+
+def srcsets(key, widths, url):
+    """Returns srcset of each format (by extension) for image's copies
+    at widths (from variant_widths), with url(key) building each URL"""
+
+    return {ext: ', '.join(f'{url(variant_key(key, width, ext))} {width}w'
+                           for width in widths)
+            for ext, fmt in FORMATS}
@@ -0,0 +1,227 @@
+"""Background processing of uploaded posts
+
+search_music only saves the image and creates a pending Post with a queued
+UploadJob. Workers claim jobs from the upload_jobs table, get keywords and
+songs for the post, then mark it ready. Jobs are rows in the db, so they
+survive restarts, and failed jobs are retried with backoff."""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+from models.models import db, Song, UploadJob
+from views.api_funcs import request_keywords, get_list_of_tracks
+from views.images import prepare_for_keywording
+from views.metrics import metrics
+from views.storage import current_storage, image_key
+from views.thumbnails import POST_WIDTHS, ensure_variants
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+# Base delay before a failed job is retried, doubled for every attempt
+RETRY_DELAY = timedelta(seconds=10)
+# Running jobs not finished after this long are assumed lost with their worker
+STALE_AFTER = timedelta(minutes=5)
+# Seconds a job waits for its photo's sized copies before marking post ready
+THUMBNAIL_TIMEOUT = 60
+
+
+class UploadJobError(Exception):
+    """Raised when an upload job can't finish its post"""
+
+
+def enqueue_upload(post, image=None):
+    """Adds a queued job for post (and its UploadedImage) to the session
+    (committed by caller)"""
+
+    job = UploadJob(post=post, image=image)
+    db.session.add(job)
+    return job
+
+
+def claim_next_job():
+    """Claims the oldest job that is due (or was abandoned by a crashed
+    worker) and marks it running. Returns job or None if no job is due."""
+
+    now = datetime.now()
+    job = (UploadJob.query
+           .filter(or_(and_(UploadJob.status == 'queued',
+                            UploadJob.run_after <= now),
+                       and_(UploadJob.status == 'running',
+                            UploadJob.locked_at < now - STALE_AFTER)))
+           .order_by(UploadJob.id)
+           # workers in other processes skip rows already being claimed
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.locked_at = now
+    job.attempts += 1
+    db.session.commit()
+    return job
+
+
+def process_upload(job):
+    """Gets keywords and songs for job's post and marks post ready"""
+
+    post = job.post
+    keywords = get_post_keywords(job)
+
+    # send keywords to Spotify API to get song data as a list
+    song_data_list = get_list_of_tracks(keywords)
+    if not song_data_list:
+        raise UploadJobError('Spotify returned no songs')
+
+    # Find or add all songs at once, saved with the post and
+    # the songs' post counters in one commit
+    added_ids = []
+    for song in Song.resolve_songs(song_data_list):
+        if song not in post.songs:
+            post.songs.append(song)
+            added_ids.append(song.id)
+    Song.adjust_counts('post_count', {song_id: 1 for song_id in added_ids})
+
+    # sized copies of the photo, usually made by search_music already
+    ensure_variants(current_storage(), image_key('post-images', post.image),
+                    POST_WIDTHS, timeout=THUMBNAIL_TIMEOUT)
+
+    post.status = 'ready'
+    job.status = 'done'
+    job.last_error = None
+    db.session.commit()
+
+
+def get_post_keywords(job):
+    """Returns keywords for job's image, reusing keywords saved from an
+    earlier upload of the same photo when available"""
+
+    image = job.image
+    if image is not None and image.keywords:
+        metrics.incr('keywording.reused')
+        return image.keywords
+
+    # send downscaled copy of photo to AI-image API to get keywords
+    with current_storage().open(image_key('post-images', job.post.image)) as original:
+        image_file, prep_stats = prepare_for_keywording(original)
+    job.original_bytes = prep_stats['original_bytes']
+    job.keyword_bytes = prep_stats['sent_bytes']
+    job.preprocess_ms = prep_stats['preprocess_ms']
+    metrics.incr('keywording.bytes_saved', prep_stats['bytes_saved'])
+    metrics.observe('keywording.preprocess_ms', prep_stats['preprocess_ms'])
+
+    keywords = request_keywords(image_file)
+    if not keywords:
+        raise UploadJobError('Image API returned no keywords')
+
+    # save keywords for later uploads of the same photo (and for retries
+    # of this job if the song search fails)
+    if image is not None:
+        image.keywords = keywords
+        db.session.commit()
+    return keywords
+
+
+def run_next_job():
+    """Claims and processes one job, returns False if no job was due"""
+
+    job = claim_next_job()
+    if job is None:
+        return False
+
+    job_id = job.id
+    started = time.perf_counter()
+    try:
+        process_upload(job)
+        metrics.incr('upload_jobs.done')
+    except Exception as err:
+        db.session.rollback()
+        logger.exception('Upload job %s failed', job_id)
+        fail_job(UploadJob.query.get(job_id), err)
+    finally:
+        metrics.observe('upload_jobs.duration_ms', (time.perf_counter() - started) * 1000)
+    return True
+
+
+def fail_job(job, err):
+    """Requeues job with backoff, or marks job and its post failed
+    once out of attempts"""
+
+    job.last_error = str(err) or err.__class__.__name__
+
+    if job.attempts >= MAX_ATTEMPTS:
+        job.status = 'failed'
+        job.post.status = 'failed'
+        metrics.incr('upload_jobs.failed')
+    else:
+        job.status = 'queued'
+        delay = RETRY_DELAY * (2 ** (job.attempts - 1))
+        # don't retry before a throttling or broken API is worth trying again
+        retry_after = getattr(err, 'retry_after', None)
+        if retry_after:
+            delay = max(delay, timedelta(seconds=retry_after))
+        job.run_after = datetime.now() + delay
+        metrics.incr('upload_jobs.retried')
+    db.session.commit()
+
+
+class UploadWorker(threading.Thread):
+    """Daemon thread that keeps processing due upload jobs.
+    Sleeps poll_interval seconds between checks unless woken by a new upload."""
+
+    def __init__(self, app, poll_interval=5):
+        super().__init__(daemon=True, name='upload-worker')
+        self.app = app
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        """Starts checking for jobs right away"""
+
+        self._wake.set()
+
+    def stop(self):
+        """Stops worker after its current job"""
+
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                # new app context per job so each job gets a fresh session
+                while not self._stopping.is_set():
+                    with self.app.app_context():
+                        if not run_next_job():
+                            break
+            except Exception:
+                logger.exception('Upload worker could not check for jobs')
+            self._wake.wait(self.poll_interval)
+
+
+_workers = []
+
+def start_upload_workers(app, count=1, poll_interval=5):
+    """Starts count worker threads for app in this process"""
+
+    for _ in range(count - len(_workers)):
+        worker = UploadWorker(app, poll_interval=poll_interval)
+        worker.start()
+        _workers.append(worker)
+    return _workers
+
+
+def wake_upload_workers():
+    """Wakes this process's workers after a job was queued"""
+
+    for worker in _workers:
+        worker.wake()
@@ -0,0 +1,46 @@
+"""Saving uploaded post images, deduplicated by content hash"""
+
+from sqlalchemy.exc import IntegrityError
+
+from models.models import db, UploadedImage
+from views.images import perceptual_hash
+from views.metrics import metrics
+from views.storage import MAX_UPLOAD_BYTES
+
+
+def save_post_image(img_file, storage, max_size=MAX_UPLOAD_BYTES):
+    """Streams uploaded image file into storage under its content key
+    and returns its UploadedImage (added to session). Raises
+    UploadTooLarge if it's bigger than max_size bytes.
+
+    - identical bytes: earlier image is returned, stored only once
+    - near-duplicate (close perceptual hash): new file is stored, but
+      keywords of the earlier upload are copied so keywording is skipped"""
+
+    stored = storage.save(img_file.stream, img_file.filename, max_size)
+
+    image = UploadedImage.query.filter_by(sha256=stored.sha256).first()
+    if image:
+        metrics.incr('uploads.duplicates')
+        return image
+
+    with storage.open(stored.key) as file:
+        phash = perceptual_hash(file)
+    similar = None
+    if phash:
+        similar = UploadedImage.find_similar(phash)
+        if similar:
+            metrics.incr('uploads.near_duplicates')
+
+    image = UploadedImage(sha256=stored.sha256,
+                          phash=phash,
+                          filename=stored.key,
+                          keywords=similar.keywords if similar else None)
+    try:
+        with db.session.begin_nested():
+            db.session.add(image)
+    except IntegrityError:
+        # same bytes saved by a concurrent upload, use its record
+        image = UploadedImage.query.filter_by(sha256=stored.sha256).one()
+        metrics.incr('uploads.duplicates')
+    return image